@@ -19,6 +19,13 @@ def func(session):
     )
 
 
+@nox.session(python=VERSIONS[-1])
+def benchmark(session):
+    session.install("-e", ".")
+    args = session.posargs or ["config"]
+    session.run("python", "-m", "ncolony.tests.benchmark", *args)
+
+
 @nox.session(python=VERSIONS)
 def tests(session):
     tmpdir = session.create_tmp()
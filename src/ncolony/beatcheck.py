@@ -16,50 +16,422 @@ Processes are encouraged to try and beat about 3-4 times
 faster than the minimum, so that they can miss one beat, and
 account for slight timer inaccuracies, and still not be considered
 unhealthy.
+
+The configuration directory is scanned every :code:`--freq` seconds,
+but each process is checked at its own deadline, so a process
+that stops beating is restarted soon after its deadline.
 """
 
+import collections
 import functools
+import heapq
+import itertools
 import json
-import time
+import os
+import stat
 
-from twisted.python import filepath, usage
+from twisted.python import filepath, log, usage
 
 from twisted.application import internet as tainternet
+from twisted.internet import defer, protocol, reactor as tireactor, task
 
-from ncolony import ctllib
+from ncolony import ctllib, instrument, scanner as scannerlib, statustable
 from ncolony.client import heart
 
 
-def check(path, start, now):
+Heart = collections.namedtuple("Heart", "period grace status")
+
+# pylint: disable=too-few-public-methods
+
+
+class State:
+
+    """Parsed heartbeat configuration of a process
+
+    The configuration file is only read again when its fingerprint
+    changes (see :code:`ncolony.scanner.readFile`), and only parsed
+    again when its contents do.
+
+    :params location: a twisted.python.filepath.FilePath, the configuration
+    """
+
+    KEY = "ncolony.beatcheck"
+
+    def __init__(self, location):
+        self.location = location
+        self.name = location.basename()
+        self.fingerprint = None
+        self.content = None
+        self.mtime = None
+        self.heart = None
+
+    def apply(self, snapshot):
+        """Parse the configuration again if it changed
+
+        :params snapshot: a ncolony.scanner.Snapshot of the configuration
+        :returns: boolean, whether the configuration changed
+        """
+        self.mtime = snapshot.mtime
+        if snapshot.content is None:
+            return False
+        if snapshot.content == self.content:
+            self.fingerprint = snapshot.fingerprint
+            return False
+        parsed = json.loads(snapshot.content)
+        params = parsed.get(self.KEY)
+        self.heart = None
+        if params is not None:
+            self.heart = Heart(params["period"], params["grace"], params["status"])
+        self.fingerprint = snapshot.fingerprint
+        self.content = snapshot.content
+        return True
+
+
+# pylint: enable=too-few-public-methods
+
+
+def check(path, start, now, table=None):
     """check which processes need to be restarted
 
+    This is a single scan of a Scheduler, at a fixed time.
+
     :params path: a twisted.python.filepath.FilePath with configurations
     :params start: when the checker started running
     :params now: current time
+    :params table: a ncolony.statustable.StatusTable to record heartbeats
+                   and health in, or None
     :returns: list of strings
     """
-    return [child.basename() for child in path.children() if _isbad(child, start, now)]
-
-
-def _isbad(child, start, now):
-    content = child.getContent()
-    parsed = json.loads(content)
-    params = parsed.get("ncolony.beatcheck")
-    if params is None:
-        return False
-    period = params["period"]
-    grace = params["grace"]
-    mtime = max(child.getModificationTime(), start)
-    if mtime + period * grace >= now:
-        return False
-    status = params["status"]
-    statusPath = child.clonePath(status)
-    if not statusPath.exists():
-        return True
-    if statusPath.isdir():
-        statusPath = statusPath.child(child.basename())
-    statusMtime = statusPath.getModificationTime()
-    return (statusMtime + period) < now
+    clock = task.Clock()
+    clock.advance(now)
+    ret = []
+    Scheduler(1, clock, path, start, ret.append, table).scan()
+    return ret
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _scan(directory):
+    ret = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    ret[entry.name] = entry.stat().st_mtime
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return ret
+
+
+# pylint: disable=too-few-public-methods
+
+
+class StatusReader:
+
+    """Read heartbeat times, sharing directory reads within one check
+
+    A status is either a file, or a directory with a file for each
+    process. The first process in a status directory costs a stat of
+    the directory and one of its file. When more processes in the same
+    directory are checked, the directory is read once with os.scandir,
+    and their heartbeats come from that.
+
+    A reader is meant for one pass over the processes: it does not
+    notice heartbeats that happen after it read a directory.
+    """
+
+    def __init__(self):
+        self._isdir = {}
+        self._once = set()
+        self._scans = {}
+
+    def lastBeat(self, status, name):
+        """Find the time of a process's last heartbeat
+
+        :params status: string, the status file or directory
+        :params name: string, name of process
+        :returns: number, or None if there was no heartbeat
+        """
+        isdir = self._isdir.get(status)
+        if isdir is None:
+            try:
+                info = os.stat(status)
+            except OSError:
+                return None
+            isdir = self._isdir[status] = stat.S_ISDIR(info.st_mode)
+            if not isdir:
+                return info.st_mtime
+        if not isdir:
+            return _mtime(status)
+        beats = self._scans.get(status)
+        if beats is None:
+            if status not in self._once:
+                self._once.add(status)
+                return _mtime(os.path.join(status, name))
+            beats = self._scans[status] = _scan(status)
+        return beats.get(name)
+
+
+# pylint: enable=too-few-public-methods
+
+
+def _readBeats(needed):
+    reader = StatusReader()
+    return {name: reader.lastBeat(status, name) for status, name in needed}
+
+
+# pylint: disable=too-many-arguments,too-many-instance-attributes
+
+
+class Scheduler(tainternet.TimerService):
+
+    """Check heartbeats when they are due
+
+    Every step, the configuration directory is scanned for added,
+    changed and removed processes. Each process has a deadline:
+    the end of its grace period, or a period after its last heartbeat,
+    whichever is later. Deadlines are kept in a heap, and the scheduler
+    wakes up at the earliest one, so only processes whose deadline has
+    passed are checked, and a process that stopped beating is restarted
+    at its deadline rather than on the next step.
+
+    A process that was restarted is checked again after its grace period.
+
+    Heartbeats received by a BeatProtocol are kept in memory. The
+    status file of a process is only looked at when there is no
+    recent enough heartbeat in memory.
+
+    Configuration and status files are read with the scanner, so
+    they can be read in threads. Processes that are due while
+    heartbeats are being read are checked once that read is done,
+    and processes whose heartbeats could not be read in time are
+    checked again after a step. When every heartbeat needed is in
+    memory, no files are read.
+
+    :params step: number, seconds between scans of the configuration
+    :params reactor: IReactorTime
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params start: when the checker started running
+    :params restarter: function of one argument, the name of a process
+                       to restart
+    :params table: a ncolony.statustable.StatusTable to record heartbeats
+                   and health in, or None
+    :params scanner: a ncolony.scanner.Scanner, or None to read on the
+                     reactor thread
+    :params stats: a ncolony.instrument.Stats to record the time spent
+                   reading, parsing and checking in, or None
+    """
+
+    def __init__(
+        self,
+        step,
+        reactor,
+        path,
+        start,
+        restarter,
+        table=None,
+        scanner=None,
+        stats=None,
+    ):
+        self.stats = instrument.ensure(stats).scoped("beatcheck")
+        tainternet.TimerService.__init__(
+            self, step, self.stats.timed("tick", self.scan)
+        )
+        self.clock = reactor
+        self.path = path
+        self.epoch = start
+        self.restarter = restarter
+        self.table = table
+        self.scanner = scanner
+        self.states = {}
+        self.beats = {}
+        self.deadlines = []
+        self.generations = {}
+        self._counter = itertools.count()
+        self._call = None
+        self._reading = False
+        self._waiting = []
+
+    def _run(self, key, func, *args):
+        if self.scanner is None:
+            return scannerlib.inline(key, func, *args)
+        return self.scanner.run(key, func, *args)
+
+    def scan(self):
+        """Find added, changed and removed processes, and check those due
+
+        :returns: Deferred that fires when the check is done
+        """
+        known = {name: state.fingerprint for name, state in self.states.items()}
+        read = self.stats.timed("read", self._run)
+        d = read(self.path.path, scannerlib.readDirectory, self.path.path, known)
+        d.addCallback(self._scanned)
+        d.addErrback(scannerlib.skipped, self.path.path)
+        return d
+
+    def _scanned(self, snapshots):
+        with self.stats.timing("parse"):
+            changed = self._parse(snapshots)
+        return self._checkAll(changed)
+
+    def _parse(self, snapshots):
+        if self.table is not None:
+            self.table.refresh()
+        for name in set(self.states) - set(snapshots):
+            del self.states[name]
+            self.beats.pop(name, None)
+            self.generations.pop(name, None)
+        changed = []
+        for name, snapshot in snapshots.items():
+            state = self.states.get(name)
+            if state is None:
+                state = self.states[name] = State(self.path.child(name))
+            if not state.apply(snapshot):
+                continue
+            if state.heart is None:
+                self.generations.pop(name, None)
+            else:
+                changed.append(state)
+        return changed
+
+    def _popDue(self, now):
+        ret = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, generation, name = heapq.heappop(self.deadlines)
+            if self.generations.get(name) == generation:
+                ret.append(self.states[name])
+        return ret
+
+    def _checkAll(self, states):
+        self._cancel()
+        now = self.clock.seconds()
+        states = states + self._popDue(now)
+        if self._reading:
+            # Not a slow read: ours, which will check these when done
+            self._waiting.extend(states)
+            return None
+        if not states:
+            self._reschedule()
+            return None
+        needed = []
+        for state in states:
+            lastBeat = self.beats.get(state.name)
+            if lastBeat is None or lastBeat + state.heart.period <= now:
+                needed.append((state.heart.status, state.name))
+        if needed:
+            read = self.stats.timed("heartbeats", self._run)
+            d = read("heartbeats", _readBeats, needed)
+        else:
+            d = defer.succeed({})
+        self._reading = True
+        d.addCallback(self.stats.timed("dispatch", self._checkBeats), states)
+        d.addErrback(self._retry, states)
+        d.addBoth(self._readDone)
+        return d
+
+    def _readDone(self, dummy):
+        self._reading = False
+        waiting, self._waiting = self._waiting, []
+        if waiting:
+            self._checkAll(waiting)
+        else:
+            self._reschedule()
+
+    def _checkBeats(self, fileBeats, states):
+        now = self.clock.seconds()
+        for state in states:
+            if self.states.get(state.name) is state and state.heart is not None:
+                self._check(state, now, fileBeats.get(state.name))
+
+    def _retry(self, reason, states):
+        scannerlib.skipped(reason, "heartbeats")
+        now = self.clock.seconds()
+        for state in states:
+            if self.states.get(state.name) is state and state.heart is not None:
+                self._push(state, now + self.step)
+
+    def _check(self, state, now, fileBeat):
+        params = state.heart
+        deadline = max(state.mtime, self.epoch) + params.period * params.grace
+        lastBeat = self.beats.get(state.name)
+        if fileBeat is not None:
+            lastBeat = max(lastBeat or fileBeat, fileBeat)
+        if lastBeat is not None:
+            deadline = max(deadline, lastBeat + params.period)
+        bad = deadline <= now
+        if bad:
+            self.restarter(state.name)
+            deadline = now + max(params.period * params.grace, self.step)
+        if self.table is not None:
+            health = statustable.UNHEALTHY if bad else statustable.HEALTHY
+            self.table.setHealth(state.name, lastBeat or 0, health)
+        self._push(state, deadline)
+
+    def _push(self, state, deadline):
+        generation = next(self._counter)
+        self.generations[state.name] = generation
+        heapq.heappush(self.deadlines, (deadline, generation, state.name))
+
+    def beat(self, name):
+        """Note a heartbeat of a process
+
+        :params name: string, name of process
+        :returns: None
+        """
+        if name in self.states:
+            self.beats[name] = self.clock.seconds()
+
+    def _wake(self):
+        self._call = None
+        self._checkAll([])
+
+    def _reschedule(self, dummy=None):
+        self._cancel()
+        if self.deadlines:
+            delay = max(0, self.deadlines[0][0] - self.clock.seconds())
+            self._call = self.clock.callLater(delay, self._wake)
+
+    def _cancel(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def stopService(self):
+        """Stop scanning, and stop waking up for deadlines"""
+        self._cancel()
+        return tainternet.TimerService.stopService(self)
+
+
+# pylint: enable=too-many-arguments,too-many-instance-attributes
+
+
+class BeatProtocol(protocol.DatagramProtocol):
+
+    """Receive heartbeats on a Unix datagram socket
+
+    Each datagram is the name of a process.
+
+    :params scheduler: a Scheduler
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def datagramReceived(self, datagram, addr):
+        """Note a heartbeat"""
+        try:
+            name = datagram.decode("utf-8")
+        except UnicodeDecodeError:
+            log.msg("Ignoring heartbeat that is not a name: ", repr(datagram))
+            return
+        self.scheduler.beat(name)
 
 
 def run(restarter, checker, timer):
@@ -88,20 +460,69 @@ def parseConfig(opt):
     return restarter, path
 
 
+def makeScanner(opt):
+    """Make a scanner to read configuration in threads
+
+    :params opt: dictionary-like object with 'freq', and optionally
+                 'scan-threads' and 'scan-timeout' (which defaults
+                 to 'freq')
+    :returns: a ncolony.scanner.Scanner, named "scanner"
+    """
+    timeout = opt.get("scan-timeout")
+    if timeout is None:
+        timeout = opt["freq"]
+    ret = scannerlib.Scanner(
+        tireactor, size=opt.get("scan-threads", 4), timeout=timeout
+    )
+    ret.setName("scanner")
+    return ret
+
+
+class _BeatServer(tainternet.UNIXDatagramServer):
+    def startService(self):
+        """Remove a socket left over from an earlier run, and listen"""
+        address = self.args[0]
+        if os.path.exists(address):
+            os.remove(address)
+        tainternet.UNIXDatagramServer.startService(self)
+
+
 def makeService(opt):
     """Make a service
 
-    :params opt: dictionary-like object with 'freq', 'config' and 'messages'
-    :returns: twisted.application.internet.TimerService that at opt['freq']
-              checks for stale processes in opt['config'], and sends
-              restart messages through opt['messages']
+    :params opt: dictionary-like object with 'freq', 'config' and 'messages',
+                 and optionally 'status-table', 'socket', 'scan-threads',
+                 'scan-timeout' and 'stats'
+    :returns: service with a Scheduler that at opt['freq'] scans
+              opt['config'], and sends restart messages for stale processes
+              through opt['messages']
     """
     restarter, path = parseConfig(opt)
-    now = time.time()
-    checker = functools.partial(check, path, now)
-    beatcheck = tainternet.TimerService(opt["freq"], run, restarter, checker, time.time)
+    table = None
+    if opt.get("status-table") is not None:
+        table = statustable.StatusTable(opt["status-table"])
+    scanner = makeScanner(opt)
+    stats = instrument.maybeStats(opt.get("stats"))
+    beatcheck = Scheduler(
+        opt["freq"],
+        tireactor,
+        path,
+        tireactor.seconds(),
+        restarter,
+        table,
+        scanner=scanner,
+        stats=stats,
+    )
     beatcheck.setName("beatcheck")
-    return heart.wrapHeart(beatcheck)
+    ret = heart.wrapHeart(beatcheck)
+    scanner.setServiceParent(ret)
+    instrument.maybeAddService(ret, stats, opt.get("stats"), tireactor)
+    address = opt.get("socket")
+    if address is not None:
+        listener = _BeatServer(address, BeatProtocol(beatcheck))
+        listener.setName("beats")
+        listener.setServiceParent(ret)
+    return ret
 
 
 # pylint: disable=too-few-public-methods
@@ -115,6 +536,17 @@ class Options(usage.Options):
         ["messages", None, None, "Directory for messages"],
         ["config", None, None, "Directory for configuration"],
         ["freq", None, 10, "Frequency of checking for updates", float],
+        ["status-table", None, None, "Status table to record heartbeats in"],
+        ["socket", None, None, "Unix datagram socket to receive heartbeats on"],
+        ["scan-threads", None, 4, "Most threads reading configuration", int],
+        [
+            "scan-timeout",
+            None,
+            None,
+            "Seconds to wait for reading configuration (default: freq)",
+            float,
+        ],
+        ["stats", None, None, "File to write event loop stats to"],
     ]
 
     def postOptions(self):
@@ -5,11 +5,26 @@
 =====================
 
 A heart beater.
+
+By default, each beat touches the status file. If the configuration
+has a :code:`socket`, beats are sent as datagrams to the beat checker's
+Unix socket instead, and the file is only touched by the first beat
+(so restarts waiting for a heartbeat see it) and when sending fails.
+
+By default, the heart beats three times a period. If the configuration
+has :code:`beats` (how many beats to aim for in a period) or
+:code:`margin` (the part of the period to keep free as a safety margin),
+the heart adapts instead: it beats :code:`beats` times a period, but
+beats more often when its timer fires late, so that a beat is never
+expected later than :code:`1 - margin` of the period after the last one.
+Fewer beats a period means fewer writes to the status file system.
 """
 from __future__ import division
 
+import collections
 import json
 import os
+import socket
 
 from twisted.python import filepath
 from twisted.application import internet as tainternet, service as taservice
@@ -34,6 +49,102 @@ class Heart:
         self.path.touch()
 
 
+class SocketHeart(Heart):
+
+    """A Heart that sends beats to a Unix datagram socket.
+
+    Each beat is a datagram with the name of the process.
+    The first beat also touches the file, since waiting for a
+    restarted process to beat only looks at the file.
+    If a beat cannot be sent, the file is touched instead.
+    """
+
+    def __init__(self, path, address, name):
+        super().__init__(path)
+        self.address = address
+        self.name = name
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.touched = False
+
+    def beat(self):
+        """Send a beat, or touch the file"""
+        if not self.touched:
+            self.touched = True
+            super().beat()
+        try:
+            self.socket.sendto(self.name.encode("utf-8"), self.address)
+        except OSError:
+            super().beat()
+
+
+# pylint: disable=too-many-arguments,too-many-instance-attributes
+class AdaptiveBeater(taservice.Service):
+
+    """Beat a heart as rarely as is safe
+
+    Each time a beat is late, the lateness (timer jitter and reactor lag)
+    is noted. The next beat is due after :code:`period / beats`, or
+    sooner, if the worst recent lateness would otherwise push it past
+    the safety margin. Beats are never more than :code:`maxBeats`
+    times a period.
+
+    :param reactor: IReactorTime
+    :param heart: a Heart
+    :param period: number, the heartbeat period
+    :param beats: number, how many beats to aim for in a period
+    :param margin: number, the part of the period to keep as a safety margin
+    :param window: integer, how many recent beats to take the lateness of
+    """
+
+    maxBeats = 10
+
+    def __init__(self, reactor, heart, period, beats=3, margin=0.1, window=10):
+        self.reactor = reactor
+        self.heart = heart
+        self.period = period
+        self.beats = beats
+        self.margin = margin
+        self.lags = collections.deque(maxlen=window)
+        self._due = None
+        self._call = None
+
+    def interval(self):
+        """How long to wait for the next beat
+
+        :returns: number
+        """
+        lag = max(self.lags, default=0)
+        safe = self.period * (1 - self.margin) - lag
+        ret = min(self.period / self.beats, safe)
+        return max(ret, self.period / self.maxBeats)
+
+    def startService(self):
+        """Beat, and keep beating"""
+        taservice.Service.startService(self)
+        self._beat()
+
+    def _beat(self):
+        now = self.reactor.seconds()
+        if self._due is not None:
+            self.lags.append(max(now - self._due, 0))
+        self.heart.beat()
+        delay = self.interval()
+        self._due = now + delay
+        self._call = self.reactor.callLater(delay, self._beat)
+
+    def stopService(self):
+        """Stop beating"""
+        taservice.Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = self._due = None
+        self.lags.clear()
+
+
+# pylint: enable=too-many-arguments,too-many-instance-attributes
+
+
 def makeService():
     """Make a service
 
@@ -50,7 +161,24 @@ def makeService():
     if myFilePath.isdir():
         name = os.environ["NCOLONY_NAME"]
         myFilePath = myFilePath.child(name)
-    heart = Heart(myFilePath)
+    address = params.get("socket")
+    if address is None:
+        heart = Heart(myFilePath)
+    else:
+        heart = SocketHeart(myFilePath, address, os.environ["NCOLONY_NAME"])
+    if "beats" in params or "margin" in params:
+        # Only import the reactor when it is needed,
+        # so that programs can install their own first.
+        # pylint: disable=import-outside-toplevel
+        from twisted.internet import reactor
+
+        return AdaptiveBeater(
+            reactor,
+            heart,
+            params["period"],
+            beats=params.get("beats", 3),
+            margin=params.get("margin", 0.1),
+        )
     ret = tainternet.TimerService(params["period"] / 3, heart.beat)
     return ret
 
@@ -6,8 +6,11 @@ from __future__ import division
 
 import json
 import os
+import shutil
+import socket
 import unittest
 
+from twisted.internet import task
 from twisted.python import filepath
 from twisted.application import internet as tainternet
 
@@ -152,3 +155,109 @@ class TestHeart(unittest.TestCase):
         myEnv["NCOLONY_CONFIG"] = configJSON
         replaceEnvironment(self, myEnv)
         self.assertIsNone(heart.makeService())
+
+    def test_make_service_socket(self):
+        """Test make service sends beats to a socket when configured"""
+        params = dict(status="my.status", period=10, grace=3, socket="beats")
+        myEnv = buildEnv(params=params)
+        myEnv["NCOLONY_NAME"] = "hello"
+        replaceEnvironment(self, myEnv)
+        service = heart.makeService()
+        myHeart = _getSelf(service.call[0])
+        self.addCleanup(myHeart.socket.close)
+        self.assertIsInstance(myHeart, heart.SocketHeart)
+        self.assertEqual(myHeart.address, "beats")
+        self.assertEqual(myHeart.name, "hello")
+        self.assertEqual(myHeart.getFile().basename(), "my.status")
+
+    def test_make_service_adaptive(self):
+        """Test make service builds an adaptive heart when configured"""
+        params = dict(status="my.status", period=10, grace=3, beats=1.5)
+        replaceEnvironment(self, buildEnv(params=params))
+        service = heart.makeService()
+        self.assertIsInstance(service, heart.AdaptiveBeater)
+        self.assertEqual(service.heart.getFile().basename(), "my.status")
+        self.assertEqual((service.period, service.beats), (10, 1.5))
+        self.assertEqual(service.margin, 0.1)
+
+
+class TestAdaptiveBeater(unittest.TestCase):
+
+    """Tests for adapting the beat rate"""
+
+    def setUp(self):
+        """Make an adaptive heart with a fake clock"""
+        self.clock = task.Clock()
+        self.fake = DummyFile()
+        self.beater = heart.AdaptiveBeater(
+            self.clock, heart.Heart(self.fake), 10, beats=1.25, margin=0.1, window=2
+        )
+
+    def test_steady(self):
+        """Without lateness, the heart beats as rarely as asked"""
+        self.beater.startService()
+        self.assertEqual(self.fake.touched, 1)
+        self.clock.advance(7.9)
+        self.assertEqual(self.fake.touched, 1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.fake.touched, 2)
+        self.assertEqual(list(self.beater.lags), [0])
+
+    def test_late(self):
+        """Late beats make the following beats come sooner"""
+        self.beater.startService()
+        self.clock.advance(10)
+        self.assertEqual(self.fake.touched, 2)
+        self.assertEqual(self.beater.interval(), 7)
+        self.clock.pump([7, 7])
+        self.assertEqual(self.fake.touched, 4)
+        self.assertEqual(self.beater.interval(), 8)
+
+    def test_floor(self):
+        """However late the beats, the heart does not beat too often"""
+        self.beater.lags.append(100)
+        self.assertEqual(self.beater.interval(), 1)
+
+    def test_stop(self):
+        """Stopping the service stops the beats"""
+        self.beater.startService()
+        self.clock.advance(9)
+        self.beater.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(list(self.beater.lags), [])
+        self.beater.stopService()
+        self.clock.advance(100)
+        self.assertEqual(self.fake.touched, 2)
+
+
+class TestSocketHeart(unittest.TestCase):
+
+    """Tests for sending beats to a socket"""
+
+    def setUp(self):
+        """Make a directory for the socket"""
+        self.directory = os.path.abspath("dummy-beats")
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.address = os.path.join(self.directory, "beats")
+        self.fake = DummyFile()
+        self.heart = heart.SocketHeart(self.fake, self.address, "hello")
+        self.addCleanup(self.heart.socket.close)
+
+    def test_beat(self):
+        """Beats are sent as datagrams with the name"""
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(self.address)
+        for _ in range(2):
+            self.heart.beat()
+            self.assertEqual(receiver.recv(100), b"hello")
+        self.assertEqual(self.fake.touched, 1)
+
+    def test_fallback(self):
+        """The file is touched when the beat cannot be sent"""
+        self.heart.touched = True
+        self.heart.beat()
+        self.assertEqual(self.fake.touched, 1)
@@ -0,0 +1,201 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.cron
+==============
+
+Parse cron expressions, and find when they are next due.
+
+An expression has five fields: minute (0-59), hour (0-23),
+day of month (1-31), month (1-12 or jan-dec) and day of week
+(0-7 or sun-sat, where both 0 and 7 are Sunday). Each field is
+:code:`*`, a value, a range (:code:`1-5`), any of those with a step
+(:code:`*/15`, :code:`1-30/2`, or :code:`5/10`, meaning from 5 on),
+or a comma-separated list of them. As in cron, when both the day of
+month and the day of week are restricted, a day matching either
+is due. Expressions that can never be due, like :code:`0 0 30 2 *`,
+are rejected.
+
+The aliases :code:`@yearly` (or :code:`@annually`), :code:`@monthly`,
+:code:`@weekly`, :code:`@daily` (or :code:`@midnight`) and
+:code:`@hourly` are also understood.
+
+Times are in local time.
+"""
+
+import bisect
+import calendar
+import datetime
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+MONTHS = dict(
+    (name, number)
+    for number, name in enumerate(
+        "jan feb mar apr may jun jul aug sep oct nov dec".split(), start=1
+    )
+)
+
+WEEKDAYS = dict(
+    (name, number) for number, name in enumerate("sun mon tue wed thu fri sat".split())
+)
+
+# Give up looking for a due time this many years ahead
+_HORIZON = 5
+
+
+def _value(text, names):
+    if text.lower() in names:
+        return names[text.lower()]
+    return int(text)
+
+
+def _parseField(text, low, high, names=None):
+    names = names or {}
+    values = set()
+    for part in text.split(","):
+        rangeText, slash, stepText = part.partition("/")
+        step = int(stepText) if slash else 1
+        if rangeText == "*":
+            start, end = low, high
+        else:
+            startText, dash, endText = rangeText.partition("-")
+            start = _value(startText, names)
+            if dash:
+                end = _value(endText, names)
+            elif slash:
+                end = high
+            else:
+                end = start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError("Bad cron field", text)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Schedule:
+
+    """When a cron expression is due
+
+    :params minutes: set of integers
+    :params hours: set of integers
+    :params days: set of integers, days of month
+    :params months: set of integers
+    :params weekdays: set of integers, days of week (0 is Sunday)
+    :params anyDay: boolean, whether days of month are unrestricted
+    :params anyWeekday: boolean, whether days of week are unrestricted
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, minutes, hours, days, months, weekdays, anyDay=False, anyWeekday=False
+    ):
+        self.minutes = tuple(sorted(minutes))
+        self.hours = frozenset(hours)
+        self.days = frozenset(days)
+        self.months = frozenset(months)
+        self.weekdays = frozenset(weekdays)
+        self.anyDay = anyDay
+        self.anyWeekday = anyWeekday
+
+    # pylint: enable=too-many-arguments
+
+    def __eq__(self, other):
+        return isinstance(other, Schedule) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return "<%s:%s>" % (self.__class__.__name__, vars(self))
+
+    def _isDay(self, when):
+        isDay = when.day in self.days
+        isWeekday = (when.weekday() + 1) % 7 in self.weekdays
+        if self.anyDay or self.anyWeekday:
+            return isDay and isWeekday
+        return isDay or isWeekday
+
+    def next(self, after):
+        """Find when the expression is next due
+
+        Whole months, days and hours that are not due are skipped
+        at once, so this takes few steps.
+
+        :params after: datetime.datetime
+        :returns: datetime.datetime, the first due minute after it
+        :raises: ValueError, if not due in the next few years
+        """
+        when = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        horizon = when.year + _HORIZON
+        while when.year <= horizon:
+            if when.month not in self.months:
+                year, month = divmod(when.month, 12)
+                when = datetime.datetime(when.year + year, month + 1, 1)
+                continue
+            if not self._isDay(when):
+                when = datetime.datetime(when.year, when.month, when.day)
+                when += datetime.timedelta(days=1)
+                continue
+            index = bisect.bisect_left(self.minutes, when.minute)
+            if when.hour not in self.hours or index == len(self.minutes):
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            return when.replace(minute=self.minutes[index])
+        raise ValueError("Never due", self)
+
+    def nextTime(self, timestamp):
+        """Find when the expression is next due
+
+        When clocks go back, local times repeat: a due time whose
+        first occurrence already passed is taken at its second one,
+        so the result is always after the timestamp.
+
+        :params timestamp: number, seconds since the epoch
+        :returns: number, seconds since the epoch, later than timestamp
+        """
+        when = self.next(datetime.datetime.fromtimestamp(timestamp))
+        due = when.timestamp()
+        if due <= timestamp:
+            due = when.replace(fold=1).timestamp()
+        return due
+
+
+def parse(expression):
+    """Parse a cron expression
+
+    :params expression: string
+    :returns: Schedule
+    :raises: ValueError, if the expression is not valid, or names
+             only days that do not exist, like February 30th
+    """
+    expression = ALIASES.get(expression.strip().lower(), expression)
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError("Cron expressions have five fields", expression)
+    minutes, hours, days, months, weekdays = fields
+    weekdaySet = _parseField(weekdays, 0, 7, WEEKDAYS)
+    if 7 in weekdaySet:
+        weekdaySet = (weekdaySet - {7}) | {0}
+    schedule = Schedule(
+        minutes=_parseField(minutes, 0, 59),
+        hours=_parseField(hours, 0, 23),
+        days=_parseField(days, 1, 31),
+        months=_parseField(months, 1, 12, MONTHS),
+        weekdays=weekdaySet,
+        anyDay=days.startswith("*"),
+        anyWeekday=weekdays.startswith("*"),
+    )
+    # Only days of month can rule out every day: days of week always match
+    # some day, and a restricted day of week matches on its own
+    if schedule.anyWeekday and not any(
+        day <= calendar.monthrange(2000, month)[1]
+        for month in schedule.months
+        for day in schedule.days
+    ):
+        raise ValueError("Cron expression is never due", expression)
+    return schedule
@@ -30,6 +30,11 @@ Restart also needs just the name.
 
 Restart-all does not need even the name, since it restarts
 all processes.
+
+Restart-all and restart-group can restart processes a few at a time
+(a rolling restart), waiting for each restarted process to be running
+again (and, optionally, to have sent a heartbeat) before restarting
+more.
 """
 
 import argparse
@@ -38,9 +43,13 @@ import functools
 import itertools
 import json
 import os
+import sys
+import time
 
 from twisted.python import filepath
 
+from ncolony import statustable
+
 NEXT = functools.partial(next, itertools.count(0))
 
 Places = collections.namedtuple("Places", "config messages")
@@ -105,7 +114,13 @@ def remove(places, name):
     fle.remove()
 
 
-def _addMessage(places, content):
+def addMessage(places, content):
+    """Send a message
+
+    :params places: a Places instance
+    :params content: bytes, the JSON-encoded message
+    :returns: None
+    """
     messages = filepath.FilePath(places.messages)
     name = "%03dMessage.%s" % (NEXT(), os.getpid())
     message = messages.child(name)
@@ -120,17 +135,92 @@ def restart(places, name):
     :returns: None
     """
     content = _dumps(dict(type="RESTART", name=name))
-    _addMessage(places, content)
+    addMessage(places, content)
+
 
+def _rolling(details, batch, health, timeout):
+    if batch is not None:
+        details["batch"] = batch
+        if health:
+            details["health"] = True
+        if timeout is not None:
+            details["timeout"] = timeout
+    return details
 
-def restartAll(places):
+
+def restartAll(places, batch=None, health=False, timeout=None):
     """Restart all processes
 
     :params places: a Places instance
+    :params batch: integer, how many processes to restart at a time,
+                   or None to restart them all at once
+    :params health: boolean, whether a rolling restart should wait for
+                    restarted processes to send a heartbeat
+    :params timeout: number, seconds a rolling restart waits for a process
+                     to be ready before moving on
+    :returns: None
+    """
+    details = _rolling(dict(type="RESTART-ALL"), batch, health, timeout)
+    addMessage(places, _dumps(details))
+
+
+# pylint: disable=too-many-arguments
+def restartGroup(places, group, batch=None, health=False, timeout=None):
+    """Restart all processes in a group
+
+    :params places: a Places instance
+    :params group: string, the name of the group
+    :params batch: integer, how many processes to restart at a time,
+                   or None to restart them all at once
+    :params health: boolean, whether a rolling restart should wait for
+                    restarted processes to send a heartbeat
+    :params timeout: number, seconds a rolling restart waits for a process
+                     to be ready before moving on
     :returns: None
     """
-    content = _dumps(dict(type="RESTART-ALL"))
-    _addMessage(places, content)
+    details = _rolling(dict(type="RESTART-GROUP", group=group), batch, health, timeout)
+    addMessage(places, _dumps(details))
+
+
+# pylint: enable=too-many-arguments
+
+
+_HEALTH = {
+    statustable.UNKNOWN: "-",
+    statustable.HEALTHY: "healthy",
+    statustable.UNHEALTHY: "unhealthy",
+}
+
+
+def _formatTime(when):
+    if not when:
+        return "-"
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(when))
+
+
+def status(places, table, out=None):
+    """Print the status of all processes, from a status table
+
+    :params places: a Places instance (unused)
+    :params table: string, location of the status table
+    :params out: file to print to, or None for standard output
+    :returns: None
+    """
+    del places
+    if out is None:
+        out = sys.stdout
+    for name, state in sorted(statustable.read(table).items()):
+        out.write(
+            "%s %s %s %d %s %s\n"
+            % (
+                name,
+                state.pid or "-",
+                _formatTime(state.start),
+                state.restarts,
+                _formatTime(state.heartbeat),
+                _HEALTH.get(state.health, "-"),
+            )
+        )
 
 
 def _parseJSON(fname):
@@ -144,10 +234,20 @@ PARSER.add_argument("--messages", required=True)
 PARSER.add_argument("--config", required=True)
 _subparsers = PARSER.add_subparsers()
 _restart_all_parser = _subparsers.add_parser("restart-all")
+_restart_group_parser = _subparsers.add_parser("restart-group")
+_restart_group_parser.add_argument("group")
+for _parser in (_restart_all_parser, _restart_group_parser):
+    _parser.add_argument("--batch", type=int)
+    _parser.add_argument("--health", action="store_true")
+    _parser.add_argument("--timeout", type=float)
 _restart_all_parser.set_defaults(func=restartAll)
+_restart_group_parser.set_defaults(func=restartGroup)
 _restart_parser = _subparsers.add_parser("restart")
 _restart_parser.add_argument("name")
 _restart_parser.set_defaults(func=restart)
+_status_parser = _subparsers.add_parser("status")
+_status_parser.add_argument("--table", required=True)
+_status_parser.set_defaults(func=status)
 _remove_parser = _subparsers.add_parser("remove")
 _remove_parser.add_argument("name")
 _remove_parser.set_defaults(func=remove)
@@ -205,7 +305,18 @@ def main(argv):
         restart:
             name (positional)
         restart-all:
-            no arguments
+            --batch -- restart this many processes at a time
+
+            --health -- wait for heartbeats during a rolling restart
+
+            --timeout -- seconds to wait for a process during a rolling
+            restart
+        restart-group:
+            group (positional)
+
+            --batch, --health, --timeout -- as in restart-all
+        status:
+            --table (required) -- status table to read
     """
     argv = list(argv)
     if argv[0:1] == ["ctl"]:
@@ -6,73 +6,329 @@
 Monitor directories for configuration and messages
 """
 
+import collections
 import functools
+import hashlib
 import os
+import re
+import time
 
-from twisted.python import filepath
+from twisted.python import filepath, log
+from twisted.application import service
 
+from ncolony import instrument, interfaces
 
-def checker(location, receiver):
+try:
+    from twisted.internet import inotify
+except ImportError:  # pragma: no cover
+    inotify = None  # type: ignore[assignment]
+    CONFIG_MASK = MESSAGES_MASK = None
+else:
+    CONFIG_MASK = (
+        inotify.IN_CLOSE_WRITE
+        | inotify.IN_MOVED_TO
+        | inotify.IN_MOVED_FROM
+        | inotify.IN_DELETE
+        | inotify.IN_ATTRIB
+    )
+    MESSAGES_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+
+
+Fingerprint = collections.namedtuple("Fingerprint", "inode size mtime ctime")
+
+# Files modified this recently may be modified again without changing
+# their fingerprint, since file timestamps are only as precise as the
+# filesystem clock.
+RACY_WINDOW = 2 * 10**9
+
+
+def fingerprint(st):
+    """Summarize a stat result
+
+    :param st: an os.stat_result
+    :returns: a Fingerprint that changes whenever the file does
+    """
+    return Fingerprint(st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def isRacy(st, now):
+    """Whether a file was modified too recently to trust its fingerprint
+
+    :param st: an os.stat_result
+    :param now: integer, nanoseconds since the epoch, from before the stat
+    :returns: boolean
+    """
+    return now - st.st_mtime_ns < RACY_WINDOW
+
+
+def scan(location):
+    """Stat all files in a directory, ignoring temporary (.new) files
+
+    :param location: string, the directory to scan
+    :returns: dict mapping names to os.stat_result
+    """
+    ret = {}
+    with os.scandir(location) as entries:
+        for entry in entries:
+            if entry.name.endswith(".new"):
+                continue
+            try:
+                ret[entry.name] = entry.stat()
+            except FileNotFoundError:
+                continue
+    return ret
+
+
+_Entry = collections.namedtuple("_Entry", "fingerprint digest racy")
+
+
+def checker(location, receiver, confirm=True, stats=None):
     """Construct a function that checks a directory for process configuration
 
     The function checks for additions or removals
     of JSON process configuration files and calls the appropriate receiver
     methods.
 
+    Files are only read when their stat fingerprint changes (or when
+    they were modified too recently for the fingerprint to be trusted),
+    and only a hash of the contents is kept.
+
+    Changed files are reported with the receiver's update method if it
+    provides IMonitorEventUpdater, and with remove and then add
+    otherwise.
+
+    The function can also be given an iterable of names that are known
+    to have changed, in which case only those are examined.
+
     :param location: string, the directory to monitor
     :param receiver: IEventReceiver
-    :returns: a function with no parameters
+    :param confirm: boolean, whether to compare contents before reporting
+                    a file with a changed fingerprint as changed
+    :param stats: ncolony.instrument.Stats to record the time spent listing,
+                  reading and dispatching in, or None
+    :returns: a function with one optional parameter (names)
     """
     path = filepath.FilePath(location)
-    files = set()
-    filesContents = {}
-
-    def _check(path):
-        currentFiles = set(
-            fname for fname in os.listdir(location) if not fname.endswith(".new")
-        )
-        removed = files - currentFiles
-        added = currentFiles - files
-        for fname in added:
-            contents = path.child(fname).getContent()
-            filesContents[fname] = contents
+    stats = instrument.ensure(stats)
+    entries = {}
+    # pylint: disable=no-value-for-parameter
+    canUpdate = interfaces.IMonitorEventUpdater.providedBy(receiver)
+    # pylint: enable=no-value-for-parameter
+    if canUpdate:
+        update = receiver.update
+    else:
+
+        def update(fname, contents):
+            receiver.remove(fname)
             receiver.add(fname, contents)
+
+    def _read(fname, st, now):
+        with stats.timing("read"):
+            contents = path.child(fname).getContent()
+        digest = hashlib.sha256(contents).digest()
+        return contents, _Entry(fingerprint(st), digest, isRacy(st, now))
+
+    def _current(names):
+        if names is None:
+            current = scan(location)
+            return current, set(current) | set(entries)
+        names = set(fname for fname in names if not fname.endswith(".new"))
+        current = {}
+        for fname in names:
+            try:
+                current[fname] = os.stat(path.child(fname).path)
+            except FileNotFoundError:
+                continue
+        return current, names
+
+    def _check(path, names=None):
+        now = time.time_ns()
+        with stats.timing("listdir"):
+            current, names = _current(names)
+        removed = (names - set(current)) & set(entries)
+        added = set(current) - set(entries)
+        same = set(current) & set(entries)
+        for fname in added:
+            contents, entries[fname] = _read(fname, current[fname], now)
+            with stats.timing("dispatch"):
+                receiver.add(fname, contents)
         for fname in removed:
-            receiver.remove(fname)
-        same = currentFiles & files
+            del entries[fname]
+            with stats.timing("dispatch"):
+                receiver.remove(fname)
         for fname in same:
-            newContents = path.child(fname).getContent()
-            oldContents = filesContents[fname]
-            if newContents == oldContents:
+            old = entries[fname]
+            st = current[fname]
+            if old.fingerprint == fingerprint(st) and not old.racy:
                 continue
-            receiver.remove(fname)
-            filesContents[fname] = newContents
-            receiver.add(fname, newContents)
-        files.clear()
-        files.update(currentFiles)
+            contents, new = _read(fname, st, now)
+            entries[fname] = new
+            if new.digest == old.digest:
+                if confirm or new.fingerprint == old.fingerprint:
+                    continue
+            with stats.timing("dispatch"):
+                update(fname, contents)
 
     return functools.partial(_check, path)
 
 
-def messages(location, receiver):
+CLAIMED = ".claimed"
+
+
+def _messageOrder(item):
+    name, st = item
+    sequence = re.match(r"[0-9]*", name).group()
+    return st.st_mtime_ns, int(sequence or 0), name
+
+
+def messages(location, receiver, stats=None):
     """Construct a function that checks a directory for messages
 
     The function checks for new messages and
     calls the appropriate method on the receiver. Sent messages are
     deleted.
 
+    Messages are first claimed, by atomically moving them into the
+    :code:`.claimed` subdirectory, and then processed in the order they
+    were written (ties broken by the sequence number at the start of the
+    name). Each claimed message is deleted before it is sent, so a crash
+    never sends a message twice, and messages claimed but not sent
+    before a crash are sent on the next check. Identical messages
+    claimed together are only sent once.
+
+    The function accepts the names known to have changed, for
+    compatibility with the checker, but always consumes all messages.
+
     :param location: string, the directory to monitor
     :param receiver: IEventReceiver
-    :returns: a function with no parameters
+    :param stats: ncolony.instrument.Stats to record the time spent listing,
+                  reading and dispatching in, or None
+    :returns: a function with one optional parameter (names)
     """
     path = filepath.FilePath(location)
+    stats = instrument.ensure(stats)
 
-    def _check(path):
-        messageFiles = path.globChildren("*")
-        for message in messageFiles:
-            if message.basename().endswith(".new"):
+    def _claim(path, claimed):
+        for name in scan(path.path):
+            if name.startswith("."):
+                continue
+            try:
+                os.rename(path.child(name).path, claimed.child(name).path)
+            except FileNotFoundError:
                 continue
-            receiver.message(message.getContent())
-            message.remove()
+        return sorted(scan(claimed.path).items(), key=_messageOrder)
+
+    def _check(path, names=None):
+        claimed = path.child(CLAIMED)
+        if not claimed.isdir():
+            claimed.makedirs(ignoreExistingDirectory=True)
+        with stats.timing("listdir"):
+            pending = _claim(path, claimed)
+        sent = set()
+        duplicates = 0
+        for name, _ in pending:
+            message = claimed.child(name)
+            with stats.timing("read"):
+                content = message.getContent()
+                message.remove()
+            if content in sent:
+                duplicates += 1
+                continue
+            sent.add(content)
+            try:
+                with stats.timing("dispatch"):
+                    receiver.message(content)
+            except (ValueError, KeyError):
+                log.err(None, "Could not process message " + name)
+        if duplicates:
+            log.msg("Ignored duplicate messages: ", duplicates)
 
     return functools.partial(_check, path)
+
+
+# pylint: disable=too-many-instance-attributes
+
+
+class Watcher(service.Service):
+
+    """Call a check function when a directory changes
+
+    Uses inotify, where available, to notice changes in the directory,
+    and calls the check function with the names that changed. Bursts
+    of events are coalesced into one call. If inotify is not available,
+    nothing is watched, and the periodic check is relied upon.
+
+    :param location: string, the directory to watch
+    :param check: a function accepting a set of names, or None when
+                  the whole directory should be rescanned
+    :param reactor: IReactorTime and IReactorFDSet
+    :param mask: inotify event mask
+    :param notifierFactory: callable that takes a reactor and returns
+                            an inotify.INotify-like object, or None
+                            if inotify is not supported
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, location, check, reactor, mask=CONFIG_MASK, notifierFactory=None
+    ):
+        if notifierFactory is None and inotify is not None:
+            notifierFactory = inotify.INotify
+        self.location = location
+        self.check = check
+        self.mask = mask
+        self.notifierFactory = notifierFactory
+        self.notifier = None
+        self._path = None
+        self._reactor = reactor
+        self._pending = set()
+        self._call = None
+
+    # pylint: enable=too-many-arguments
+
+    def startService(self):
+        """Start watching the directory"""
+        service.Service.startService(self)
+        if self.notifierFactory is None:
+            log.msg("inotify not available, polling only: ", self.location)
+            return
+        path = filepath.FilePath(self.location)
+        try:
+            notifier = self.notifierFactory(self._reactor)
+            notifier.startReading()
+            notifier.watch(path, mask=self.mask, callbacks=[self._changed])
+        except inotify.INotifyError as e:
+            log.msg("inotify failed, polling only: ", self.location, e)
+            return
+        self._path = path.asBytesMode()
+        self.notifier = notifier
+
+    def stopService(self):
+        """Stop watching the directory"""
+        service.Service.stopService(self)
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+
+    def _changed(self, dummyWatch, path, mask):
+        if path == self._path:
+            self._pending = None
+        else:
+            name = os.fsdecode(path.basename())
+            if name.endswith(".new"):
+                return
+            if self._pending is not None:
+                self._pending.add(name)
+        if self._call is None:
+            self._call = self._reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        self._call = None
+        names, self._pending = self._pending, set()
+        self.check(names)
+
+
+# pylint: enable=too-many-instance-attributes
@@ -1,21 +1,63 @@
 # Copyright (c) Moshe Zadka
 # See LICENSE for details.
 
-"""Check HTTP server for responsiveness"""
+"""Check HTTP server for responsiveness
+
+Each process is checked on its own timer, every period. The
+configuration directory is looked at every :code:`--freq` seconds,
+but a configuration file is only read and parsed again when its
+size, modification time or inode changed.
+
+Checks can be limited to a number in flight at a time, in total
+(:code:`--max-in-flight`) and to each host (:code:`--per-host`).
+A check waiting for its turn does not count towards its timeout.
+The first check of each process can be spread over part of its
+period (:code:`--jitter`), so checks of processes configured
+together do not all happen at the same time.
+
+Processes that are not HTTP servers can be checked instead with
+:code:`"ncolony.tcpcheck"` (with :code:`host` and :code:`port`,
+succeeding when a connection is made), :code:`"ncolony.unixcheck"`
+(with the :code:`path` of a Unix socket) or :code:`"ncolony.execcheck"`
+(with :code:`args`, a command that should exit successfully, and is
+killed when it takes longer than the timeout). They take the same
+:code:`period`, :code:`grace`, :code:`maxBad`, :code:`timeout` and
+:code:`latency` as HTTP checks, and are limited the same way
+(Unix socket and command checks all count as one host).
+
+Each HTTP check is a GET (or, with :code:`"method": "HEAD"`, a HEAD).
+The body of the response is read, and thrown away, as it arrives,
+up to :code:`maxBody` bytes, after which the connection is closed.
+With :code:`"status": [CODE, ...]`, only those status codes are
+successful checks.
+
+A process is restarted when more than :code:`maxBad` checks in a row
+failed. It can also be restarted when it gets slow: with
+:code:`"latency": {"threshold": SECONDS}` in its configuration, the
+latency of the last :code:`samples` successful checks is kept, and
+when their :code:`percentile` is above the threshold the process is
+restarted, or, with :code:`"action": "log"`, only logged about.
+[defaults: percentile 0.99, samples 100, action restart]
+With :code:`--stats`, each process's latency is also written
+to the stats file, as :code:`httpcheck.latency.NAME`.
+"""
 
 import collections
 import functools
 import json
 import sys
+import urllib.parse
+import zlib
 
 import twisted
 
 from twisted.application import internet as tainternet
-from twisted.internet import defer, reactor
-from twisted.web import client
+from twisted.internet import defer, endpoints, error, protocol, reactor
+from twisted.python import log, usage
+from twisted.web import client, http
 
 import ncolony
-from ncolony import beatcheck
+from ncolony import beatcheck, instrument, scanner as scannerlib
 from ncolony.client import heart
 
 
@@ -45,7 +87,141 @@ class _ScoreCard:
         )
 
 
-Settings = collections.namedtuple("Settings", "reactor agent")
+class UnexpectedStatus(Exception):
+
+    """The response had a status code that was not expected"""
+
+
+class _Discard(protocol.Protocol):
+    def __init__(self, limit=None):
+        self.finished = defer.Deferred(self._cancel)
+        self.limit = limit
+        self.length = 0
+        self.stopped = False
+
+    def _cancel(self, finished):
+        finished.errback(defer.CancelledError())
+        self.stop()
+
+    def dataReceived(self, data):
+        """Count, and drop, part of the body"""
+        if self.stopped:
+            return
+        self.length += len(data)
+        if self.limit is not None and self.length > self.limit:
+            self.stop()
+
+    def stop(self):
+        """Stop reading the body"""
+        self.stopped = True
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        """The body was read, or reading it stopped"""
+        if self.finished.called:
+            return
+        if self.stopped or reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(self.length)
+        else:
+            self.finished.errback(reason)
+
+
+def discardBody(response, limit=None):
+    """Read the body of a response, and throw it away
+
+    Once more than limit bytes were read, reading stops
+    (and the connection is closed rather than reused).
+
+    :params response: twisted.web.iweb.IResponse
+    :params limit: integer, or None to read the whole body
+    :returns: Deferred that fires with the number of bytes read
+    """
+    consumer = _Discard(limit)
+    response.deliverBody(consumer)
+    return consumer.finished
+
+
+class _Latency:
+    def __init__(self, threshold=None, percentile=0.99, samples=100, action="restart"):
+        self.threshold = threshold
+        self.percentile = percentile
+        self.samples = samples
+        self.action = action
+        self.recent = instrument.RecentDurations(samples)
+        self.slow = False
+
+    def add(self, value):
+        """Note how long a successful check took
+
+        :returns: whether the check became, or stopped being, too slow
+        """
+        self.recent.add(value)
+        if self.threshold is None or self.recent.count < self.samples:
+            return False
+        slow = self.recent.percentile(self.percentile) > self.threshold
+        changed = slow != self.slow
+        self.slow = slow
+        return changed
+
+    def isBad(self):
+        """Too slow, and should be restarted"""
+        return self.slow and self.action == "restart"
+
+
+Settings = collections.namedtuple(
+    "Settings",
+    "reactor agent limiter jitter restarter stats",
+    defaults=(None, 0, None, None),
+)
+
+# pylint: disable=too-few-public-methods
+
+
+class Limiter:
+
+    """Limit how many checks are in flight
+
+    Checks wait for a free slot for their host first,
+    and only then for a free slot in total.
+
+    :param total: integer, the most checks in flight, or 0 for no limit
+    :param perHost: integer, the most checks in flight to one host,
+                    or 0 for no limit
+    """
+
+    def __init__(self, total=0, perHost=0):
+        self.total = defer.DeferredSemaphore(total) if total else None
+        self.perHost = perHost
+        self.hosts = {}
+
+    def run(self, url, func, *args):
+        """Run a check when there is a free slot
+
+        :param url: string, the URL being checked
+        :param func: function returning a Deferred
+        :param args: arguments to func
+        :returns: Deferred that fires with the result of func
+        """
+        call = functools.partial(func, *args)
+        if self.total is not None:
+            call = functools.partial(self.total.run, call)
+        if not self.perHost:
+            return defer.maybeDeferred(call)
+        host = urllib.parse.urlsplit(url).netloc
+        semaphore = self.hosts.get(host)
+        if semaphore is None:
+            semaphore = self.hosts[host] = defer.DeferredSemaphore(self.perHost)
+        d = semaphore.run(call)
+        d.addBoth(self._prune, host, semaphore)
+        return d
+
+    def _prune(self, result, host, semaphore):
+        if semaphore.tokens == semaphore.limit and not semaphore.waiting:
+            del self.hosts[host]
+        return result
+
+
+# pylint: enable=too-few-public-methods
 
 _USER_AGENT = (
     "NColony HTTP Check ("
@@ -56,22 +232,192 @@ _USER_AGENT = (
 
 _standardHeaders = client.Headers({"User-Agent": [_USER_AGENT]})
 
+# pylint: disable=too-few-public-methods
+
+
+class HTTPProbe:
+
+    """Check that an HTTP server answers
+
+    :params config: dict with 'url', and optionally 'method',
+                    'maxBody' and 'status'
+    """
+
+    def __init__(self, config):
+        self.url = config["url"]
+        self.method = config.get("method", "GET")
+        self.maxBody = config.get("maxBody")
+        status = config.get("status")
+        self.expected = None if status is None else frozenset(status)
+
+    def run(self, settings):
+        """Make a request, and read the response
+
+        :params settings: Settings
+        :returns: Deferred that fires when the response was read
+        """
+        d = settings.agent.request(
+            self.method.encode("ascii"),
+            self.url.encode("utf-8"),
+            _standardHeaders,
+            None,
+        )
+        d.addCallback(self._received)
+        return d
+
+    def _received(self, response):
+        d = discardBody(response, self.maxBody)
+
+        def _checkStatus(dummy):
+            if self.expected is not None and response.code not in self.expected:
+                raise UnexpectedStatus(self.url, response.code)
+            return response
+
+        d.addCallback(_checkStatus)
+        return d
+
+
+def _disconnect(proto):
+    proto.transport.loseConnection()
+
+
+class ConnectProbe:
+
+    """Check that a server accepts connections
+
+    :params url: string, what is checked
+    :params makeEndpoint: function of the reactor that returns
+                          an IStreamClientEndpoint
+    """
+
+    def __init__(self, url, makeEndpoint):
+        self.url = url
+        self.makeEndpoint = makeEndpoint
+
+    def run(self, settings):
+        """Connect, and disconnect right away
+
+        :params settings: Settings
+        :returns: Deferred that fires when connected
+        """
+        endpoint = self.makeEndpoint(settings.reactor)
+        d = endpoints.connectProtocol(endpoint, protocol.Protocol())
+        d.addCallback(_disconnect)
+        return d
+
+
+def tcpProbe(config):
+    """Check that a TCP server accepts connections
+
+    The host can be a name, an IPv4 address or an IPv6 address.
+
+    :params config: dict with 'host' and 'port'
+    :returns: ConnectProbe
+    """
+    host, port = config["host"], config["port"]
+    makeEndpoint = functools.partial(endpoints.HostnameEndpoint, host=host, port=port)
+    if ":" in host:
+        host = "[%s]" % host
+    return ConnectProbe("tcp://%s:%s" % (host, port), makeEndpoint)
+
+
+def unixProbe(config):
+    """Check that a server accepts connections on a Unix socket
+
+    :params config: dict with 'path'
+    :returns: ConnectProbe
+    """
+    path = config["path"]
+    makeEndpoint = functools.partial(endpoints.UNIXClientEndpoint, path=path)
+    return ConnectProbe("unix:" + path, makeEndpoint)
+
+
+class _ExecProtocol(protocol.ProcessProtocol):
+    def __init__(self):
+        self.finished = defer.Deferred(self._cancel)
+
+    def _cancel(self, finished):
+        finished.errback(defer.CancelledError())
+        try:
+            self.transport.signalProcess("KILL")
+        except error.ProcessExitedAlready:
+            pass
+
+    def connectionMade(self):
+        """Give the command no input"""
+        self.transport.closeStdin()
+
+    def processEnded(self, reason):
+        """The command ended, successfully or not"""
+        if self.finished.called:
+            return
+        if reason.check(error.ProcessDone):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+class ExecProbe:
+
+    """Check that a command succeeds
+
+    The command's output is thrown away. If it takes too long,
+    it is killed.
+
+    :params config: dict with 'args', the command and its arguments
+    """
+
+    def __init__(self, config):
+        self.args = config["args"]
+        self.url = "exec:" + self.args[0]
+
+    def run(self, settings):
+        """Run the command
+
+        :params settings: Settings
+        :returns: Deferred that fires when the command succeeded
+        """
+        proto = _ExecProtocol()
+        settings.reactor.spawnProcess(proto, self.args[0], self.args, env=None)
+        return proto.finished
+
+
+# pylint: enable=too-few-public-methods
+
+PROBES = {
+    "ncolony.httpcheck": HTTPProbe,
+    "ncolony.tcpcheck": tcpProbe,
+    "ncolony.unixcheck": unixProbe,
+    "ncolony.execcheck": ExecProbe,
+}
+
 # pylint: disable=too-many-instance-attributes
 
 
 class State:
 
-    """State of an HTTP check"""
+    """State of a check
 
-    KEY = "ncolony.httpcheck"
+    Each process is checked on its own timer, every period (after a
+    grace period), and restarted with the settings' restarter when
+    too many checks in a row were unsuccessful. The configuration
+    is only parsed again when it changed.
+
+    How a process is checked depends on the first key of PROBES
+    in its configuration.
+    """
 
     def __init__(self, location, settings):
         self.location = location
         self.settings = settings
         self.closed = False
         self.content = None
+        self.fingerprint = None
         self.call = None
+        self.timer = None
         self.card = None
+        self.latency = None
+        self.probe = None
         self.url = None
         self.nextCheck = None
         self.period = None
@@ -95,126 +441,261 @@ class State:
             )
         )
 
-    def _reset(self):
-        self.content = None
-        self._maybeReset()
+    def _cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
 
     def close(self):
         """Discard data and cancel all calls.
 
+        The process's latency histogram is dropped from the stats.
         Instance cannot be reused after closing.
         """
         if self.closed:
             raise ValueError("Cannot close a closed state")
-        if self.call is not None:
-            self.call.cancel()
+        self._cancel()
+        name = self.location.basename()
+        instrument.ensure(self.settings.stats).forget("latency." + name)
         self.closed = True
 
-    def check(self):
-        """Check the state of HTTP"""
+    def apply(self, snapshot):
+        """Use the configuration, if it changed
+
+        :params snapshot: a ncolony.scanner.Snapshot of the configuration
+        :returns: whether the configuration changed
+        """
         if self.closed:
             raise ValueError("Cannot check a closed state")
-        self._maybeReset()
-        if self.url is None:
+        self.fingerprint = snapshot.fingerprint
+        if snapshot.content is None:
             return False
-        return self._maybeCheck()
-
-    def _maybeReset(self):
-        content = self.location.getContent().decode("utf-8")
+        content = snapshot.content.decode("utf-8")
         if content == self.content:
-            return
+            return False
         self.content = content
-        if self.call is not None:
-            self.call.cancel()
-            self.call = None
+        self._configure()
+        return True
+
+    def _configure(self):
+        self._cancel()
         parsed = json.loads(self.content)
-        config = parsed.get(self.KEY)
-        if config is None:
-            self.url = None
+        for key, kind in PROBES.items():
+            config = parsed.get(key)
+            if config is not None:
+                break
+        else:
+            self.probe = self.url = None
             self.card = _ScoreCard()
             return
-        self.url = config["url"]
+        self.probe = kind(config)
+        self.url = self.probe.url
         self.period = config["period"]
         self.card = _ScoreCard(config["maxBad"])
+        latency = config.get("latency", {})
+        self.latency = _Latency(
+            threshold=latency.get("threshold"),
+            percentile=latency.get("percentile", 0.99),
+            samples=latency.get("samples", 100),
+            action=latency.get("action", "restart"),
+        )
         self.timeout = min(self.period, config["timeout"])
         self.nextCheck = self.settings.reactor.seconds() + config["grace"] * self.period
+        spread = zlib.crc32(self.location.basename().encode("utf-8")) / 2**32
+        self.nextCheck += self.settings.jitter * self.period * spread
+        self._schedule()
+
+    def _schedule(self):
+        delay = max(self.nextCheck - self.settings.reactor.seconds(), 0)
+        self.timer = self.settings.reactor.callLater(delay, self._fire)
+
+    def _fire(self):
+        self.timer = None
+        if self.card.isBad() or self.latency.isBad():
+            self._configure()
+            if self.settings.restarter is not None:
+                self.settings.restarter(self.location.basename())
+            return
+        self.nextCheck += self.period
+        self._schedule()
+        if self.call is not None:
+            # Still waiting for a free slot
+            return
+        if self.settings.limiter is None:
+            self.call = self._request()
+        else:
+            self.call = self.settings.limiter.run(self.url, self._request)
+        self.call.addErrback(defer.logError)
+        self.call.addCallbacks(callback=self.card.markGood, errback=self.card.markBad)
 
-    def _maybeCheck(self):
-        if self.settings.reactor.seconds() <= self.nextCheck:
-            return False
-        assert self.call is None, "Timeout reached, call still outstanding"
-        if self.card.isBad():
-            self._reset()
-            return True
-        self.nextCheck = self.settings.reactor.seconds() + self.period
-        self.call = self.settings.agent.request("GET", self.url, _standardHeaders, None)
-        delayedCall = self.settings.reactor.callLater(self.timeout, self.call.cancel)
+        def _removeCall(dummy):
+            self.call = None
+
+        self.call.addCallback(_removeCall)
+
+    def _request(self):
+        start = self.settings.reactor.seconds()
+        call = self.probe.run(self.settings)
+        delayedCall = self.settings.reactor.callLater(self.timeout, call.cancel)
 
         def _gotResult(result):
             if delayedCall.active():
                 delayedCall.cancel()
             return result
 
-        self.call.addBoth(_gotResult)
-        self.call.addErrback(defer.logError)
-        self.call.addCallbacks(callback=self.card.markGood, errback=self.card.markBad)
+        call.addBoth(_gotResult)
+        call.addCallback(self._measured, start)
+        return call
 
-        def _removeCall(dummy):
-            self.call = None
-
-        self.call.addCallback(_removeCall)
-        return False
+    def _measured(self, result, start):
+        name = self.location.basename()
+        latency = self.settings.reactor.seconds() - start
+        instrument.ensure(self.settings.stats).record("latency." + name, latency)
+        if self.latency.add(latency):
+            percentile = self.latency.recent.percentile(self.latency.percentile)
+            if self.latency.slow:
+                log.msg("Too slow: ", name, percentile)
+            else:
+                log.msg("Fast enough again: ", name, percentile)
+        return result
 
 
 # pylint: enable=too-many-instance-attributes
 
 
-def check(settings, states, location):
-    """Check all processes"""
-    children = {child.basename(): child for child in location.children()}
-    last = set(states)
-    current = set(children)
-    gone = last - current
-    added = current - last
-    for name in gone:
-        states[name].close()
-        del states[name]
-    for name in added:
-        states[name] = State(location=children[name], settings=settings)
-    return [name for name, state in states.items() if state.check()]
-
-
-def run(restarter, checker):
-    """Run restarter on the checker's output
-
-    :params restarter: something to run on the output of the checker
-    :params checker: a function expected to get one argument (current time)
-                     and return a list of stale names
-    :params timer: a function of zero arguments, intended to return current
-                   time
-    :returns: None
+def check(settings, states, location, snapshots=None):
+    """Find added, changed and removed processes
+
+    :params snapshots: dict mapping names to ncolony.scanner.Snapshot,
+                       already read from location, or None to read them
+    :returns: list of names of processes whose configuration changed
     """
-    for bad in checker():
-        restarter(bad)
+    if snapshots is None:
+        known = {name: state.fingerprint for name, state in states.items()}
+        snapshots = scannerlib.readDirectory(location.path, known)
+    for name in set(states) - set(snapshots):
+        states.pop(name).close()
+    changed = []
+    for name, snapshot in snapshots.items():
+        state = states.get(name)
+        if state is None:
+            state = states[name] = State(
+                location=location.child(name), settings=settings
+            )
+        if state.apply(snapshot):
+            changed.append(name)
+    return changed
+
+
+def scanCheck(scanner, settings, states, location):
+    """Find added, changed and removed processes, reading with a scanner
+
+    Only configurations whose fingerprint changed are read.
+
+    :params scanner: a ncolony.scanner.Scanner
+    :returns: Deferred that fires with a list of names of processes
+              whose configuration changed
+    """
+    known = {name: state.fingerprint for name, state in states.items()}
+    d = scanner.read(location.path, known)
+    d.addCallback(functools.partial(check, settings, states, location))
+    d.addErrback(_skipped, location.path)
+    return d
+
+
+def _skipped(reason, what):
+    scannerlib.skipped(reason, what)
+    return []
+
+
+class Checker(tainternet.TimerService):
+
+    """Look for configuration changes every step
+
+    Processes are checked on their own timers, which are cancelled
+    when the service stops.
+
+    :params step: number, seconds between looking for changes
+    :params checker: function of no arguments that looks for changes
+    :params states: dict mapping names to State, updated by the checker
+    """
+
+    def __init__(self, step, checker, states):
+        tainternet.TimerService.__init__(self, step, checker)
+        self.states = states
+
+    def stopService(self):
+        """Stop looking for changes, and stop checking processes"""
+        for state in self.states.values():
+            state.close()
+        self.states.clear()
+        return tainternet.TimerService.stopService(self)
 
 
 def makeService(opt):
     """Make a service
 
-    :params opt: dictionary-like object with 'freq', 'config' and 'messages'
-    :returns: twisted.application.internet.TimerService that at opt['freq']
-              checks for stale processes in opt['config'], and sends
-              restart messages through opt['messages']
+    :params opt: dictionary-like object with 'freq', 'config' and 'messages',
+                 and optionally 'scan-threads', 'scan-timeout', 'stats',
+                 'max-in-flight', 'per-host', 'persistent-per-host',
+                 'idle-timeout' and 'jitter'
+    :returns: service that at opt['freq'] looks for changes in
+              opt['config'], checks each process on its own timer,
+              and sends restart messages through opt['messages']
     """
     restarter, path = beatcheck.parseConfig(opt)
     pool = client.HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = opt.get("persistent-per-host", 2)
+    pool.cachedConnectionTimeout = opt.get("idle-timeout", 240)
     agent = client.Agent(reactor=reactor, pool=pool)
-    settings = Settings(reactor=reactor, agent=agent)
+    limiter = Limiter(total=opt.get("max-in-flight", 0), perHost=opt.get("per-host", 0))
+    stats = instrument.maybeStats(opt.get("stats"))
+    timings = instrument.ensure(stats).scoped("httpcheck")
+    settings = Settings(
+        reactor=reactor,
+        agent=agent,
+        limiter=limiter,
+        jitter=opt.get("jitter", 0),
+        restarter=restarter,
+        stats=timings,
+    )
     states = {}
-    checker = functools.partial(check, settings, states, path)
-    httpcheck = tainternet.TimerService(opt["freq"], run, restarter, checker)
+    scanner = beatcheck.makeScanner(opt)
+    checker = functools.partial(scanCheck, scanner, settings, states, path)
+    httpcheck = Checker(opt["freq"], timings.timed("tick", checker), states)
     httpcheck.setName("httpcheck")
-    return heart.wrapHeart(httpcheck)
+    ret = heart.wrapHeart(httpcheck)
+    scanner.setServiceParent(ret)
+    instrument.maybeAddService(ret, stats, opt.get("stats"), reactor)
+    return ret
+
+
+# pylint: disable=too-few-public-methods
+
+
+class Options(beatcheck.Options):
+
+    """Options for ncolony httpcheck service"""
+
+    optParameters = [
+        ["max-in-flight", None, 0, "Most checks in flight (0: no limit)", int],
+        ["per-host", None, 0, "Most checks in flight to a host (0: no limit)", int],
+        ["persistent-per-host", None, 2, "Most idle connections to a host", int],
+        ["idle-timeout", None, 240, "Seconds to keep idle connections", float],
+        ["jitter", None, 0, "Part of the period to spread first checks over", float],
+    ]
+
+    def postOptions(self):
+        """Checks that required directories are present, and jitter makes sense"""
+        beatcheck.Options.postOptions(self)
+        for param in ("status-table", "socket"):
+            if self[param] is not None:
+                raise usage.UsageError("Not supported by httpcheck", param)
+        if not 0 <= self["jitter"] <= 1:
+            raise usage.UsageError("Jitter must be between 0 and 1", self["jitter"])
 
 
-Options = beatcheck.Options
+# pylint: enable=too-few-public-methods
@@ -0,0 +1,389 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.instrument
+====================
+
+Measure how well the event loop keeps up.
+
+Stats keeps histograms of durations: how long each periodic check
+(tick) takes, how long the phases inside it (listing directories,
+reading files, parsing them and acting on them) take, and how late
+the reactor runs timed calls (reactor lag).
+
+Every service takes a :code:`--stats FILE` option. With it, the
+reactor lag is measured every second, and all histograms are written,
+as JSON, to FILE every ten seconds and when the service stops.
+The file is replaced atomically, so it can be read at any time.
+
+Each histogram has a count, a sum and a maximum (in seconds),
+estimates of the median, 95th and 99th percentiles (:code:`p50`,
+:code:`p95` and :code:`p99`, the upper bound of the bucket they fall in),
+and the counts of durations no longer than each bucket bound
+(:code:`"+Inf"` counts all of them).
+"""
+
+import bisect
+import collections
+import contextlib
+import json
+import math
+import os
+import time
+
+from twisted.application import internet as tainternet, service
+from twisted.internet import defer
+
+BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+
+    """Counts of durations, in buckets
+
+    :param bounds: sorted sequence of numbers, the upper bounds of the
+                   buckets (a last bucket holds anything larger)
+    """
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        """Add a duration
+
+        :param value: number, seconds
+        :returns: None
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Estimate a percentile
+
+        The estimate is the upper bound of the bucket the percentile
+        falls in (or the maximum, for the last bucket), so it is never
+        lower than the real value.
+
+        :param fraction: number between 0 and 1, for example 0.99 for p99
+        :returns: number, seconds (0 if the histogram is empty)
+        """
+        rank = math.ceil(fraction * self.count)
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def asDict(self):
+        """Summarize the histogram
+
+        :returns: dict with count, sum, max, p50, p95, p99
+                  and (cumulative) buckets
+        """
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets[repr(bound)] = total
+        buckets["+Inf"] = self.count
+        ret = dict(count=self.count, sum=self.sum, max=self.max, buckets=buckets)
+        for fraction in PERCENTILES:
+            ret["p%d" % round(fraction * 100)] = self.percentile(fraction)
+        return ret
+
+
+class RecentDurations:
+
+    """The most recent durations, kept exactly
+
+    Only the last size durations are remembered, so memory does not
+    grow, and old durations are forgotten. Unlike a Histogram's,
+    percentiles are not estimated: they are always one of the
+    remembered durations.
+
+    :param size: integer, how many durations are remembered
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = collections.deque(maxlen=size)
+
+    @property
+    def count(self):
+        """How many durations are remembered"""
+        return len(self.values)
+
+    def add(self, value):
+        """Add a duration
+
+        :param value: number, seconds
+        :returns: None
+        """
+        self.values.append(value)
+
+    def percentile(self, fraction):
+        """Find a percentile of the remembered durations
+
+        :param fraction: number between 0 and 1
+        :returns: number, seconds (0 if none are remembered)
+        """
+        if not self.values:
+            return 0
+        rank = max(math.ceil(fraction * len(self.values)), 1)
+        return sorted(self.values)[rank - 1]
+
+
+class Stats:
+
+    """A collection of named histograms
+
+    :param clock: function returning the current time in seconds
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.histograms = {}
+
+    def record(self, name, value):
+        """Add a duration to a histogram
+
+        :param name: string, name of histogram
+        :param value: number, seconds
+        :returns: None
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(value)
+
+    def forget(self, name):
+        """Remove a histogram, if there is one
+
+        :param name: string, name of histogram
+        :returns: None
+        """
+        self.histograms.pop(name, None)
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        """Record how long a block of code takes
+
+        :param name: string, name of histogram
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def timed(self, name, func):
+        """Wrap a function to record how long it takes
+
+        If the function returns a Deferred, the time until it fires
+        is recorded.
+
+        :param name: string, name of histogram
+        :param func: function
+        :returns: function with the same arguments and result as func
+        """
+
+        def _timed(*args, **kwargs):
+            start = self.clock()
+
+            def _done(result):
+                self.record(name, self.clock() - start)
+                return result
+
+            try:
+                ret = func(*args, **kwargs)
+            except BaseException:
+                _done(None)
+                raise
+            if isinstance(ret, defer.Deferred):
+                return ret.addBoth(_done)
+            return _done(ret)
+
+        return _timed
+
+    def scoped(self, prefix):
+        """A view of the stats that prefixes histogram names
+
+        :param prefix: string
+        :returns: Stats-like object
+        """
+        return _Scoped(self, prefix + ".")
+
+    def snapshot(self):
+        """Summarize all histograms
+
+        :returns: dict mapping names to histogram summaries
+        """
+        return {name: value.asDict() for name, value in self.histograms.items()}
+
+
+class _Scoped:
+    def __init__(self, stats, prefix):
+        self.stats = stats
+        self.prefix = prefix
+
+    def record(self, name, value):
+        """Add a duration to a prefixed histogram"""
+        self.stats.record(self.prefix + name, value)
+
+    def forget(self, name):
+        """Remove a prefixed histogram"""
+        self.stats.forget(self.prefix + name)
+
+    def timing(self, name):
+        """Record how long a block of code takes in a prefixed histogram"""
+        return self.stats.timing(self.prefix + name)
+
+    def timed(self, name, func):
+        """Wrap a function to record how long it takes in a prefixed histogram"""
+        return self.stats.timed(self.prefix + name, func)
+
+    def scoped(self, prefix):
+        """A view of the stats that prefixes histogram names some more"""
+        return _Scoped(self.stats, self.prefix + prefix + ".")
+
+
+class NullStats:
+
+    """Stats that are not kept"""
+
+    def record(self, name, value):
+        """Do nothing"""
+
+    def forget(self, name):
+        """Do nothing"""
+
+    def timing(self, name):
+        """Time nothing"""
+        del name
+        return contextlib.nullcontext()
+
+    def timed(self, name, func):
+        """Return the function as it is"""
+        del name
+        return func
+
+    def scoped(self, prefix):
+        """Return the same, empty, stats"""
+        del prefix
+        return self
+
+
+NULL = NullStats()
+
+
+def ensure(stats):
+    """Return the stats, or stats that are not kept if there are none
+
+    :param stats: Stats, or None
+    :returns: Stats-like object
+    """
+    if stats is None:
+        return NULL
+    return stats
+
+
+class LagMonitor(service.Service):
+
+    """Measure how late the reactor runs timed calls
+
+    :param reactor: IReactorTime
+    :param stats: Stats
+    :param interval: number, seconds between measurements
+    """
+
+    def __init__(self, reactor, stats, interval=1):
+        self.reactor = reactor
+        self.stats = stats
+        self.interval = interval
+        self._due = None
+        self._call = None
+
+    def startService(self):
+        """Start measuring"""
+        service.Service.startService(self)
+        self._schedule()
+
+    def stopService(self):
+        """Stop measuring"""
+        service.Service.stopService(self)
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _schedule(self):
+        self._due = self.reactor.seconds() + self.interval
+        self._call = self.reactor.callLater(self.interval, self._measure)
+
+    def _measure(self):
+        self.stats.record("reactor.lag", max(self.reactor.seconds() - self._due, 0))
+        self._schedule()
+
+
+def write(stats, path):
+    """Write a snapshot of the stats to a file, atomically
+
+    :param stats: Stats
+    :param path: string, the file to write
+    :returns: None
+    """
+    temp = path + ".new"
+    with open(temp, "w") as fp:
+        json.dump(stats.snapshot(), fp, sort_keys=True)
+    os.rename(temp, path)
+
+
+class _StatsFile(tainternet.TimerService):
+    def __init__(self, interval, stats, path):
+        tainternet.TimerService.__init__(self, interval, write, stats, path)
+        self.stats = stats
+        self.path = path
+
+    def stopService(self):
+        ret = tainternet.TimerService.stopService(self)
+        write(self.stats, self.path)
+        return ret
+
+
+def maybeStats(path):
+    """Make stats to record in, if they are to be written somewhere
+
+    :param path: string, the file to write stats to, or None
+    :returns: Stats, or None
+    """
+    if path is None:
+        return None
+    return Stats()
+
+
+def maybeAddService(master, stats, path, reactor, interval=10):
+    """Add measuring reactor lag, and writing stats, to a service collection
+
+    Nothing is added if there are no stats.
+
+    :param master: a service.IServiceCollection
+    :param stats: Stats, or None
+    :param path: string, the file to write stats to
+    :param reactor: IReactorTime
+    :param interval: number, seconds between writes
+    :returns: None
+    """
+    if stats is None:
+        return
+    lag = LagMonitor(reactor, stats)
+    lag.setName("lag")
+    lag.setServiceParent(master)
+    statsFile = _StatsFile(interval, stats, path)
+    statsFile.setName("stats")
+    statsFile.setServiceParent(master)
@@ -29,11 +29,21 @@ Interface definitions
 
       :params contents: string, message contents
       :returns: None
+
+.. py:class:: IMonitorEventUpdater
+
+   .. py:method:: update
+
+      File changed
+
+      :params name: string, file name
+      :params contents: string, new file contents
+      :returns: None
 """
 
 from zope import interface
 
-__all__ = ["IMonitorEventReceiver"]
+__all__ = ["IMonitorEventReceiver", "IMonitorEventUpdater"]
 
 # pylint: disable=no-self-argument
 
@@ -50,3 +60,15 @@ class IMonitorEventReceiver(interface.Interface):
 
     def message(contents):
         """New message"""
+
+
+class IMonitorEventUpdater(interface.Interface):
+
+    """Event sink that handles changed files itself
+
+    Receivers that do not provide this get a remove and an add
+    when a file changes.
+    """
+
+    def update(name, contents):
+        """File changed"""
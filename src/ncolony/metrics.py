@@ -0,0 +1,197 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.metrics
+=================
+
+Serve the supervisor's metrics, in the Prometheus text format.
+
+With :code:`--metrics ENDPOINT` (a Twisted endpoint description,
+such as :code:`tcp:9100:interface=127.0.0.1` or
+:code:`unix:/run/ncolony/metrics`), the supervisor serves, on any path:
+
+* :code:`ncolony_processes` and :code:`ncolony_processes_running`,
+  how many processes are monitored, and how many are running.
+* :code:`ncolony_process_restarts_total`, by :code:`name`,
+  and :code:`ncolony_group_restarts_total`, by :code:`group`,
+  how many times processes were started again
+  (after a restart, or after they ended on their own).
+* :code:`ncolony_restarts_requested_total`,
+  :code:`ncolony_restarts_performed_total` and
+  :code:`ncolony_restarts_suppressed_total`,
+  restart requests received from messages, and what came of them.
+* :code:`ncolony_spawn_latency_seconds`, a histogram of the time
+  from a process ending to it running again.
+* :code:`ncolony_message_queue_depth`, how many messages are
+  waiting to be handled.
+* A histogram for each timing kept by :code:`ncolony.instrument`,
+  for example :code:`ncolony_config_tick_seconds` (how long scanning
+  the configuration takes) and :code:`ncolony_messages_dispatch_seconds`
+  (how long handling a message takes).
+"""
+
+import collections
+import os
+
+from twisted.application import strports
+from twisted.web import resource, server
+
+from ncolony import directory_monitor, instrument
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsPublisher:
+
+    """Count process starts, and how long processes take to run again
+
+    This is a publisher for :code:`ncolony.service.PublishingDict`.
+
+    :param reactor: IReactorTime
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.starts = collections.Counter()
+        self.spawnLatency = instrument.Histogram()
+        self._ended = {}
+
+    def set(self, name, value):
+        """A process started"""
+        del value
+        self.starts[name] += 1
+        ended = self._ended.pop(name, None)
+        if ended is not None:
+            self.spawnLatency.add(self.reactor.seconds() - ended)
+
+    def delete(self, name):
+        """A process ended"""
+        self._ended[name] = self.reactor.seconds()
+
+
+def _escape(value):
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+def _metricName(name):
+    return "".join(char if char.isalnum() else "_" for char in name)
+
+
+def _scalar(lines, name, kind, value):
+    lines.append("# TYPE %s %s" % (name, kind))
+    lines.append("%s %s" % (name, value))
+
+
+def _labelled(lines, name, label, values):
+    lines.append("# TYPE %s counter" % name)
+    for key, value in sorted(values.items()):
+        lines.append('%s{%s="%s"} %s' % (name, label, _escape(key), value))
+
+
+def _histogram(lines, name, histogram):
+    summary = histogram.asDict()
+    lines.append("# TYPE %s histogram" % name)
+    for bound, count in summary["buckets"].items():
+        lines.append('%s_bucket{le="%s"} %s' % (name, bound, count))
+    lines.append("%s_sum %s" % (name, summary["sum"]))
+    lines.append("%s_count %s" % (name, summary["count"]))
+
+
+def queueDepth(messages):
+    """Count the messages waiting to be handled
+
+    :param messages: string, the messages directory
+    :returns: integer
+    """
+    ret = 0
+    for location in (messages, os.path.join(messages, directory_monitor.CLAIMED)):
+        try:
+            names = directory_monitor.scan(location)
+        except FileNotFoundError:
+            continue
+        ret += sum(1 for name in names if not name.startswith("."))
+    return ret
+
+
+# pylint: disable=too-few-public-methods,too-many-arguments
+class Metrics:
+
+    """Gather the supervisor's metrics
+
+    :param monitor: a ProcessMonitor
+    :param receiver: a ncolony.process_events.Receiver
+    :param publisher: a MetricsPublisher
+    :param stats: a ncolony.instrument.Stats
+    :param messages: string, the messages directory
+    """
+
+    def __init__(self, monitor, receiver, publisher, stats, messages):
+        self.monitor = monitor
+        self.receiver = receiver
+        self.publisher = publisher
+        self.stats = stats
+        self.messages = messages
+
+    def render(self):
+        """Render the metrics
+
+        :returns: string, in the Prometheus text format
+        """
+        lines = []
+        _scalar(lines, "ncolony_processes", "gauge", len(self.monitor.processes))
+        _scalar(
+            lines, "ncolony_processes_running", "gauge", len(self.monitor.protocols)
+        )
+        restarts = {
+            name: max(self.publisher.starts[name] - 1, 0)
+            for name in self.monitor.processes
+        }
+        _labelled(lines, "ncolony_process_restarts_total", "name", restarts)
+        groups = {
+            group: sum(restarts.get(name, 0) for name in names)
+            for group, names in self.receiver.groups().items()
+        }
+        _labelled(lines, "ncolony_group_restarts_total", "group", groups)
+        for kind in ("requested", "performed", "suppressed"):
+            name = "ncolony_restarts_%s_total" % kind
+            _scalar(lines, name, "counter", self.receiver.stats[kind])
+        _histogram(lines, "ncolony_spawn_latency_seconds", self.publisher.spawnLatency)
+        depth = queueDepth(self.messages)
+        _scalar(lines, "ncolony_message_queue_depth", "gauge", depth)
+        for name, histogram in sorted(self.stats.histograms.items()):
+            _histogram(lines, "ncolony_%s_seconds" % _metricName(name), histogram)
+        return "".join(line + "\n" for line in lines)
+
+
+# pylint: enable=too-few-public-methods,too-many-arguments
+
+
+class MetricsResource(resource.Resource):
+
+    """Serve metrics
+
+    :param metrics: a Metrics
+    """
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        """Render the metrics"""
+        request.setHeader(b"content-type", CONTENT_TYPE)
+        return self.metrics.render().encode("utf-8")
+
+
+def makeService(description, metrics):
+    """Make a service that serves metrics
+
+    :param description: string, a Twisted endpoint description
+    :param metrics: a Metrics
+    :returns: service, named "metrics"
+    """
+    ret = strports.service(description, server.Site(MetricsResource(metrics)))
+    ret.setName("metrics")
+    return ret
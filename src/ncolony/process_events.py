@@ -7,6 +7,7 @@ Convert events into process monitoring actions.
 """
 
 import collections
+import functools
 import json
 import os
 
@@ -18,33 +19,156 @@ from ncolony import interfaces
 
 VALID_KEYS = frozenset(["args", "uid", "gid", "env", "env_inherit", "group"])
 
+Rolling = collections.namedtuple("Rolling", "batch health timeout")
 
-@interface.implementer(interfaces.IMonitorEventReceiver)
+
+# pylint: disable=too-many-instance-attributes
+
+
+class RollingRestart:
+
+    """Restart processes a batch at a time
+
+    At most :code:`batch` processes are being restarted at any time.
+    A process stops being counted once it is ready again (or once
+    :code:`timeout` seconds have passed), and then the next process
+    is restarted.
+
+    :params reactor: IReactorTime
+    :params stop: a function that gets a name, stops the process,
+                  and returns a token to check readiness with, or None
+                  if there is nothing to wait for
+    :params isReady: a function that gets a name and a token and
+                     returns whether the process is ready
+    :params batch: integer, the most processes to restart at a time
+    :params timeout: seconds to wait for a process to be ready
+    :params interval: seconds between readiness checks
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, reactor, stop, isReady, batch, timeout=60, interval=1):
+        self.reactor = reactor
+        self.stop = stop
+        self.isReady = isReady
+        self.batch = max(batch, 1)
+        self.timeout = timeout
+        self.interval = interval
+        self.queue = collections.deque()
+        self.inFlight = {}
+        self._call = None
+
+    # pylint: enable=too-many-arguments
+
+    def done(self):
+        """Whether all processes were restarted
+
+        :returns: boolean
+        """
+        return not self.queue and not self.inFlight
+
+    def extend(self, names):
+        """Restart more processes
+
+        Processes that are already waiting to be restarted, or are
+        being restarted, are not restarted again.
+
+        :params names: iterable of strings, names of processes
+        :returns: the number of processes that will be restarted
+        """
+        known = set(self.queue) | set(self.inFlight)
+        added = 0
+        for name in names:
+            if name not in known:
+                known.add(name)
+                self.queue.append(name)
+                added += 1
+        if self._call is None:
+            self._step()
+        return added
+
+    def _step(self):
+        self._call = None
+        now = self.reactor.seconds()
+        for name, (token, deadline) in list(self.inFlight.items()):
+            if self.isReady(name, token):
+                del self.inFlight[name]
+            elif now >= deadline:
+                log.msg("Timed out waiting for restarted process: ", name)
+                del self.inFlight[name]
+        while self.queue and len(self.inFlight) < self.batch:
+            name = self.queue.popleft()
+            token = self.stop(name)
+            if token is not None:
+                self.inFlight[name] = token, now + self.timeout
+        if self.done():
+            log.msg("Rolling restart done")
+            return
+        self._call = self.reactor.callLater(self.interval, self._step)
+
+
+@interface.implementer(
+    interfaces.IMonitorEventReceiver, interfaces.IMonitorEventUpdater
+)
 class Receiver:
 
     """A wrapper around ProcessMonitor that responds to events
 
+    Restart requests can be gathered for a window of time, and then
+    acted on together: each process is stopped at most once, and a
+    restart of everything makes restarts of single processes redundant.
+    The number of restarts requested, performed and suppressed is kept
+    in :code:`stats`.
+
+    Configuration changes that do not change how the process is
+    started (for example, changes to the parameters of a health check)
+    do not restart the process. Those are counted as :code:`unchanged`
+    in :code:`stats`.
+
+    Restart messages with a :code:`batch` restart processes a batch at
+    a time (see :code:`RollingRestart`), waiting for each one to run
+    again -- and, if :code:`health` is set, to send a heartbeat -- before
+    restarting more. Such messages are not gathered: they join the
+    rolling restart in progress, if any, which keeps its own settings and
+    restarts each process at most once. The rolling restart in progress,
+    or the last one, is :code:`rolling`.
+
     :params monitor: a ProcessMonitor
+    :params environ: environment to inherit variables from
+    :params window: seconds to gather restart requests for, or 0
+                    to act on each request immediately
+    :params reactor: IReactorTime, needed if window is not 0 or for
+                     rolling restarts
+    :params publisher: a StatusPublisher to tell about processes that are
+                       no longer monitored, or None
     """
 
-    def __init__(self, monitor, environ=None):
+    # pylint: disable=too-many-arguments
+    def __init__(self, monitor, environ=None, window=0, reactor=None, publisher=None):
         """Initialize from ProcessMonitor"""
         if environ is None:
             environ = os.environ
         self.environ = environ
         self.monitor = monitor
+        self.window = window
+        self.reactor = reactor
+        self.publisher = publisher
+        self.stats = collections.Counter()
         self._groupToProcess = collections.defaultdict(set)
         self._processToGroups = {}
+        self._spawnParams = {}
+        self._env = {}
+        self._status = {}
+        self.rolling = None
+        self._pending = set()
+        self._pendingAll = False
+        self._requested = 0
+        self._call = None
 
-    def add(self, name, contents):
-        """Add a process
+    # pylint: enable=too-many-arguments
 
-        :params name: string, name of process
-        :params contents: string, contents
-           parsed as JSON for process params
-        :returns: None
-        """
+    def _parse(self, name, contents):
         parsedContents = json.loads(contents.decode("utf-8"))
+        heart = parsedContents.get("ncolony.beatcheck")
         parsedContents = {
             key: value for key, value in parsedContents.items() if key in VALID_KEYS
         }
@@ -53,11 +177,43 @@ class Receiver:
         for key in parsedContents.pop("env_inherit", []):
             parsedContents["env"][key] = self.environ.get(key, "")
         groups = parsedContents.pop("group", [])
+        parsedContents["env"]["NCOLONY_NAME"] = name
+        return parsedContents, groups, heart
+
+    def _register(self, name, groups, heart):
         for key in groups:
             self._groupToProcess[key].add(name)
         self._processToGroups[name] = groups
+        status = (heart or {}).get("status")
+        if status is not None:
+            self._status[name] = status
+
+    def groups(self):
+        """The processes in each group
+
+        :returns: dict mapping group names to sets of process names
+        """
+        return {group: set(names) for group, names in self._groupToProcess.items()}
+
+    def _unregister(self, name):
+        self._status.pop(name, None)
+        for group in self._processToGroups.pop(name):
+            self._groupToProcess[group].remove(name)
+
+    def add(self, name, contents):
+        """Add a process
+
+        :params name: string, name of process
+        :params contents: string, contents
+           parsed as JSON for process params
+        :returns: None
+        """
+        parsedContents, groups, heart = self._parse(name, contents)
+        self._register(name, groups, heart)
+        spawnParams = dict(parsedContents, env=dict(parsedContents["env"]))
+        self._spawnParams[name] = spawnParams, heart
         parsedContents["env"]["NCOLONY_CONFIG"] = contents
-        parsedContents["env"]["NCOLONY_NAME"] = name
+        self._env[name] = parsedContents["env"]
         self.monitor.addProcess(**parsedContents)
         log.msg("Added monitored process: ", name)
 
@@ -68,8 +224,36 @@ class Receiver:
         """
         self.monitor.removeProcess(name)
         log.msg("Removed monitored process: ", name)
-        for group in self._processToGroups.pop(name):
-            self._groupToProcess[group].remove(name)
+        self._unregister(name)
+        del self._spawnParams[name]
+        del self._env[name]
+        if self.publisher is not None:
+            self.publisher.forget(name)
+
+    def update(self, name, contents):
+        """Update a process whose configuration changed
+
+        If the parameters the process is started with, and its
+        ncolony.beatcheck configuration (which its heart reads when
+        it starts), did not change, the process is not restarted:
+        it gets the new configuration (in NCOLONY_CONFIG) when it is
+        next started. Otherwise, it is removed and added again.
+
+        :params name: string, name of process
+        :params contents: string, new contents
+           parsed as JSON for process params
+        :returns: None
+        """
+        parsedContents, groups, heart = self._parse(name, contents)
+        if (parsedContents, heart) != self._spawnParams[name]:
+            self.remove(name)
+            self.add(name, contents)
+            return
+        self._unregister(name)
+        self._register(name, groups, heart)
+        self._env[name]["NCOLONY_CONFIG"] = contents
+        self.stats["unchanged"] += 1
+        log.msg("Updated monitored process without restarting: ", name)
 
     def message(self, contents):
         """Respond to a restart or a restart-all message
@@ -80,19 +264,122 @@ class Receiver:
            If the value is 'restart', another key
            ('value') should exist with a logical process
            name.
+           A 'batch' key asks for a rolling restart, with
+           optional 'health' and 'timeout' keys.
         """
         contents = json.loads(contents.decode("utf-8"))
         tp = contents["type"]
         if tp == "RESTART":
-            self.monitor.stopProcess(contents["name"])
-            log.msg("Restarting monitored process: ", contents["name"])
+            names = [contents["name"]]
         elif tp == "RESTART-ALL":
-            self.monitor.restartAll()
-            log.msg("Restarting all monitored processes")
+            names = None
         elif tp == "RESTART-GROUP":
             log.msg("Restarting group", contents["group"])
-            for name in self._groupToProcess[contents["group"]]:
-                log.msg("Restarting monitored process: ", name)
-                self.monitor.stopProcess(name)
+            names = sorted(self._groupToProcess[contents["group"]])
         else:
             raise ValueError("unknown type", contents)
+        if "batch" in contents:
+            if names is None:
+                names = sorted(self._processToGroups)
+            rolling = Rolling(
+                int(contents["batch"]),
+                bool(contents.get("health", False)),
+                float(contents.get("timeout", 60)),
+            )
+            self._rollingRestart(names, rolling)
+            return
+        if self.window:
+            self._gather(names)
+            return
+        if names is None:
+            self._count(len(self._processToGroups), len(self._processToGroups))
+            self.monitor.restartAll()
+            log.msg("Restarting all monitored processes")
+            return
+        self._count(len(names), len(names))
+        for name in names:
+            self.monitor.stopProcess(name)
+            log.msg("Restarting monitored process: ", name)
+
+    def _rollingRestart(self, names, rolling):
+        if self.rolling is None or self.rolling.done():
+            log.msg("Rolling restart, batch: ", rolling.batch)
+            self.rolling = RollingRestart(
+                self.reactor,
+                self._stopOne,
+                functools.partial(self._isReady, health=rolling.health),
+                rolling.batch,
+                timeout=rolling.timeout,
+            )
+        performed = self.rolling.extend(names)
+        self._count(len(names), performed)
+
+    def _heartbeat(self, name):
+        status = self._status.get(name)
+        if status is None:
+            return None
+        if os.path.isdir(status):
+            status = os.path.join(status, name)
+        try:
+            return os.stat(status).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _stopOne(self, name):
+        if name not in self._processToGroups:
+            return None
+        protocol = self.monitor.protocols.get(name)
+        heartbeat = self._heartbeat(name)
+        self.monitor.stopProcess(name)
+        log.msg("Restarting monitored process: ", name)
+        if not self.monitor.running:
+            return None
+        # A process that is down is waited on until the monitor starts it
+        return protocol, heartbeat
+
+    def _isReady(self, name, token, health):
+        if name not in self._processToGroups:
+            return True
+        oldProtocol, heartbeat = token
+        protocol = self.monitor.protocols.get(name)
+        if protocol is None or protocol is oldProtocol:
+            return False
+        if health and heartbeat is not None:
+            return self._heartbeat(name) != heartbeat
+        return True
+
+    def _count(self, requested, performed):
+        self.stats["requested"] += requested
+        self.stats["performed"] += performed
+        self.stats["suppressed"] += requested - performed
+
+    def _gather(self, names):
+        if names is None:
+            self._requested += len(self._processToGroups)
+            self._pendingAll = True
+        else:
+            self._requested += len(names)
+            self._pending.update(names)
+        if self._call is None:
+            self._call = self.reactor.callLater(self.window, self._flush)
+
+    def _flush(self):
+        self._call = None
+        if self._pendingAll:
+            names = list(self._processToGroups)
+            self.monitor.restartAll()
+            log.msg("Restarting all monitored processes")
+        else:
+            names = sorted(self._pending & set(self._processToGroups))
+            for name in names:
+                self.monitor.stopProcess(name)
+                log.msg("Restarting monitored process: ", name)
+        self._count(self._requested, len(names))
+        if self._requested > len(names):
+            log.msg("Suppressed redundant restarts: ", self._requested - len(names))
+        self._requested = 0
+        self._pending = set()
+        self._pendingAll = False
+
+
+# pylint: enable=too-many-instance-attributes
@@ -0,0 +1,208 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.scanner
+==================
+
+Read configuration directories away from the reactor thread.
+
+The checkers read every configuration file, and look at heartbeat
+files, on every check. When those are on a slow (for example, network)
+file system, doing that on the reactor thread holds up every timer
+and network callback in the process. A Scanner runs those reads in
+a small thread pool instead.
+
+Only one read with the same key (usually, the directory being read)
+runs at a time, so a stuck file system does not pile up reads, and
+a read can be given a deadline after which the checker gives up
+on it and tries again on the next check.
+"""
+
+import collections
+import os
+import stat
+import time
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python import failure, log, threadpool
+
+from ncolony import directory_monitor
+
+Snapshot = collections.namedtuple("Snapshot", "fingerprint mtime content")
+
+
+class BusyError(Exception):
+
+    """A read with the same key is still running"""
+
+
+def _read(path, info, known, now):
+    fingerprint = directory_monitor.fingerprint(info)
+    content = None
+    if fingerprint != known:
+        with open(path, "rb") as fp:
+            content = fp.read()
+    if directory_monitor.isRacy(info, now):
+        fingerprint = None
+    return Snapshot(fingerprint, info.st_mtime, content)
+
+
+def readFile(path, known=None):
+    """Read a configuration file, unless it did not change
+
+    Fingerprints are those of :code:`ncolony.directory_monitor`.
+    A file modified too recently for its fingerprint to be trusted
+    gets None as a fingerprint, so it is read again the next time.
+
+    This blocks, so it is meant to be run in a thread.
+
+    :param path: string, the file to read
+    :param known: the fingerprint of the file when it was last read, or None
+    :returns: Snapshot, with content None if the fingerprint is unchanged
+    """
+    now = time.time_ns()
+    return _read(path, os.stat(path), known, now)
+
+
+def readDirectory(path, known=None):
+    """Read the configuration files in a directory, unless they did not change
+
+    Anything that is not a regular file is ignored, and so are
+    temporary (.new) files. Files removed while the directory is read
+    are left out.
+
+    This blocks, so it is meant to be run in a thread.
+
+    :param path: string, the directory to read
+    :param known: dict mapping names to fingerprints of files when they
+                  were last read, or None
+    :returns: dict mapping names to Snapshot
+    """
+    if known is None:
+        known = {}
+    now = time.time_ns()
+    ret = {}
+    for name, info in directory_monitor.scan(path).items():
+        if not stat.S_ISREG(info.st_mode):
+            continue
+        child = os.path.join(path, name)
+        try:
+            ret[name] = _read(child, info, known.get(name), now)
+        except FileNotFoundError:
+            continue
+    return ret
+
+
+def inline(key, func, *args):
+    """Run a read on this thread, as a Scanner would run it in a thread
+
+    :param key: ignored
+    :param func: function to run
+    :param args: arguments to func
+    :returns: Deferred that fires with the result of func
+    """
+    del key
+    return defer.maybeDeferred(func, *args)
+
+
+class Scanner(service.Service):
+
+    """Run blocking reads in a bounded thread pool
+
+    :param reactor: IReactorTime and IReactorThreads
+    :param size: integer, the most reads that run at the same time
+    :param timeout: number, seconds to wait for a read before giving up
+                    on it, or None to wait as long as it takes
+    """
+
+    def __init__(self, reactor, size=4, timeout=None):
+        self.reactor = reactor
+        self.timeout = timeout
+        self.pool = threadpool.ThreadPool(
+            minthreads=0, maxthreads=size, name="ncolony-scanner"
+        )
+        self._busy = set()
+
+    def startService(self):
+        """Start the threads"""
+        service.Service.startService(self)
+        self.pool.start()
+
+    def stopService(self):
+        """Stop the threads, without waiting for them on the reactor thread
+
+        The threads are joined in a thread of the reactor's own pool.
+        Shutdown waits for running reads to finish, but no longer than
+        the timeout, if there is one: a read stuck on a hung file system
+        is left behind.
+
+        :returns: Deferred that fires when the threads are stopped,
+                  or the timeout passed
+        """
+        service.Service.stopService(self)
+
+        def _leftBehind(reason):
+            reason.trap(defer.TimeoutError)
+            log.msg("Reads still running at shutdown were left behind")
+
+        d = threads.deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(), self.pool.stop
+        )
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, self.reactor)
+            d.addErrback(_leftBehind)
+        return d
+
+    def run(self, key, func, *args):
+        """Run a read in a thread
+
+        Fails with BusyError if a read with the same key is running,
+        and with twisted.internet.defer.TimeoutError if the read takes
+        longer than the timeout. The key is only free again when the
+        read actually finishes.
+
+        :param key: hashable, what is being read
+        :param func: function to run
+        :param args: arguments to func
+        :returns: Deferred that fires with the result of func
+        """
+        if key in self._busy:
+            return defer.fail(BusyError(key))
+        self._busy.add(key)
+        ret = defer.Deferred()
+
+        def _finish(result):
+            self._busy.discard(key)
+            if not ret.called:
+                ret.callback(result)
+            elif isinstance(result, failure.Failure):
+                log.msg("Read failed after its deadline: ", key, result)
+
+        d = threads.deferToThreadPool(self.reactor, self.pool, func, *args)
+        d.addBoth(_finish)
+        if self.timeout is not None:
+            ret.addTimeout(self.timeout, self.reactor)
+        return ret
+
+    def read(self, path, known=None):
+        """Read the configuration files in a directory in a thread
+
+        :param path: string, the directory to read
+        :param known: dict mapping names to fingerprints of files when they
+                      were last read, or None
+        :returns: Deferred that fires with a dict mapping names to Snapshot
+        """
+        return self.run(path, readDirectory, path, dict(known or {}))
+
+
+def skipped(reason, what):
+    """Log a read that was skipped because it is busy or too slow
+
+    Use as an errback. Other failures are passed on.
+
+    :param reason: Failure
+    :param what: string, what was being read
+    :returns: None
+    """
+    reason.trap(BusyError, defer.TimeoutError)
+    log.msg("Skipping check, reading took too long: ", what)
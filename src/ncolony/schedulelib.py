@@ -9,10 +9,38 @@ Construct a Twisted service for process scheduling.
 
    $ twistd -n ncolonysched --timeout 2 --grace 1 --frequency 10
             --arg /bin/echo --arg hello
+
+One scheduler can also run many commands (jobs), each on its own
+frequency, described in a JSON file:
+
+.. code-block:: bash
+
+   $ twistd -n ncolonysched --jobs jobs.json --max-running 4
+
+where :code:`jobs.json` maps job names to their :code:`args`,
+:code:`frequency`, :code:`timeout`, :code:`grace`, and, optionally,
+:code:`overlap`: what to do when a job is due while its last run
+is still going -- :code:`"skip"` it (the default), :code:`"queue"`
+it to run when the last run ends, or :code:`"kill"` the last run.
+With :code:`--max-running`, jobs beyond that many wait for their turn.
+
+A job can have a :code:`cron` expression (see :code:`ncolony.cron`)
+instead of a :code:`frequency`, and a :code:`splay`: each run is delayed
+by up to that many seconds, picked from the host and job names
+(:code:`"splayBy": "hash"`, the default) or at random
+(:code:`"splayBy": "random"`). A single command can be scheduled the
+same way with :code:`--cron`, :code:`--splay` and :code:`--splay-by`.
 """
 from __future__ import print_function
 
+import collections
+import functools
+import json
+import math
 import os
+import random
+import socket
+import zlib
 
 from zope import interface
 
@@ -25,6 +53,7 @@ from twisted.internet import reactor as tireactor
 
 from twisted.application import internet as tainternet, service
 
+from ncolony import cron as cronlib, instrument
 from ncolony.client import heart
 
 
@@ -46,11 +75,12 @@ class ProcessProtocol:
             print("[%d]" % fd, line)
 
     def processEnded(self, reason):
-        """Report process end to deferred
+        """Report process end to deferred, unless it was cancelled
 
         :params reason: a Failure
         """
-        self.deferred.errback(reason)
+        if not self.deferred.called:
+            self.deferred.errback(reason)
 
     def processExited(self, reason):
         """Ignore processExited"""
@@ -71,9 +101,16 @@ def runProcess(args, timeout, grace, reactor):
     :params reactor: IReactorProcess and IReactorTime
     :returns: deferred that fires with success when the process ends,
               or fails if there was a problem spawning/terminating
-              the process
+              the process. Cancelling it kills the process.
     """
-    deferred = defer.Deferred()
+
+    def _kill(dummy):
+        try:
+            process.signalProcess("KILL")
+        except tierror.ProcessExitedAlready:
+            pass
+
+    deferred = defer.Deferred(_kill)
     protocol = ProcessProtocol(deferred)
     process = reactor.spawnProcess(protocol, args[0], args, env=os.environ)
 
@@ -83,12 +120,13 @@ def runProcess(args, timeout, grace, reactor):
 
     deferred.addErrback(_logEnded)
 
-    def _cancelTermination(dummy):
+    def _cancelTermination(result):
         for termination in terminations:
             if termination.active():
                 termination.cancel()
+        return result
 
-    deferred.addCallback(_cancelTermination)
+    deferred.addBoth(_cancelTermination)
     terminations = []
     terminations.append(reactor.callLater(timeout, process.signalProcess, "TERM"))
     terminations.append(
@@ -97,6 +135,212 @@ def runProcess(args, timeout, grace, reactor):
     return deferred
 
 
+Job = collections.namedtuple(
+    "Job",
+    "name args frequency timeout grace overlap cron splay splayBy",
+    defaults=("skip", None, 0, "hash"),
+)
+
+OVERLAPS = ("skip", "queue", "kill")
+
+SPLAYS = ("hash", "random")
+
+
+def parseJobs(content):
+    """Parse job descriptions
+
+    :params content: string, a JSON object mapping job names to objects
+                     with 'args', 'timeout', 'grace', either 'frequency'
+                     or 'cron' (a cron expression), and optionally
+                     'overlap' (one of OVERLAPS), 'splay' and 'splayBy'
+                     (one of SPLAYS)
+    :returns: list of Job, sorted by name
+    """
+    ret = []
+    for name, details in sorted(json.loads(content).items()):
+        ret.append(
+            makeJob(
+                name=name,
+                args=details["args"],
+                frequency=details.get("frequency"),
+                timeout=details["timeout"],
+                grace=details["grace"],
+                overlap=details.get("overlap", "skip"),
+                cron=details.get("cron"),
+                splay=details.get("splay", 0),
+                splayBy=details.get("splayBy", "hash"),
+            )
+        )
+    return ret
+
+
+def makeJob(**kwargs):
+    """Make a job, checking it makes sense
+
+    :params kwargs: the fields of Job, with cron a cron expression;
+                    one of frequency and cron is needed
+    :returns: Job
+    :raises: ValueError, if the job does not make sense
+    """
+    kwargs.setdefault("frequency", None)
+    job = Job(**kwargs)
+    if (job.frequency is None) == (job.cron is None):
+        raise ValueError("Need one of frequency or cron", job.name)
+    if job.overlap not in OVERLAPS:
+        raise ValueError("Unknown overlap policy", job.name, job.overlap)
+    if job.splayBy not in SPLAYS:
+        raise ValueError("Unknown splay", job.name, job.splayBy)
+    if job.cron is not None:
+        job = job._replace(cron=cronlib.parse(job.cron))
+    return job
+
+
+def splayDelay(job, hostname, rand=random.random):
+    """How long to delay a run of a job by
+
+    With "hash", the delay is the same for every run of a job on
+    a host, but differs between jobs and hosts. With "random",
+    each run is delayed differently.
+
+    :params job: Job
+    :params hostname: string
+    :params rand: function returning a random number in [0, 1)
+    :returns: number, seconds between 0 and the job's splay
+    """
+    if job.splayBy == "random":
+        return rand() * job.splay
+    key = "%s:%s" % (hostname, job.name)
+    return zlib.crc32(key.encode("utf-8")) / 2**32 * job.splay
+
+
+class JobTimer(service.Service):
+
+    """Run a job whenever it is due
+
+    A job with a frequency is due when the service starts,
+    and every frequency seconds after that; a job with a cron
+    schedule is due when the schedule says. Each run is delayed
+    by the job's splay. Runs that were missed, because the reactor
+    was busy or the splay is longer than the time between runs,
+    are not made up for.
+
+    :params job: Job
+    :params run: function called with the job when it is due
+    :params reactor: IReactorTime
+    """
+
+    def __init__(self, job, run, reactor):
+        self.job = job
+        self.run = run
+        self.reactor = reactor
+        self.splay = functools.partial(splayDelay, job, socket.gethostname())
+        self.call = None
+        self.due = None
+        self.delay = 0
+
+    def startService(self):
+        """Schedule the first run"""
+        service.Service.startService(self)
+        now = self.reactor.seconds()
+        if self.job.cron is not None:
+            now = self.job.cron.nextTime(now)
+        self._schedule(now)
+
+    def stopService(self):
+        """Cancel the next run"""
+        service.Service.stopService(self)
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def _schedule(self, due):
+        self.due = due
+        self.delay = self.splay()
+        delay = max(due + self.delay - self.reactor.seconds(), 0)
+        self.call = self.reactor.callLater(delay, self._fire)
+
+    def _fire(self):
+        self.call = None
+        # Always strictly after now, so a run is never due twice
+        now = self.reactor.seconds()
+        if self.job.cron is not None:
+            due = self.job.cron.nextTime(now)
+        else:
+            periods = math.floor((now - self.due) / self.job.frequency) + 1
+            due = self.due + periods * self.job.frequency
+        # Scheduled first, so a run that fails does not stop the job
+        self._schedule(due)
+        self.run(self.job)
+
+
+# pylint: disable=too-few-public-methods
+
+
+class Runner:
+
+    """Run jobs, keeping to their overlap policies and to a limit
+
+    When a job is due while its last run is still going (or still
+    waiting for its turn), its overlap policy decides what happens:
+    "skip" does not run it, "queue" runs it once the last run ends
+    (queueing at most one run), and "kill" kills the last run and
+    runs it right away.
+
+    :params reactor: IReactorProcess and IReactorTime
+    :params maxRunning: integer, the most jobs running at a time,
+                        or 0 for no limit
+    """
+
+    def __init__(self, reactor, maxRunning=0):
+        self.reactor = reactor
+        self.limit = defer.DeferredSemaphore(maxRunning) if maxRunning else None
+        self.running = {}
+        self.queued = set()
+
+    def run(self, job):
+        """Run a job, if its overlap policy allows
+
+        This does not wait for the job to end.
+
+        :params job: Job
+        :returns: None
+        """
+        current = self.running.get(job.name)
+        if current is None:
+            self._start(job)
+        elif job.overlap == "kill":
+            print("Killing last run of", job.name)
+            current.cancel()
+            self._start(job)
+        elif job.overlap == "queue" and job.name not in self.queued:
+            self.queued.add(job.name)
+        else:
+            print("Skipping", job.name, "-- last run still going")
+
+    def _start(self, job):
+        args = (job.args, job.timeout, job.grace, self.reactor)
+        if self.limit is None:
+            d = defer.maybeDeferred(runProcess, *args)
+        else:
+            d = self.limit.run(runProcess, *args)
+        self.running[job.name] = d
+        d.addErrback(self._failed, job)
+        d.addCallback(self._finished, job)
+
+    def _failed(self, reason, job):
+        if not reason.check(defer.CancelledError):
+            print("Running", job.name, "failed:", reason.getErrorMessage())
+
+    def _finished(self, dummy, job):
+        del self.running[job.name]
+        if job.name in self.queued:
+            self.queued.remove(job.name)
+            self._start(job)
+
+
+# pylint: enable=too-few-public-methods
+
+
 class Options(usage.Options):
 
     """Options for scheduler service"""
@@ -111,6 +355,12 @@ class Options(usage.Options):
             int,
         ],
         ["frequency", None, None, "How often to run the command", int],
+        ["stats", None, None, "File to write event loop stats to"],
+        ["jobs", None, None, "JSON file describing jobs, instead of one command"],
+        ["max-running", None, 0, "Most jobs running at a time (0: no limit)", int],
+        ["cron", None, None, "When to run the command, instead of frequency"],
+        ["splay", None, 0, "Most seconds to delay each run by", float],
+        ["splay-by", None, "hash", "How to pick the delay: hash or random"],
     ]
 
     def __init__(self):
@@ -122,27 +372,75 @@ class Options(usage.Options):
         self["args"].append(arg)
 
     def postOptions(self):
-        for elem in ["args", "timeout", "grace", "frequency"]:
+        if self["jobs"] is not None:
+            if self["args"]:
+                raise ValueError("jobs", "args")
+            return
+        required = ["args", "timeout", "grace"]
+        if self["cron"] is None:
+            required.append("frequency")
+        else:
+            cronlib.parse(self["cron"])
+        for elem in required:
             if not self[elem]:
                 raise ValueError(elem)
 
 
+def makeJobsService(jobs, runner, tick):
+    """Make a service that runs jobs
+
+    :params jobs: list of Job
+    :params runner: Runner
+    :params tick: function that wraps a function, such as Stats.timed
+    :returns: service, with a JobTimer named after each job
+    """
+    ret = service.MultiService()
+    for job in jobs:
+        timer = JobTimer(job, tick(runner.run), runner.reactor)
+        timer.setName(job.name)
+        timer.setServiceParent(ret)
+    return ret
+
+
 def makeService(opts):
     """Make scheduler service
 
     :params opts: dict-like object.
-       keys: frequency, args, timeout, grace
+       keys: frequency (or cron), args, timeout, grace, and optionally
+       splay, splay-by and stats; or jobs (a file to read with parseJobs),
+       and optionally max-running and stats
     """
-    ser = tainternet.TimerService(
-        opts["frequency"],
-        runProcess,
-        opts["args"],
-        opts["timeout"],
-        opts["grace"],
-        tireactor,
-    )
+    stats = instrument.maybeStats(opts.get("stats"))
+    tick = functools.partial(instrument.ensure(stats).timed, "scheduler.tick")
+    if opts.get("jobs") is not None:
+        with open(opts["jobs"]) as fp:
+            jobs = parseJobs(fp.read())
+        runner = Runner(tireactor, opts.get("max-running", 0))
+        ser = makeJobsService(jobs, runner, tick)
+    elif opts.get("cron") is not None or opts.get("splay"):
+        job = makeJob(
+            name=" ".join(opts["args"]),
+            args=opts["args"],
+            frequency=None if opts.get("cron") else opts["frequency"],
+            timeout=opts["timeout"],
+            grace=opts["grace"],
+            cron=opts.get("cron"),
+            splay=opts.get("splay", 0),
+            splayBy=opts.get("splay-by", "hash"),
+        )
+        ser = makeJobsService([job], Runner(tireactor), tick)
+    else:
+        ser = tainternet.TimerService(
+            opts["frequency"],
+            tick(runProcess),
+            opts["args"],
+            opts["timeout"],
+            opts["grace"],
+            tireactor,
+        )
     ret = service.MultiService()
     ser.setName("scheduler")
     ser.setServiceParent(ret)
     heart.maybeAddHeart(ret)
+    instrument.maybeAddService(ret, stats, opts.get("stats"), tireactor)
     return ret
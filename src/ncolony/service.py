@@ -12,13 +12,29 @@ Implement the 'ncolony' twistd plugin.
 Will run a service that brings up all processes described in files
 in the configuration directory (and shuts them down if the files
 ago away), and listens for restart messages on the messages directory.
+
+With :code:`--shards N`, it instead runs N worker supervisors,
+and spreads the processes between them (see :code:`ncolony.shard`).
 """
 
-from twisted.python import usage
+import json
+import os
+import sys
+import warnings
+
+from twisted.python import filepath, log, usage
+from twisted.internet import reactor as tireactor, threads
 from twisted.application import service as taservice, internet
 from twisted.runner import procmon as procmonlib, procmontap
 
-from ncolony import directory_monitor, process_events
+from ncolony import (
+    directory_monitor,
+    instrument,
+    metrics as metricslib,
+    process_events,
+    shard,
+    statustable,
+)
 
 # pylint: disable=too-few-public-methods
 
@@ -30,6 +46,8 @@ class TransportDirectoryDict(dict):
     This dict-like object assumes all the values have a 'pid' attribute,
     and writes that attribute into a file named the same as the key
     in the given directory.
+
+    Deprecated: use a PublishingDict with a PidPublisher instead.
     """
 
     def __init__(self, output):
@@ -37,6 +55,12 @@ class TransportDirectoryDict(dict):
 
         :param output: a {twisted.python.filepath.FilePath} object
         """
+        warnings.warn(
+            "TransportDirectoryDict is deprecated, "
+            "use PublishingDict with a PidPublisher instead",
+            DeprecationWarning,
+            stacklevel=2,
+        )
         super().__init__()
         self.output = output
 
@@ -49,10 +73,180 @@ class TransportDirectoryDict(dict):
         self.output.child(name).remove()
 
 
+class PublishingDict(dict):
+
+    """Dict-like object that tells publishers about its values
+
+    Publishers have a :code:`set` method, called with a name and a value,
+    and a :code:`delete` method, called with a name.
+
+    :param publishers: PidPublisher, StatusPublisher or the like
+    """
+
+    def __init__(self, *publishers):
+        super().__init__()
+        self.publishers = publishers
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        for publisher in self.publishers:
+            publisher.set(name, value)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        for publisher in self.publishers:
+            publisher.delete(name)
+
+
 # pylint: enable=too-few-public-methods
 
 
-def get(config, messages, freq, pidDir=None, reactor=None):
+def _pidOf(value):
+    pid = getattr(value, "pid", None)
+    if pid is None:
+        pid = getattr(getattr(value, "transport", None), "pid", None)
+    return pid
+
+
+# pylint: disable=too-many-instance-attributes
+
+
+class PidPublisher(taservice.Service):
+
+    """Publish pids, in batches, away from the reactor thread
+
+    Changes are gathered for :code:`delay` seconds, and then written
+    in a thread -- one file per process in the output directory, and/or
+    a single JSON file mapping names to pids, replaced atomically.
+    A name that changes several times while changes are gathered is
+    written once. While the service is not running, changes are written
+    right away.
+
+    The values are either things with a :code:`pid` attribute, or
+    process protocols whose transport has one. The pid is found when
+    writing, so it is fine for the process to be started after its
+    protocol is published.
+
+    :param reactor: IReactorTime
+    :param output: {twisted.python.filepath.FilePath} or None,
+                   directory to keep pid files
+    :param index: {twisted.python.filepath.FilePath} or None,
+                  file to keep all pids in
+    :param delay: number, seconds to gather changes for
+    :param runner: function that takes a function and arguments,
+                   calls it in a thread and returns a Deferred
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, reactor, output=None, index=None, delay=0, runner=None):
+        if runner is None:
+            runner = threads.deferToThread
+        self.reactor = reactor
+        self.output = output
+        self.index = index
+        self.delay = delay
+        self.runner = runner
+        self.values = {}
+        self._dirty = {}
+        self._call = None
+        self._writing = None
+
+    # pylint: enable=too-many-arguments
+
+    def set(self, name, value):
+        """Publish a new value for a name"""
+        self.values[name] = value
+        self._changed(name, value)
+
+    def delete(self, name):
+        """Stop publishing a name"""
+        del self.values[name]
+        self._changed(name, None)
+
+    def _changed(self, name, value):
+        self._dirty[name] = value
+        if not self.running:
+            self._write(*self._collect())
+        elif self._call is None and self._writing is None:
+            self._call = self.reactor.callLater(self.delay, self._flush)
+
+    def _collect(self):
+        dirty, self._dirty = self._dirty, {}
+        pids = {}
+        for name, value in dirty.items():
+            if value is None:
+                pids[name] = None
+                continue
+            pid = _pidOf(value)
+            if pid is not None:
+                pids[name] = pid
+        snapshot = None
+        if self.index is not None:
+            snapshot = {name: _pidOf(value) for name, value in self.values.items()}
+        return pids, snapshot
+
+    def _flush(self):
+        self._call = None
+        d = self._writing = self.runner(self._write, *self._collect())
+        d.addErrback(log.err, "Could not publish pids")
+        d.addBoth(self._written)
+
+    def _written(self, _ignored):
+        self._writing = None
+        if self._dirty and self.running:
+            self._call = self.reactor.callLater(self.delay, self._flush)
+
+    def _write(self, pids, snapshot):
+        if self.output is not None:
+            for name, pid in pids.items():
+                child = self.output.child(name)
+                if pid is None:
+                    try:
+                        child.remove()
+                    except FileNotFoundError:
+                        pass
+                else:
+                    child.setContent(str(pid).encode("ascii"))
+        if snapshot is not None:
+            snapshot = {name: pid for name, pid in snapshot.items() if pid is not None}
+            self.index.setContent(json.dumps(snapshot, sort_keys=True).encode("utf-8"))
+
+    def stopService(self):
+        """Stop gathering changes, and write the ones that were gathered"""
+        taservice.Service.stopService(self)
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._writing is None:
+            self._write(*self._collect())
+            return None
+        d, self._writing = self._writing, None
+        d.addCallback(lambda _: self._write(*self._collect()))
+        return d
+
+
+# pylint: enable=too-many-instance-attributes
+
+
+# pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+def get(
+    config,
+    messages,
+    freq,
+    pidDir=None,
+    reactor=None,
+    inotify=False,
+    restartWindow=0,
+    shards=0,
+    shardRoot=None,
+    shardArgs=(),
+    pidIndex=None,
+    pidDelay=0,
+    statusTable=None,
+    statusCapacity=4096,
+    stats=None,
+    metrics=None,
+):
     """Return a service which monitors processes based on directory contents
 
     Construct and return a service that, when started, will run processes
@@ -68,31 +262,112 @@ def get(config, messages, freq, pidDir=None, reactor=None):
                  updates
     :param pidDir: {twisted.python.filepath.FilePath} or None,
                    location to keep pid files
+    :param pidIndex: {twisted.python.filepath.FilePath} or None,
+                     file to keep all pids in, as JSON
+    :param pidDelay: number, seconds to gather pid changes for before
+                     writing them
+    :param statusTable: string or None, location of a status table
+                        to publish
+    :param statusCapacity: integer, the most processes the status table
+                           can hold
     :param reactor: something implementing the interfaces
                        {twisted.internet.interfaces.IReactorTime} and
                        {twisted.internet.interfaces.IReactorProcess} and
+    :param inotify: boolean, whether to also watch the configuration
+                    and messages directories with inotify (where available),
+                    so changes are noticed without waiting for the next check
+    :param restartWindow: number, seconds to gather restart requests for
+                          before acting on them together
+    :param shards: integer, if not 0, the number of worker supervisors to
+                   run processes with, instead of running them directly
+    :param shardRoot: string, directory for the workers' configuration
+                      and messages directories
+    :param shardArgs: list of strings, more command-line arguments for
+                      the workers
+    :param stats: ncolony.instrument.Stats to record check timings in,
+                  or None
+    :param metrics: string, a Twisted endpoint description to serve
+                    metrics on (see :code:`ncolony.metrics`), or None
     :returns: service, {twisted.application.interfaces.IService}
     """
+    if metrics is not None and stats is None:
+        stats = instrument.Stats()
+    stats = instrument.ensure(stats)
+    if reactor is None:
+        reactor = tireactor
     ret = taservice.MultiService()
-    args = ()
-    if reactor is not None:
-        args = (reactor,)
-    procmon = procmonlib.ProcessMonitor(*args)
-    if pidDir is not None:
-        protocols = TransportDirectoryDict(pidDir)
-        procmon.protocols = protocols
+    procmon = procmonlib.ProcessMonitor(reactor)
+    publishers = []
+    if pidDir is not None or pidIndex is not None:
+        publisher = PidPublisher(reactor, output=pidDir, index=pidIndex, delay=pidDelay)
+        publisher.setName("pids")
+        publisher.setServiceParent(ret)
+        publishers.append(publisher)
+    statusPublisher = None
+    if statusTable is not None:
+        statustable.create(statusTable, statusCapacity)
+        table = statustable.StatusTable(statusTable)
+        table.refresh()
+        statusPublisher = statustable.StatusPublisher(reactor, table)
+        publishers.append(statusPublisher)
+    metricsPublisher = None
+    if metrics is not None:
+        metricsPublisher = metricslib.MetricsPublisher(reactor)
+        publishers.append(metricsPublisher)
+    if publishers:
+        procmon.protocols = PublishingDict(*publishers)
     procmon.setName("procmon")
-    receiver = process_events.Receiver(procmon)
-    confcheck = directory_monitor.checker(config, receiver)
-    confserv = internet.TimerService(freq, confcheck)
+    if shards:
+        places = shard.makePlaces(shardRoot, shards)
+        receiver = shard.Router(places)
+        for index, place in enumerate(places):
+            args = [sys.executable, "-m", "twisted", "ncolony"]
+            args.extend(["--config", place.config, "--messages", place.messages])
+            args.extend(["--frequency", str(freq)])
+            args.extend(shardArgs)
+            procmon.addProcess("ncolony-shard-%d" % index, args, env=dict(os.environ))
+        confcheck = shard.pruning(
+            directory_monitor.checker(config, receiver, stats=stats.scoped("config")),
+            receiver,
+        )
+    else:
+        receiver = process_events.Receiver(
+            procmon, window=restartWindow, reactor=reactor, publisher=statusPublisher
+        )
+        confcheck = directory_monitor.checker(
+            config, receiver, stats=stats.scoped("config")
+        )
+    confserv = internet.TimerService(freq, stats.timed("config.tick", confcheck))
     confserv.setServiceParent(ret)
-    messagecheck = directory_monitor.messages(messages, receiver)
-    messageserv = internet.TimerService(freq, messagecheck)
+    if inotify:
+        confwatch = directory_monitor.Watcher(config, confcheck, reactor)
+        confwatch.setName("confwatch")
+        confwatch.setServiceParent(ret)
+    messagecheck = directory_monitor.messages(
+        messages, receiver, stats=stats.scoped("messages")
+    )
+    messageserv = internet.TimerService(
+        freq, stats.timed("messages.tick", messagecheck)
+    )
     messageserv.setServiceParent(ret)
+    if inotify:
+        messagewatch = directory_monitor.Watcher(
+            messages, messagecheck, reactor, mask=directory_monitor.MESSAGES_MASK
+        )
+        messagewatch.setName("messagewatch")
+        messagewatch.setServiceParent(ret)
     procmon.setServiceParent(ret)
+    if metrics is not None:
+        gathered = metricslib.Metrics(
+            procmon, receiver, metricsPublisher, stats, messages
+        )
+        metricslib.makeService(metrics, gathered).setServiceParent(ret)
     return ret
 
 
+# pylint: enable=too-many-arguments,too-many-locals,too-many-statements
+
+
 # pylint: disable=too-few-public-methods
 
 
@@ -100,11 +375,30 @@ class Options(usage.Options):
 
     """Options for ncolony service"""
 
+    optFlags = [
+        ["inotify", None, "Watch for updates with inotify, where available"],
+    ]
+
     optParameters = [
         ["config", None, None, "Directory for configuration"],
         ["messages", None, None, "Directory for messages"],
         ["frequency", None, 10, "Frequency of checking for updates", float],
         ["pid", None, None, "Directory of PID files"],
+        ["pid-index", None, None, "File with all PIDs, as JSON"],
+        ["pid-delay", None, 0, "Seconds to gather PID changes for", float],
+        ["status-table", None, None, "File to publish a status table in"],
+        ["status-capacity", None, 4096, "Most processes in the status table", int],
+        [
+            "restart-window",
+            None,
+            0,
+            "Seconds to gather restart requests before acting on them",
+            float,
+        ],
+        ["shards", None, 0, "Number of worker supervisors to run processes with", int],
+        ["shard-root", None, None, "Directory for the workers' directories"],
+        ["stats", None, None, "File to write event loop stats to"],
+        ["metrics", None, None, "Endpoint to serve metrics on"],
     ] + procmontap.Options.optParameters
 
     def postOptions(self):
@@ -112,28 +406,68 @@ class Options(usage.Options):
         for param in ("messages", "config"):
             if self[param] is None:
                 raise usage.UsageError("Missing required", param)
+        if self["shards"] and self["shard-root"] is None:
+            raise usage.UsageError("Missing required", "shard-root")
+        for param in ("pid-index", "status-table", "metrics"):
+            if self["shards"] and self[param] is not None:
+                raise usage.UsageError("Cannot use with shards", param)
 
 
 # pylint: enable=too-few-public-methods
 
 
+def _maybePath(name):
+    if name is None:
+        return None
+    return filepath.FilePath(name)
+
+
 def makeService(opt):
     """Return a service based on parsed command-line options
 
     :param opt: dict-like object. Relevant keys are config, messages,
-                pid, frequency, threshold, killtime, minrestartdelay
-                and maxrestartdelay
+                pid, pid-index, pid-delay, status-table, status-capacity,
+                frequency, inotify, restart-window, threshold, killtime,
+                minrestartdelay, maxrestartdelay, shards, shard-root,
+                stats and metrics
     :returns: service, {twisted.application.interfaces.IService}
     """
+    shardArgs = []
+    pidDir = opt["pid"]
+    killTime = opt["killtime"]
+    if opt["shards"]:
+        for param in ("threshold", "killtime", "minrestartdelay", "maxrestartdelay"):
+            shardArgs.extend(["--" + param, str(opt[param])])
+        shardArgs.extend(["--restart-window", str(opt["restart-window"])])
+        if opt["inotify"]:
+            shardArgs.append("--inotify")
+        if pidDir is not None:
+            shardArgs.extend(["--pid", pidDir, "--pid-delay", str(opt["pid-delay"])])
+            pidDir = None
+        # Give the workers time to stop their processes
+        killTime *= 2
+    stats = instrument.maybeStats(opt["stats"])
     ret = get(
         config=opt["config"],
         messages=opt["messages"],
-        pidDir=opt["pid"],
+        pidDir=_maybePath(pidDir),
+        pidIndex=_maybePath(opt["pid-index"]),
+        pidDelay=opt["pid-delay"],
+        statusTable=opt["status-table"],
+        statusCapacity=opt["status-capacity"],
         freq=opt["frequency"],
+        inotify=opt["inotify"],
+        restartWindow=opt["restart-window"],
+        shards=opt["shards"],
+        shardRoot=opt["shard-root"],
+        shardArgs=shardArgs,
+        stats=stats,
+        metrics=opt["metrics"],
     )
+    instrument.maybeAddService(ret, stats, opt["stats"], tireactor)
     pm = ret.getServiceNamed("procmon")
     pm.threshold = opt["threshold"]
-    pm.killTime = opt["killtime"]
+    pm.killTime = killTime
     pm.minRestartDelay = opt["minrestartdelay"]
     pm.maxRestartDelay = opt["maxrestartdelay"]
     return ret
@@ -0,0 +1,156 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.shard
+================
+
+Spread processes over several supervisors.
+
+A front-end supervisor reads the configuration and messages directories
+as usual, but instead of running processes, it copies each configuration
+file into the configuration directory of one of several worker
+supervisors (chosen by a hash of the name), and passes messages on to
+the workers that need them. Each worker is a regular ncolony supervisor,
+with its own process monitor, and is itself run by the front-end's
+process monitor.
+"""
+
+import functools
+import json
+import os
+import zlib
+
+from zope import interface
+
+from twisted.python import filepath, log
+
+from ncolony import ctllib, interfaces
+
+
+def shardFor(name, count):
+    """Find which shard a process belongs to
+
+    :param name: string, the name of the process
+    :param count: integer, the number of shards
+    :returns: integer, between 0 and count-1
+    """
+    return zlib.crc32(name.encode("utf-8")) % count
+
+
+def makePlaces(root, count):
+    """Create the directories of the workers
+
+    :param root: string, directory to hold the workers' directories
+    :param count: integer, the number of workers
+    :returns: list of ctllib.Places, one for each worker
+    """
+    ret = []
+    for index in range(count):
+        base = filepath.FilePath(root).child(str(index))
+        place = ctllib.Places(
+            config=base.child("config").path, messages=base.child("messages").path
+        )
+        for directory in place:
+            filepath.FilePath(directory).makedirs(ignoreExistingDirectory=True)
+        ret.append(place)
+    return ret
+
+
+@interface.implementer(
+    interfaces.IMonitorEventReceiver, interfaces.IMonitorEventUpdater
+)
+class Router:
+
+    """Pass events on to the worker supervisors
+
+    Configuration files are copied to the configuration directory
+    of the worker the process belongs to. Restarts of one process
+    are sent to that worker, and all other messages are sent to all
+    workers.
+
+    :params places: list of ctllib.Places, the workers' directories
+    """
+
+    def __init__(self, places):
+        self.places = places
+        self.names = set()
+        self.pruned = False
+
+    def _place(self, name):
+        return self.places[shardFor(name, len(self.places))]
+
+    def add(self, name, contents):
+        """Copy a process's configuration to its worker
+
+        :params name: string, name of process
+        :params contents: bytes, configuration
+        :returns: None
+        """
+        self.names.add(name)
+        config = filepath.FilePath(self._place(name).config)
+        config.child(name).setContent(contents)
+
+    update = add
+
+    def remove(self, name):
+        """Remove a process's configuration from its worker
+
+        :params name: string, name of process
+        :returns: None
+        """
+        self.names.discard(name)
+        config = filepath.FilePath(self._place(name).config)
+        try:
+            config.child(name).remove()
+        except FileNotFoundError:
+            pass
+
+    def message(self, contents):
+        """Send a message to the workers that need it
+
+        :params contents: bytes, the message
+        :returns: None
+        """
+        parsed = json.loads(contents.decode("utf-8"))
+        tp = parsed["type"]
+        if tp == "RESTART":
+            ctllib.addMessage(self._place(parsed["name"]), contents)
+        elif tp in ("RESTART-ALL", "RESTART-GROUP"):
+            for place in self.places:
+                ctllib.addMessage(place, contents)
+        else:
+            raise ValueError("unknown type", parsed)
+
+    def prune(self):
+        """Remove configurations the workers should not have
+
+        Those are configurations of processes that were removed while
+        the front-end was not running, or that belong to another worker
+        (because the number of workers changed).
+
+        :returns: None
+        """
+        self.pruned = True
+        for place in self.places:
+            for name in os.listdir(place.config):
+                if name.endswith(".new"):
+                    continue
+                if name in self.names and self._place(name) == place:
+                    continue
+                log.msg("Pruning configuration from worker: ", name, place.config)
+                os.remove(os.path.join(place.config, name))
+
+
+def _pruneAfter(check, router, names=None):
+    check(names)
+    if names is None and not router.pruned:
+        router.prune()
+
+
+def pruning(check, router):
+    """Prune the workers' configuration after the first full check
+
+    :params check: a function returned by directory_monitor.checker
+    :params router: a Router
+    :returns: a function with one optional parameter (names)
+    """
+    return functools.partial(_pruneAfter, check, router)
@@ -0,0 +1,271 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.statustable
+=====================
+
+A fixed-layout status table, shared through a memory-mapped file.
+
+The supervisor keeps a record for each process with its name, pid,
+start time and number of restarts. The heartbeat checker adds the
+time of the last heartbeat and the result of the last health check.
+Anything can read the state of all processes with one read of the file.
+
+The supervisor creates a new table when it starts.
+
+The file starts with a header (magic, version, capacity and record
+size), followed by :code:`capacity` fixed-size records. A record with
+an empty name is free. Each field is only written by one program, so
+the supervisor and the heartbeat checker can both write to the table.
+"""
+
+import collections
+import mmap
+import os
+import struct
+
+from twisted.python import log
+
+MAGIC = b"NCST"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+NAME = struct.Struct("<64s")
+PROCESS = struct.Struct("<qdq")
+HEALTH = struct.Struct("<dq")
+RECORD_SIZE = 128
+PROCESS_OFFSET = NAME.size
+HEALTH_OFFSET = PROCESS_OFFSET + PROCESS.size
+
+UNKNOWN, HEALTHY, UNHEALTHY = range(3)
+
+Status = collections.namedtuple("Status", "name pid start restarts heartbeat health")
+
+
+def _decodeName(raw):
+    return raw.rstrip(b"\0").decode("utf-8")
+
+
+def _parse(data):
+    magic, version, capacity, recordSize = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or recordSize != RECORD_SIZE:
+        raise ValueError("not a status table", magic, version, recordSize)
+    ret = {}
+    for slot in range(capacity):
+        offset = HEADER.size + slot * RECORD_SIZE
+        (name,) = NAME.unpack_from(data, offset)
+        if not name.strip(b"\0"):
+            continue
+        name = _decodeName(name)
+        pid, start, restarts = PROCESS.unpack_from(data, offset + PROCESS_OFFSET)
+        heartbeat, health = HEALTH.unpack_from(data, offset + HEALTH_OFFSET)
+        ret[name] = Status(name, pid, start, restarts, heartbeat, health)
+    return ret
+
+
+def read(path):
+    """Read the status of all processes
+
+    :param path: string, location of the table
+    :returns: dict mapping names to Status
+    """
+    with open(path, "rb") as fp:
+        return _parse(fp.read())
+
+
+def create(path, capacity=4096):
+    """Create an empty status table, replacing any existing one
+
+    :param path: string, location of the table
+    :param capacity: integer, the most processes the table can hold
+    :returns: None
+    """
+    temp = path + ".new"
+    with open(temp, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, capacity, RECORD_SIZE))
+        fp.truncate(HEADER.size + capacity * RECORD_SIZE)
+    os.rename(temp, path)
+
+
+class StatusTable:
+
+    """A status table that can be written to
+
+    The table is opened, and the records in it found, on
+    :code:`refresh`. If the table is replaced, the new one is opened
+    on the next refresh. Until the table is opened, writes are ignored.
+
+    :param path: string, location of the table
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.capacity = 0
+        self._map = None
+        self._inode = None
+        self._slots = {}
+        self._free = []
+
+    def refresh(self):
+        """Open the table if it was replaced, and find the records in it
+
+        :returns: None
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self._inode:
+            self.close()
+            with open(self.path, "r+b") as fp:
+                self._map = mmap.mmap(fp.fileno(), 0)
+            self._inode = inode
+            _, _, self.capacity, _ = HEADER.unpack_from(self._map)
+        self._slots = {}
+        self._free = []
+        for slot in reversed(range(self.capacity)):
+            (name,) = NAME.unpack_from(self._map, self._offset(slot))
+            if name.strip(b"\0"):
+                self._slots[_decodeName(name)] = slot
+            else:
+                self._free.append(slot)
+
+    def _offset(self, slot):
+        return HEADER.size + slot * RECORD_SIZE
+
+    def _find(self, name):
+        slot = self._slots.get(name)
+        if slot is None:
+            return None
+        (current,) = NAME.unpack_from(self._map, self._offset(slot))
+        if _decodeName(current) != name:
+            return None
+        return slot
+
+    def add(self, name):
+        """Add a record for a process, unless there is one
+
+        :param name: string, name of process
+        :returns: None
+        """
+        if self._find(name) is not None:
+            return
+        encoded = name.encode("utf-8")
+        if len(encoded) > NAME.size:
+            log.msg("Name too long for status table: ", name)
+            return
+        if not self._free:
+            log.msg("Status table full or not open, not adding: ", name)
+            return
+        slot = self._free.pop()
+        offset = self._offset(slot)
+        self._map[offset : offset + RECORD_SIZE] = bytes(RECORD_SIZE)
+        NAME.pack_into(self._map, offset, encoded)
+        self._slots[name] = slot
+
+    def remove(self, name):
+        """Remove the record of a process
+
+        :param name: string, name of process
+        :returns: None
+        """
+        slot = self._find(name)
+        if slot is None:
+            return
+        offset = self._offset(slot)
+        self._map[offset : offset + RECORD_SIZE] = bytes(RECORD_SIZE)
+        del self._slots[name]
+        self._free.append(slot)
+
+    def setProcess(self, name, pid, start, restarts):
+        """Set the supervisor's fields of a record
+
+        :param name: string, name of process
+        :param pid: integer, or 0 if the process is not running
+        :param start: number, time the process was last started
+        :param restarts: integer, number of times the process was restarted
+        :returns: None
+        """
+        slot = self._find(name)
+        if slot is None:
+            return
+        offset = self._offset(slot) + PROCESS_OFFSET
+        PROCESS.pack_into(self._map, offset, pid, start, restarts)
+
+    def setHealth(self, name, heartbeat, health):
+        """Set the heartbeat checker's fields of a record
+
+        :param name: string, name of process
+        :param heartbeat: number, time of the last heartbeat, or 0
+        :param health: HEALTHY, UNHEALTHY or UNKNOWN
+        :returns: None
+        """
+        slot = self._find(name)
+        if slot is None:
+            return
+        offset = self._offset(slot) + HEALTH_OFFSET
+        HEALTH.pack_into(self._map, offset, heartbeat, health)
+
+    def close(self):
+        """Stop using the table"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._inode = None
+            self._slots = {}
+            self._free = []
+
+
+class StatusPublisher:
+
+    """Keep the supervisor's fields of a status table up to date
+
+    This is a publisher for :code:`ncolony.service.PublishingDict`:
+    it is told when a process protocol is added (the process started)
+    and removed (the process ended). The pid is filled in once the
+    process was spawned.
+
+    :param reactor: IReactorTime
+    :param table: a StatusTable
+    """
+
+    def __init__(self, reactor, table):
+        self.reactor = reactor
+        self.table = table
+        self.starts = {}
+        self.restarts = collections.Counter()
+        self._started = {}
+        self._call = None
+
+    def set(self, name, value):
+        """A process started"""
+        self.table.add(name)
+        if name in self.starts:
+            self.restarts[name] += 1
+        self.starts[name] = self.reactor.seconds()
+        self._started[name] = value
+        if self._call is None:
+            self._call = self.reactor.callLater(0, self._fill)
+
+    def delete(self, name):
+        """A process ended"""
+        self._started.pop(name, None)
+        self._write(name, 0)
+
+    def forget(self, name):
+        """A process is no longer monitored"""
+        self.starts.pop(name, None)
+        self.restarts.pop(name, None)
+        self._started.pop(name, None)
+        self.table.remove(name)
+
+    def _write(self, name, pid):
+        if name not in self.starts:
+            # Forgotten while running: the process ends after removal
+            return
+        self.table.setProcess(name, pid, self.starts[name], self.restarts[name])
+
+    def _fill(self):
+        self._call = None
+        started, self._started = self._started, {}
+        for name, value in started.items():
+            transport = getattr(value, "transport", None)
+            self._write(name, getattr(transport, "pid", None) or 0)
@@ -0,0 +1,308 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Benchmarks for ncolony
+
+Usually run as
+
+$ python -m ncolony.tests.benchmark config --count 10000
+$ python -m ncolony.tests.benchmark messages
+$ python -m ncolony.tests.benchmark shards --counts 100,1000,20000 --shards 0,8
+
+Each subcommand prints one line per measurement.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from zope import interface
+
+from twisted.internet import defer, task
+
+from ncolony import ctllib
+from ncolony import directory_monitor
+from ncolony import interfaces
+
+
+@interface.implementer(interfaces.IMonitorEventReceiver)
+class _Timestamps:
+
+    """Receiver that notes when events arrive"""
+
+    def __init__(self):
+        self.waiting = {}
+
+    def expect(self, name):
+        """Return a deferred that fires with the time name is added"""
+        d = self.waiting[name] = defer.Deferred()
+        return d
+
+    def add(self, name, contents):
+        """Fire the deferred waiting for this name, if any"""
+        d = self.waiting.pop(name, None)
+        if d is not None:
+            d.callback(time.monotonic())
+
+    def remove(self, name):
+        """Ignore removals"""
+
+    def message(self, contents):
+        """Fire the deferred waiting for messages, if any"""
+        self.add(None, contents)
+
+
+def _populate(location, count, size=0):
+    old = time.time() - 3600
+    for i in range(count):
+        content = json.dumps(dict(args=["/bin/true", str(i)], padding="x" * size))
+        fname = os.path.join(location, "proc%05d" % i)
+        with open(fname, "w") as fp:
+            fp.write(content)
+        os.utime(fname, (old, old))
+
+
+def _report(what, value, unit):
+    print("%-40s %12.3f %s" % (what, value, unit))
+    sys.stdout.flush()
+
+
+def _sleep(reactor, seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+@defer.inlineCallbacks
+def _latency(reactor, location, receiver, changes):
+    total = worst = 0
+    for i in range(changes):
+        name = "proc%05d" % i
+        d = receiver.expect(name)
+        yield _sleep(reactor, 0.137)
+        start = time.monotonic()
+        with open(os.path.join(location, name), "w") as fp:
+            fp.write(json.dumps(dict(args=["/bin/false", str(start)])))
+        end = yield d
+        total += end - start
+        worst = max(worst, end - start)
+    return total / changes, worst
+
+
+@defer.inlineCallbacks
+def _idleCPU(reactor, idle):
+    before = time.process_time()
+    yield _sleep(reactor, idle)
+    return (time.process_time() - before) / idle * 100
+
+
+@defer.inlineCallbacks
+def config(reactor, args):
+    """Polling versus inotify when watching the configuration directory"""
+    location = tempfile.mkdtemp()
+    try:
+        _populate(location, args.count, args.size)
+        receiver = _Timestamps()
+        check = directory_monitor.checker(location, receiver)
+        tracemalloc.start()
+        start = time.monotonic()
+        check()
+        _report("initial scan", (time.monotonic() - start) * 1000, "ms")
+        _report("checker memory", tracemalloc.get_traced_memory()[0] / 2**20, "MiB")
+        tracemalloc.stop()
+        start = time.process_time()
+        for _ in range(args.ticks):
+            check()
+        elapsed = (time.process_time() - start) / args.ticks
+        _report("idle poll tick (CPU)", elapsed * 1000, "ms")
+        poller = task.LoopingCall(check)
+        poller.clock = reactor
+        poller.start(args.frequency, now=False)
+        cpu = yield _idleCPU(reactor, args.idle)
+        _report("idle CPU, polling every %ss" % args.frequency, cpu, "%")
+        mean, worst = yield _latency(reactor, location, receiver, args.changes)
+        _report("change-to-add, polling (mean)", mean * 1000, "ms")
+        _report("change-to-add, polling (max)", worst * 1000, "ms")
+        poller.stop()
+        watcher = directory_monitor.Watcher(location, check, reactor)
+        watcher.startService()
+        cpu = yield _idleCPU(reactor, args.idle)
+        _report("idle CPU, inotify", cpu, "%")
+        mean, worst = yield _latency(reactor, location, receiver, args.changes)
+        _report("change-to-add, inotify (mean)", mean * 1000, "ms")
+        _report("change-to-add, inotify (max)", worst * 1000, "ms")
+        watcher.stopService()
+    finally:
+        shutil.rmtree(location)
+
+
+@defer.inlineCallbacks
+def _messageLatency(reactor, places, receiver, count):
+    total = worst = 0
+    for _ in range(count):
+        d = receiver.expect(None)
+        yield _sleep(reactor, 0.137)
+        start = time.monotonic()
+        ctllib.restart(places, "proc")
+        end = yield d
+        total += end - start
+        worst = max(worst, end - start)
+    # Let the message be removed before going on
+    yield _sleep(reactor, 0)
+    return total / count, worst
+
+
+@defer.inlineCallbacks
+def messages(reactor, args):
+    """Polling versus inotify when waiting for restart messages"""
+    location = tempfile.mkdtemp()
+    try:
+        places = ctllib.Places(config=location, messages=location)
+        receiver = _Timestamps()
+        check = directory_monitor.messages(location, receiver)
+        poller = task.LoopingCall(check)
+        poller.clock = reactor
+        poller.start(args.frequency, now=False)
+        mean, worst = yield _messageLatency(reactor, places, receiver, args.count)
+        _report("restart latency, polling (mean)", mean * 1000, "ms")
+        _report("restart latency, polling (max)", worst * 1000, "ms")
+        poller.stop()
+        watcher = directory_monitor.Watcher(
+            location, check, reactor, mask=directory_monitor.MESSAGES_MASK
+        )
+        watcher.startService()
+        mean, worst = yield _messageLatency(reactor, places, receiver, args.count)
+        _report("restart latency, inotify (mean)", mean * 1000, "ms")
+        _report("restart latency, inotify (max)", worst * 1000, "ms")
+        watcher.stopService()
+    finally:
+        shutil.rmtree(location)
+
+
+def _running(marker):
+    ret = set()
+    for pid in os.listdir("/proc"):
+        try:
+            with open("/proc/%s/cmdline" % pid, "rb") as fp:
+                cmdline = fp.read()
+        except (IOError, ValueError):
+            continue
+        if cmdline.endswith(marker):
+            ret.add(pid)
+    return ret
+
+
+@defer.inlineCallbacks
+def _until(reactor, condition):
+    start = time.monotonic()
+    while not condition():
+        yield _sleep(reactor, 0.25)
+    return time.monotonic() - start
+
+
+def _cpuSeconds(pid):
+    with open("/proc/%d/stat" % pid) as fp:
+        ticks = sum(map(int, fp.read().split()[13:15]))
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _supervisorCommand(args, places, shards, location):
+    command = [sys.executable, "-m", "twisted", "ncolony", "--inotify"]
+    command.extend(["--config", places.config, "--messages", places.messages])
+    command.extend(["--frequency", str(args.frequency)])
+    if shards:
+        command.extend(["--shards", str(shards)])
+        command.extend(["--shard-root", os.path.join(location, "shards")])
+    return command
+
+
+@defer.inlineCallbacks
+def _supervise(reactor, args, count, shards):
+    location = tempfile.mkdtemp()
+    marker = ("%d" % (10**6 + os.getpid())).encode("ascii") + b"\0"
+    try:
+        places = ctllib.Places(
+            config=os.path.join(location, "config"),
+            messages=os.path.join(location, "messages"),
+        )
+        for directory in places:
+            os.mkdir(directory)
+        for i in range(count):
+            ctllib.add(places, "proc%05d" % i, "/bin/sleep", [marker[:-1].decode()])
+        label = "%d processes, %d shards:" % (count, shards)
+        command = _supervisorCommand(args, places, shards, location)
+        with subprocess.Popen(command, stdout=subprocess.DEVNULL) as supervisor:
+            try:
+                elapsed = yield _until(reactor, lambda: len(_running(marker)) >= count)
+                _report(label + " start", elapsed, "s")
+                before = _running(marker)
+                ctllib.restartAll(places)
+                elapsed = yield _until(
+                    reactor,
+                    lambda: not (_running(marker) & before)
+                    and len(_running(marker)) >= count,
+                )
+                _report(label + " restart-all", elapsed, "s")
+                before = _cpuSeconds(supervisor.pid)
+                yield _sleep(reactor, args.idle)
+                _report(
+                    label + " idle front-end CPU",
+                    (_cpuSeconds(supervisor.pid) - before) / args.idle * 100,
+                    "%",
+                )
+            finally:
+                supervisor.send_signal(signal.SIGTERM)
+                yield _until(reactor, lambda: supervisor.poll() is not None)
+                for pid in _running(marker):
+                    os.kill(int(pid), signal.SIGKILL)
+    finally:
+        shutil.rmtree(location)
+
+
+@defer.inlineCallbacks
+def scaling(reactor, args):
+    """Supervising many processes, with and without worker supervisors"""
+    for count in args.counts:
+        for shardCount in args.shards:
+            yield _supervise(reactor, args, count, shardCount)
+
+
+def _integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+PARSER = argparse.ArgumentParser()
+_subparsers = PARSER.add_subparsers()
+_config_parser = _subparsers.add_parser("config")
+_config_parser.add_argument("--count", type=int, default=10000)
+_config_parser.add_argument("--size", type=int, default=1000)
+_config_parser.add_argument("--frequency", type=float, default=1)
+_config_parser.add_argument("--ticks", type=int, default=10)
+_config_parser.add_argument("--idle", type=float, default=5)
+_config_parser.add_argument("--changes", type=int, default=5)
+_config_parser.set_defaults(func=config)
+_messages_parser = _subparsers.add_parser("messages")
+_messages_parser.add_argument("--frequency", type=float, default=1)
+_messages_parser.add_argument("--count", type=int, default=20)
+_messages_parser.set_defaults(func=messages)
+_shards_parser = _subparsers.add_parser("shards")
+_shards_parser.add_argument("--counts", type=_integers, default=[100, 1000, 20000])
+_shards_parser.add_argument("--shards", type=_integers, default=[0, 8])
+_shards_parser.add_argument("--frequency", type=float, default=1)
+_shards_parser.add_argument("--idle", type=float, default=5)
+_shards_parser.set_defaults(func=scaling)
+
+
+def main(argv):
+    """Run the benchmark named on the command line"""
+    args = PARSER.parse_args(argv)
+    task.react(args.func, (args,))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
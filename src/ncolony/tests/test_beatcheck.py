@@ -12,8 +12,9 @@ import unittest
 from twisted.python import filepath, usage
 
 from twisted.application import internet as tainternet
+from twisted.internet import defer, reactor, task
 
-from ncolony import beatcheck, ctllib
+from ncolony import beatcheck, ctllib, instrument, scanner, statustable
 from ncolony.client.tests import test_heart
 from ncolony.tests import helper
 
@@ -145,6 +146,45 @@ class TestBeatChecker(unittest.TestCase):
         self.assertFalse(self.checker(mtime, mtime))
         self.assertEqual(set(self.checker(mtime, mtime + 11)), set(["foo", "bar"]))
 
+    def test_status_table(self):
+        """Test heartbeats and health are recorded in a status table"""
+        tablePath = os.path.join(self.status, "table")
+        statustable.create(tablePath)
+        table = statustable.StatusTable(tablePath)
+        self.addCleanup(table.close)
+        writer = statustable.StatusTable(tablePath)
+        self.addCleanup(writer.close)
+        writer.refresh()
+        for name in ["foo", "bar", "baz"]:
+            writer.add(name)
+        for name, status in [
+            ("foo", self.status),
+            ("bar", os.path.join(self.status, "bar")),
+        ]:
+            check = {"ncolony.beatcheck": {"period": 10, "grace": 1, "status": status}}
+            self.filepath.child(name).setContent(helper.dumps2utf8(check))
+        self.filepath.child("baz").setContent(helper.dumps2utf8({}))
+        mtime = self.filepath.child("foo").getModificationTime()
+        statusFile = filepath.FilePath(self.status).child("foo")
+        statusFile.setContent(b"111")
+        os.utime(statusFile.path, (mtime + 5, mtime + 5))
+        checker = functools.partial(beatcheck.check, self.filepath, table=table)
+        self.assertEqual(checker(mtime, mtime + 11), ["bar"])
+        states = statustable.read(tablePath)
+        self.assertEqual(states["foo"].heartbeat, mtime + 5)
+        self.assertEqual(states["foo"].health, statustable.HEALTHY)
+        self.assertEqual(states["bar"].heartbeat, 0)
+        self.assertEqual(states["bar"].health, statustable.UNHEALTHY)
+        self.assertEqual(states["baz"].health, statustable.UNKNOWN)
+
+    def test_status_directory_missing(self):
+        """Test a status directory without the process's file"""
+        check = {"ncolony.beatcheck": {"period": 10, "grace": 1, "status": self.status}}
+        fooFile = self.filepath.child("foo")
+        fooFile.setContent(helper.dumps2utf8(check))
+        mtime = fooFile.getModificationTime()
+        self.assertEqual(self.checker(mtime, mtime + 20), ["foo"])
+
     def test_run(self):
         """Test the runner"""
         _checker_args = []
@@ -171,29 +211,411 @@ class TestBeatChecker(unittest.TestCase):
         masterService = beatcheck.makeService(opt)
         service = masterService.getServiceNamed("beatcheck")
         after = time.time()
-        self.assertIsInstance(service, tainternet.TimerService)
+        self.assertIsInstance(service, beatcheck.Scheduler)
         self.assertEqual(service.step, 5)
-        callableThing, args, kwargs = service.call
-        self.assertIs(callableThing, beatcheck.run)
-        self.assertFalse(kwargs)
-        restarter, checker, timer = args
-        self.assertIs(timer, time.time)
+        self.assertIs(service.clock, reactor)
+        self.assertIsNone(service.table)
+        self.assertIs(masterService.getServiceNamed("scanner"), service.scanner)
+        self.assertEqual(service.scanner.timeout, 5)
+        self.assertEqual(service.scanner.pool.max, 4)
+        restarter = service.restarter
         self.assertIs(restarter.func, ctllib.restart)
         self.assertFalse(restarter.keywords)
         (places,) = restarter.args
         self.assertEqual(places, ctllib.Places(config="config", messages="messages"))
-        self.assertIs(checker.func, beatcheck.check)
-        self.assertFalse(checker.keywords)
-        path, start = checker.args
-        self.assertEqual(path.basename(), "config")
-        self.assertLessEqual(before, start)
-        self.assertLessEqual(start, after)
+        self.assertEqual(service.path.basename(), "config")
+        self.assertLessEqual(before, service.epoch)
+        self.assertLessEqual(service.epoch, after)
+
+    def test_make_service_status_table(self):
+        """Test makeService with a status table"""
+        opt = {"config": "config", "messages": "messages", "freq": 5}
+        opt["status-table"] = "status-table"
+        opt["scan-threads"] = 2
+        opt["scan-timeout"] = 1
+        masterService = beatcheck.makeService(opt)
+        service = masterService.getServiceNamed("beatcheck")
+        self.assertEqual(service.table.path, "status-table")
+        self.assertEqual(service.scanner.timeout, 1)
+        self.assertEqual(service.scanner.pool.max, 2)
+
+    def test_make_service_stats(self):
+        """Test makeService writing stats"""
+        opt = {"config": "config", "messages": "messages", "freq": 5}
+        opt["stats"] = "stats.json"
+        masterService = beatcheck.makeService(opt)
+        service = masterService.getServiceNamed("beatcheck")
+        statsFile = masterService.getServiceNamed("stats")
+        self.assertEqual(statsFile.path, "stats.json")
+        self.assertIs(service.stats.stats, statsFile.stats)
+        self.assertIs(masterService.getServiceNamed("lag").stats, statsFile.stats)
+
+    def test_make_service_socket(self):
+        """Test makeService listening for heartbeats on a socket"""
+        address = os.path.abspath("dummy-beats")
+        opt = {"config": "config", "messages": "messages", "freq": 5}
+        opt["socket"] = address
+        masterService = beatcheck.makeService(opt)
+        scheduler = masterService.getServiceNamed("beatcheck")
+        listener = masterService.getServiceNamed("beats")
+        self.assertIsInstance(listener, tainternet.UNIXDatagramServer)
+        path, beats = listener.args
+        self.assertEqual(path, address)
+        self.assertIs(beats.scheduler, scheduler)
+        listener.startService()
+        self.addCleanup(os.remove, address)
+        listener.stopService()
+        self.assertTrue(os.path.exists(address))
+        masterService = beatcheck.makeService(opt)
+        self.assertTrue(os.path.exists(address))
+        listener = masterService.getServiceNamed("beats")
+        listener.startService()
+        listener.stopService()
 
     def test_make_service_with_health(self):
         """Test beatcheck with heart beater"""
         testWrappedHeart(self, beatcheck.makeService)
 
 
+class ControlledScanner:
+
+    """A scanner whose reads finish when told to"""
+
+    def __init__(self):
+        self.pending = {}
+        self.busy = set()
+
+    def run(self, key, func, *args):
+        """Start a read"""
+        if key in self.busy or key in self.pending:
+            return defer.fail(scanner.BusyError(key))
+        d = defer.Deferred()
+        self.pending[key] = (d, func, args)
+        return d
+
+    def finish(self, key):
+        """Finish a read"""
+        d, func, args = self.pending.pop(key)
+        d.callback(func(*args))
+
+    def fail(self, key, error):
+        """Fail a read"""
+        d, _, _ = self.pending.pop(key)
+        d.errback(error)
+
+
+class TestStatusReader(unittest.TestCase):
+
+    """Test reading heartbeat times"""
+
+    def setUp(self):
+        self.status = os.path.abspath("dummy-status")
+        shutil.rmtree(self.status, ignore_errors=True)
+        os.makedirs(self.status)
+        self.addCleanup(shutil.rmtree, self.status, ignore_errors=True)
+        self.reader = beatcheck.StatusReader()
+
+    def beat(self, name, when):
+        """Pretend a process sent a heartbeat"""
+        status = os.path.join(self.status, name)
+        filepath.FilePath(status).touch()
+        os.utime(status, (when, when))
+        return status
+
+    def test_directory(self):
+        """A status directory is read once processes share it"""
+        for when, name in enumerate(["a", "b", "c"], 1000):
+            self.beat(name, when)
+        os.symlink("nowhere", os.path.join(self.status, "dangling"))
+        self.assertEqual(self.reader.lastBeat(self.status, "a"), 1000)
+        self.assertEqual(self.reader.lastBeat(self.status, "b"), 1001)
+        os.remove(os.path.join(self.status, "c"))
+        self.beat("d", 1003)
+        self.assertEqual(self.reader.lastBeat(self.status, "c"), 1002)
+        self.assertIsNone(self.reader.lastBeat(self.status, "d"))
+        self.assertIsNone(self.reader.lastBeat(self.status, "dangling"))
+
+    def test_directory_removed(self):
+        """A status directory that disappeared has no heartbeats"""
+        self.beat("a", 1000)
+        self.assertEqual(self.reader.lastBeat(self.status, "a"), 1000)
+        shutil.rmtree(self.status)
+        self.assertIsNone(self.reader.lastBeat(self.status, "a"))
+
+    def test_file(self):
+        """A status file is its process's heartbeat"""
+        status = self.beat("a", 1000)
+        self.assertEqual(self.reader.lastBeat(status, "a"), 1000)
+        os.utime(status, (1001, 1001))
+        self.assertEqual(self.reader.lastBeat(status, "a"), 1001)
+
+    def test_missing(self):
+        """A missing status has no heartbeat"""
+        missing = os.path.join(self.status, "missing")
+        self.assertIsNone(self.reader.lastBeat(missing, "a"))
+
+
+class TestScheduler(unittest.TestCase):
+
+    """Test checking heartbeats at their deadlines"""
+
+    def setUp(self):
+        self.path = os.path.abspath("dummy-config")
+        self.status = os.path.abspath("dummy-status")
+        paths = (self.path, self.status)
+
+        def _cleanup():
+            for path in paths:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+
+        _cleanup()
+        self.addCleanup(_cleanup)
+        for path in paths:
+            os.makedirs(path)
+        self.filepath = filepath.FilePath(self.path)
+        self.restarted = []
+        self.clock = task.Clock()
+        self.mtime = self.configure("foo", period=10, grace=3)
+        self.clock.advance(self.mtime)
+        self.scheduler = beatcheck.Scheduler(
+            5, self.clock, self.filepath, self.mtime, self.restarted.append
+        )
+
+    def configure(self, name, **params):
+        """Write a configuration, and return its modification time"""
+        params["status"] = self.status
+        config = self.filepath.child(name)
+        config.setContent(helper.dumps2utf8({"ncolony.beatcheck": params}))
+        return config.getModificationTime()
+
+    def beat(self, name, when):
+        """Pretend a process sent a heartbeat"""
+        status = os.path.join(self.status, name)
+        filepath.FilePath(status).touch()
+        os.utime(status, (when, when))
+
+    def nextWakeup(self):
+        """When the scheduler will next wake up"""
+        (call,) = self.clock.getDelayedCalls()
+        return call.getTime()
+
+    def test_deadlines(self):
+        """Processes are checked, and restarted, at their deadlines"""
+        self.scheduler.scan()
+        self.assertEqual(self.nextWakeup(), self.mtime + 30)
+        self.clock.advance(29.5)
+        self.assertEqual(self.restarted, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertEqual(self.nextWakeup(), self.mtime + 60)
+        self.beat("foo", self.mtime + 55)
+        self.clock.advance(30)
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertEqual(self.nextWakeup(), self.mtime + 65)
+        self.clock.advance(5)
+        self.assertEqual(self.restarted, ["foo", "foo"])
+
+    def test_stats(self):
+        """Time spent on each phase of a check is recorded"""
+        stats = instrument.Stats()
+        scheduler = beatcheck.Scheduler(
+            5, self.clock, self.filepath, self.mtime, self.restarted.append, stats=stats
+        )
+        scheduler.startService()
+        self.clock.advance(30)
+        scheduler.stopService()
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertEqual(
+            sorted(stats.histograms),
+            [
+                "beatcheck.dispatch",
+                "beatcheck.heartbeats",
+                "beatcheck.parse",
+                "beatcheck.read",
+                "beatcheck.tick",
+            ],
+        )
+
+    def test_unchanged(self):
+        """Scanning unchanged configuration does not move deadlines"""
+        self.scheduler.scan()
+        self.clock.advance(20)
+        self.scheduler.scan()
+        self.assertEqual(len(self.scheduler.deadlines), 1)
+        self.assertEqual(self.nextWakeup(), self.mtime + 30)
+
+    def test_state(self):
+        """Configurations are only parsed again when their contents change"""
+        state = beatcheck.State(self.filepath.child("foo"))
+        content = helper.dumps2utf8({})
+        self.assertTrue(state.apply(scanner.Snapshot(None, 0, content)))
+        self.assertFalse(state.apply(scanner.Snapshot((1, 2, 3), 0, content)))
+        self.assertEqual(state.fingerprint, (1, 2, 3))
+        self.assertFalse(state.apply(scanner.Snapshot((1, 2, 3), 5, None)))
+        self.assertEqual(state.mtime, 5)
+
+    def test_changed(self):
+        """Changed configuration moves the deadline"""
+        self.scheduler.scan()
+        self.clock.advance(20)
+        mtime = self.configure("foo", period=100, grace=1)
+        self.scheduler.scan()
+        self.clock.advance(20)
+        self.assertEqual(self.restarted, [])
+        self.assertEqual(self.nextWakeup(), mtime + 100)
+
+    def test_removed(self):
+        """Removed processes, and processes without a heart, are not checked"""
+        self.configure("bar", period=10, grace=1)
+        self.scheduler.scan()
+        self.filepath.child("foo").remove()
+        self.filepath.child("bar").setContent(helper.dumps2utf8({}))
+        self.scheduler.scan()
+        self.clock.advance(100)
+        self.assertEqual(self.restarted, [])
+        self.assertEqual(list(self.scheduler.states), ["bar"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_overdue(self):
+        """Processes overdue when first seen are restarted at once"""
+        self.clock.advance(100)
+        self.scheduler.scan()
+        self.assertEqual(self.restarted, ["foo"])
+
+    def test_no_grace(self):
+        """Restarted processes without a grace period are checked every step"""
+        mtime = self.configure("foo", period=10, grace=0)
+        self.clock.advance(mtime - self.mtime)
+        self.scheduler.scan()
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertEqual(self.nextWakeup(), self.clock.seconds() + 5)
+
+    def test_status_table(self):
+        """Heartbeats and health are recorded when processes are checked"""
+        tablePath = os.path.join(self.status, "table")
+        statustable.create(tablePath)
+        table = statustable.StatusTable(tablePath)
+        self.addCleanup(table.close)
+        table.refresh()
+        table.add("foo")
+        self.scheduler.table = table
+        self.beat("foo", self.mtime)
+        self.scheduler.scan()
+        state = statustable.read(tablePath)["foo"]
+        self.assertEqual(state.heartbeat, self.mtime)
+        self.assertEqual(state.health, statustable.HEALTHY)
+        self.clock.advance(30)
+        state = statustable.read(tablePath)["foo"]
+        self.assertEqual(state.health, statustable.UNHEALTHY)
+
+    def test_socket_beats(self):
+        """Heartbeats in memory are used, and files only when they are old"""
+        self.scheduler.scan()
+        self.clock.advance(25)
+        self.scheduler.beat("foo")
+        self.scheduler.beat("bar")
+        self.assertEqual(list(self.scheduler.beats), ["foo"])
+        self.clock.advance(5)
+        self.assertEqual(self.restarted, [])
+        self.assertEqual(self.nextWakeup(), self.mtime + 35)
+        self.beat("foo", self.mtime + 33)
+        self.clock.advance(5)
+        self.assertEqual(self.restarted, [])
+        self.assertEqual(self.nextWakeup(), self.mtime + 43)
+        self.filepath.child("foo").remove()
+        self.scheduler.scan()
+        self.assertEqual(self.scheduler.beats, {})
+
+    def test_protocol(self):
+        """Datagrams with names are heartbeats"""
+        self.scheduler.scan()
+        beats = beatcheck.BeatProtocol(self.scheduler)
+        beats.datagramReceived(b"\xff", None)
+        self.assertEqual(self.scheduler.beats, {})
+        beats.datagramReceived(b"foo", None)
+        self.assertEqual(self.scheduler.beats, dict(foo=self.mtime))
+
+    def test_scanner(self):
+        """Configuration and heartbeats are read with the scanner, if needed"""
+        myScanner = self.scheduler.scanner = ControlledScanner()
+        self.scheduler.scan()
+        self.assertEqual(list(myScanner.pending), [self.path])
+        myScanner.finish(self.path)
+        self.assertEqual(list(myScanner.pending), ["heartbeats"])
+        self.assertEqual(self.scheduler.deadlines, [])
+        myScanner.finish("heartbeats")
+        self.assertEqual(self.nextWakeup(), self.mtime + 30)
+        # No files are read when all heartbeats needed are in memory
+        self.clock.advance(29)
+        self.scheduler.beat("foo")
+        self.clock.advance(1)
+        self.assertEqual(myScanner.pending, {})
+        self.assertEqual(self.restarted, [])
+
+    def test_scanner_busy(self):
+        """Checks are skipped, or retried, when reading takes too long"""
+        myScanner = self.scheduler.scanner = ControlledScanner()
+        myScanner.busy.add(self.path)
+        self.scheduler.scan()
+        self.assertEqual(self.scheduler.states, {})
+        myScanner.busy = set(["heartbeats"])
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        self.assertEqual(self.nextWakeup(), self.mtime + 5)
+        self.filepath.child("foo").remove()
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        self.assertEqual(self.scheduler.generations, {})
+
+    def test_due_while_reading(self):
+        """Processes due while heartbeats are read are checked after the read"""
+        myScanner = self.scheduler.scanner = ControlledScanner()
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        self.configure("bar", period=1, grace=1)
+        self.clock.advance(5)
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        self.assertEqual(list(myScanner.pending), ["heartbeats"])
+        myScanner.finish("heartbeats")
+        self.assertEqual(list(myScanner.pending), ["heartbeats"])
+        myScanner.finish("heartbeats")
+        self.assertEqual(self.restarted, ["bar"])
+        self.assertEqual(myScanner.pending, {})
+        self.assertEqual(self.nextWakeup(), self.mtime + 10)
+
+    def test_removed_while_reading(self):
+        """Processes removed while their heartbeats are read are not checked"""
+        myScanner = self.scheduler.scanner = ControlledScanner()
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        self.filepath.child("foo").remove()
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        myScanner.finish("heartbeats")
+        self.assertEqual(self.scheduler.deadlines, [])
+        self.assertEqual(self.restarted, [])
+        self.configure("foo", period=10, grace=3)
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        self.filepath.child("foo").remove()
+        self.scheduler.scan()
+        myScanner.finish(self.path)
+        myScanner.fail("heartbeats", defer.TimeoutError())
+        self.assertEqual(self.scheduler.deadlines, [])
+
+    def test_service(self):
+        """The scheduler scans every step, and stops waking up when stopped"""
+        self.scheduler.startService()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 2)
+        self.configure("bar", period=10, grace=1)
+        self.clock.advance(5)
+        self.assertEqual(sorted(self.scheduler.states), ["bar", "foo"])
+        self.scheduler.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
 def testWrappedHeart(utest, serviceMaker):
     """Service has a child heart beater"""
     opt = dict(config="config", messages="messages", freq=5)
@@ -228,6 +650,10 @@ class TestOptions(unittest.TestCase):
         self.assertEqual(self.opt["messages"], "message-dir")
         self.assertEqual(self.opt["config"], "config-dir")
         self.assertEqual(self.opt["freq"], 10)
+        self.assertIsNone(self.opt["status-table"])
+        self.assertIsNone(self.opt["socket"])
+        self.assertEqual(self.opt["scan-threads"], 4)
+        self.assertIsNone(self.opt["scan-timeout"])
 
     def test_freq(self):
         """Test explicit freq"""
@@ -0,0 +1,133 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.cron"""
+
+import datetime
+import os
+import time
+import unittest
+
+from ncolony import cron
+
+
+def useTimezone(testCase, name):
+    """Use a local timezone until the test is done"""
+    old = os.environ.get("TZ")
+
+    def _restore():
+        if old is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = old
+        time.tzset()
+
+    testCase.addCleanup(_restore)
+    os.environ["TZ"] = name
+    time.tzset()
+
+
+class TestParse(unittest.TestCase):
+
+    """Test parsing cron expressions"""
+
+    def test_fields(self):
+        """Values, ranges, steps and lists are understood"""
+        schedule = cron.parse("*/15 9-17/4 1,15 jan-mar,Dec 7")
+        self.assertEqual(schedule.minutes, (0, 15, 30, 45))
+        self.assertEqual(schedule.hours, {9, 13, 17})
+        self.assertEqual(schedule.days, {1, 15})
+        self.assertEqual(schedule.months, {1, 2, 3, 12})
+        self.assertEqual(schedule.weekdays, {0})
+        self.assertFalse(schedule.anyDay)
+        self.assertFalse(schedule.anyWeekday)
+        self.assertEqual(cron.parse("50/5 * * * sun").minutes, (50, 55))
+
+    def test_aliases(self):
+        """Aliases are expanded"""
+        self.assertEqual(cron.parse("@daily"), cron.parse("0 0 * * *"))
+        self.assertEqual(cron.parse(" @Hourly "), cron.parse("0 * * * *"))
+        self.assertNotEqual(cron.parse("@daily"), "0 0 * * *")
+        self.assertIn("Schedule", repr(cron.parse("@daily")))
+
+    def test_bad(self):
+        """Bad expressions are rejected"""
+        for expression in (
+            "* * * *",
+            "60 * * * *",
+            "5-1 * * * *",
+            "*/0 * * * *",
+            "* * 0 * *",
+            "* * * foo *",
+            "0 0 30 2 *",
+            "0 0 31 feb *",
+            "0 0 31 4,6,9,11 */2",
+        ):
+            with self.assertRaises(ValueError):
+                cron.parse(expression)
+
+    def test_rare(self):
+        """Expressions that are rarely due are accepted"""
+        self.assertEqual(cron.parse("0 0 29 2 *").days, {29})
+        self.assertEqual(cron.parse("0 0 31 2,3 *").months, {2, 3})
+        self.assertEqual(cron.parse("0 0 30 2 mon").weekdays, {1})
+
+
+class TestNext(unittest.TestCase):
+
+    """Test finding when an expression is next due"""
+
+    def assertNext(self, expression, after, expected):
+        """Check when an expression is next due"""
+        due = cron.parse(expression).next(datetime.datetime(*after))
+        self.assertEqual(due, datetime.datetime(*expected))
+
+    def test_minutes(self):
+        """The next due minute is found, in this hour or a later one"""
+        self.assertNext(
+            "*/15 * * * *", (2026, 10, 18, 12, 0, 30), (2026, 10, 18, 12, 15)
+        )
+        self.assertNext("*/15 * * * *", (2026, 10, 18, 12, 45), (2026, 10, 18, 13, 0))
+        self.assertNext("0 3 * * *", (2026, 10, 18, 12, 0), (2026, 10, 19, 3, 0))
+
+    def test_days(self):
+        """Days of month and week are matched as cron does"""
+        # 2026-10-18 is a Sunday
+        self.assertNext("0 9 * * mon-fri", (2026, 10, 17, 12), (2026, 10, 19, 9, 0))
+        self.assertNext("0 12 13 * fri", (2026, 10, 18), (2026, 10, 23, 12, 0))
+        self.assertNext("0 12 13 * *", (2026, 10, 18), (2026, 11, 13, 12, 0))
+        self.assertNext("0 0 29 2 *", (2026, 3, 1), (2028, 2, 29, 0, 0))
+
+    def test_months(self):
+        """Months that are not due are skipped, across years"""
+        self.assertNext("0 0 1 jan *", (2026, 10, 18), (2027, 1, 1, 0, 0))
+
+    def test_never(self):
+        """Expressions not due in the next few years fail"""
+        # The next February 29th that is a Sunday is in 2032
+        with self.assertRaises(ValueError):
+            cron.parse("0 0 29 2 */7").next(datetime.datetime(2026, 10, 18))
+
+    def test_next_time(self):
+        """Timestamps are in local time"""
+        after = datetime.datetime(2026, 10, 18, 12, 1).timestamp()
+        due = cron.parse("*/5 * * * *").nextTime(after)
+        self.assertEqual(due - after, 240)
+
+    def test_next_time_fall_back(self):
+        """When clocks go back, the next time is still later"""
+        useTimezone(self, "America/New_York")
+        schedule = cron.parse("*/5 * * * *")
+        # 01:31 the second time round, after the clocks went back
+        after = datetime.datetime(2026, 11, 1, 1, 31, fold=1).timestamp()
+        self.assertEqual(schedule.nextTime(after) - after, 240)
+        # 01:56 the first time round: 02:00 is an hour later than usual
+        after = datetime.datetime(2026, 11, 1, 1, 56).timestamp()
+        self.assertEqual(schedule.nextTime(after) - after, 3840)
+        # Only 01:30 each day: the second 01:30 has not passed yet
+        schedule = cron.parse("30 1 * * *")
+        after = datetime.datetime(2026, 11, 1, 1, 10, fold=1).timestamp()
+        self.assertEqual(schedule.nextTime(after) - after, 1200)
+        after = datetime.datetime(2026, 11, 1, 1, 40, fold=1).timestamp()
+        due = datetime.datetime(2026, 11, 2, 1, 30).timestamp()
+        self.assertEqual(schedule.nextTime(after), due)
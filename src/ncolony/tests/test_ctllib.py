@@ -5,12 +5,13 @@
 
 import argparse
 import io
+import time
 import json
 import os
 import shutil
 import unittest
 
-from ncolony import ctllib
+from ncolony import ctllib, statustable
 
 
 def jsonFrom(fname):
@@ -45,6 +46,22 @@ class TestArgParsing(unittest.TestCase):
         self.assertEqual(res.config, "config")
         self.assertIs(res.func, ctllib.restartAll)
 
+    def test_restart_all_rolling(self):
+        """Check restart-all subcommand parsing with rolling options"""
+        args = self.base + ["restart-all", "--batch", "5", "--health"]
+        res = self.parser.parse_args(args + ["--timeout", "30"])
+        self.assertEqual(res.batch, 5)
+        self.assertTrue(res.health)
+        self.assertEqual(res.timeout, 30)
+
+    def test_restart_group(self):
+        """Check restart-group subcommand parsing"""
+        res = self.parser.parse_args(self.base + ["restart-group", "web"])
+        self.assertEqual(res.group, "web")
+        self.assertIsNone(res.batch)
+        self.assertFalse(res.health)
+        self.assertIs(res.func, ctllib.restartGroup)
+
     def test_restart(self):
         """Check restart subcommand parsing"""
         res = self.parser.parse_args(self.base + ["restart", "hello"])
@@ -106,6 +123,12 @@ class TestArgParsing(unittest.TestCase):
         self.assertEqual(res.extras, extras)
         self.assertIs(res.func, ctllib.add)
 
+    def test_status(self):
+        """Check status subcommand parsing"""
+        res = self.parser.parse_args(self.base + ["status", "--table", "t"])
+        self.assertEqual(res.table, "t")
+        self.assertIs(res.func, ctllib.status)
+
     def test_remove(self):
         """Check remove subcommand parsing"""
         res = self.parser.parse_args(self.base + ["remove", "hello"])
@@ -264,6 +287,55 @@ class TestController(unittest.TestCase):
         d = jsonFrom(fname)
         self.assertEqual(d, dict(type="RESTART-ALL"))
 
+    def test_restart_all_rolling(self):
+        """Test that restart-all can ask for a rolling restart"""
+        ctllib.restartAll(self.places, batch=5, health=True, timeout=30)
+        (fname,) = os.listdir(self.places.messages)
+        fname = os.path.join(self.places.messages, fname)
+        d = jsonFrom(fname)
+        self.assertEqual(d, dict(type="RESTART-ALL", batch=5, health=True, timeout=30))
+
+    def test_restart_group(self):
+        """Test that restart-group works"""
+        ctllib.restartGroup(self.places, "web", batch=2)
+        (fname,) = os.listdir(self.places.messages)
+        fname = os.path.join(self.places.messages, fname)
+        d = jsonFrom(fname)
+        self.assertEqual(d, dict(type="RESTART-GROUP", group="web", batch=2))
+
+    def test_status(self):
+        """Test that status prints the status table"""
+        tablePath = os.path.join(self.places.config, "table")
+        statustable.create(tablePath)
+        table = statustable.StatusTable(tablePath)
+        self.addCleanup(table.close)
+        table.refresh()
+        table.add("hello")
+        table.add("goodbye")
+        start = time.mktime((2020, 1, 2, 3, 4, 5, 0, 0, -1))
+        table.setProcess("hello", 100, start, 2)
+        table.setHealth("hello", start + 10, statustable.HEALTHY)
+        table.setHealth("goodbye", 0, statustable.UNHEALTHY)
+        out = io.StringIO()
+        ctllib.status(self.places, tablePath, out=out)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [
+                "goodbye - - 0 - unhealthy",
+                "hello 100 2020-01-02T03:04:05 2 2020-01-02T03:04:15 healthy",
+            ],
+        )
+
+    def test_status_stdout(self):
+        """Test that status prints to standard output by default"""
+        tablePath = os.path.join(self.places.config, "table")
+        statustable.create(tablePath)
+        out = io.StringIO()
+        self.addCleanup(setattr, ctllib.sys, "stdout", ctllib.sys.stdout)
+        ctllib.sys.stdout = out
+        ctllib.status(self.places, tablePath)
+        self.assertEqual(out.getvalue(), "")
+
     def test_extra_protection(self):
         """Test that messages have the PID in them"""
         ctllib.restartAll(self.places)
@@ -5,13 +5,23 @@
 
 import os
 import shutil
+import time
 import unittest
+from unittest import mock
 
 from zope import interface
 from zope.interface import verify
 
+from twisted.python import filepath
+from twisted.internet import defer, reactor
+from twisted.internet import task
+from twisted.trial import unittest as tunittest
+
+from ncolony import ctllib
 from ncolony import directory_monitor
+from ncolony import instrument
 from ncolony import interfaces
+from ncolony.tests import helper
 
 
 @interface.implementer(interfaces.IMonitorEventReceiver)
@@ -36,6 +46,16 @@ class EventRecorder:
         self.events.append(("MESSAGE", contents))
 
 
+@interface.implementer(interfaces.IMonitorEventUpdater)
+class UpdateRecorder(EventRecorder):
+
+    """An event receiver that also records updates"""
+
+    def update(self, name, contents):
+        """Get an update event"""
+        self.events.append(("UPDATE", name, contents))
+
+
 # pylint: disable=too-few-public-methods
 @interface.implementer(interfaces.IMonitorEventReceiver)
 class EventRecorderNoAdd:
@@ -61,6 +81,17 @@ class EventRecorderNoRemove:
         """Get a new message event"""
 
 
+class VanishedEntry:
+
+    """Something that looks like an os.DirEntry for a removed file"""
+
+    name = "two"
+
+    def stat(self):
+        """Pretend the file is gone"""
+        raise FileNotFoundError(self.name)
+
+
 # pylint: enable=too-few-public-methods
 
 
@@ -131,6 +162,18 @@ class TestMessageSender(DirectoryBasedTest):
         self.message()
         self.assertFalse(self.receiver.events)
 
+    def test_stats(self):
+        """Test time spent on phases of the check is recorded"""
+        stats = instrument.Stats()
+        message = directory_monitor.messages(
+            self.testDirectory, self.receiver, stats=stats
+        )
+        self.write("00Message", b"hello")
+        self.write("01Message", b"hello")
+        message()
+        counts = {name: value.count for name, value in stats.histograms.items()}
+        self.assertEqual(counts, dict(listdir=1, read=2, dispatch=1))
+
     def test_ignore_new(self):
         """Test ignoring messages with .new extension"""
         self.write("00Message.new", b"hello")
@@ -145,6 +188,77 @@ class TestMessageSender(DirectoryBasedTest):
         self.message()
         self.assertEqual(self.receiver.events, [("MESSAGE", b"hello")])
 
+    def test_names(self):
+        """Test all messages are processed, whatever names changed"""
+        self.write("00Message", b"hello")
+        self.write("01Message", b"goodbye")
+        self.message(set(["01Message"]))
+        self.assertEqual(
+            sorted(self.receiver.events),
+            [("MESSAGE", b"goodbye"), ("MESSAGE", b"hello")],
+        )
+
+    def writeAt(self, name, content, when):
+        """Write a message with a given modification time"""
+        self.write(name, content)
+        os.utime(os.path.join(self.testDirectory, name), (when, when))
+
+    def test_order(self):
+        """Test messages are processed in the order they were written"""
+        now = time.time()
+        self.writeAt("005Message.2", b"first", now - 10)
+        self.writeAt("001Message.1", b"second", now - 5)
+        self.writeAt("1000Message.1", b"fourth", now)
+        self.writeAt("999Message.1", b"third", now)
+        self.message()
+        self.assertEqual(
+            self.receiver.events,
+            [
+                ("MESSAGE", b"first"),
+                ("MESSAGE", b"second"),
+                ("MESSAGE", b"third"),
+                ("MESSAGE", b"fourth"),
+            ],
+        )
+
+    def test_duplicates(self):
+        """Test identical messages in one batch are only sent once"""
+        now = time.time()
+        for i in range(50):
+            self.writeAt("%03dMessage.1" % i, b"restart", now)
+        self.writeAt("050Message.1", b"other", now)
+        self.message()
+        self.assertEqual(
+            self.receiver.events, [("MESSAGE", b"restart"), ("MESSAGE", b"other")]
+        )
+        self.assertEqual(os.listdir(self.testDirectory), [".claimed"])
+        self.assertEqual(os.listdir(os.path.join(self.testDirectory, ".claimed")), [])
+
+    def test_claimed_leftover(self):
+        """Test messages claimed before a crash are sent first"""
+        now = time.time()
+        claimed = os.path.join(self.testDirectory, ".claimed")
+        os.makedirs(claimed)
+        self.writeAt(os.path.join(".claimed", "001Message.1"), b"old", now - 10)
+        self.writeAt("000Message.2", b"new", now)
+        self.message()
+        self.assertEqual(
+            self.receiver.events, [("MESSAGE", b"old"), ("MESSAGE", b"new")]
+        )
+
+    def test_claimed_elsewhere(self):
+        """Test messages claimed by another consumer are skipped"""
+        self.write("00Message", b"hello")
+        with mock.patch.object(os, "rename", side_effect=FileNotFoundError()):
+            self.message()
+        self.assertFalse(self.receiver.events)
+
+    def test_ignore_hidden(self):
+        """Test hidden files are not messages"""
+        self.write(".hidden", b"hello")
+        self.message()
+        self.assertFalse(self.receiver.events)
+
     def test_repeated_message(self):
         """Test the same message repeated twice"""
         self.write("00Message", b"hello")
@@ -168,6 +282,33 @@ class TestMessageSender(DirectoryBasedTest):
         )
 
 
+class TestMessageErrors(tunittest.TestCase):
+
+    """Test messages that cannot be processed"""
+
+    def test_error(self):
+        """Test a bad message is logged and does not stop the rest"""
+        location = self.mktemp()
+        os.makedirs(location)
+        events = []
+
+        def _message(content):
+            if content == b"bad":
+                raise ValueError("unknown message", content)
+            events.append(content)
+
+        receiver = EventRecorder()
+        receiver.message = _message
+        check = directory_monitor.messages(location, receiver)
+        path = filepath.FilePath(location)
+        path.child("00Message").setContent(b"bad")
+        path.child("01Message").setContent(b"good")
+        check()
+        self.assertEqual(events, [b"good"])
+        (error,) = self.flushLoggedErrors(ValueError)
+        self.assertEqual(error.value.args, ("unknown message", b"bad"))
+
+
 class TestEventSender(DirectoryBasedTest):
 
     """Test monitoring the configuration directory"""
@@ -184,6 +325,21 @@ class TestEventSender(DirectoryBasedTest):
         self.monitor()
         self.assertFalse(self.receiver.events)
 
+    def test_stats(self):
+        """Test time spent on phases of the check is recorded"""
+        stats = instrument.Stats()
+        monitor = directory_monitor.checker(
+            self.testDirectory, UpdateRecorder(), stats=stats
+        )
+        self.write("one", b"A")
+        self.write("two", b"B")
+        monitor()
+        self.remove("two")
+        self.write("one", b"AA")
+        monitor(["one", "two"])
+        counts = {name: value.count for name, value in stats.histograms.items()}
+        self.assertEqual(counts, dict(listdir=2, read=3, dispatch=4))
+
     def test_ignore_new(self):
         """Test ignoring a file with a .new extension"""
         self.write("one.new", b"A")
@@ -233,3 +389,303 @@ class TestEventSender(DirectoryBasedTest):
             self.receiver.events,
             [("ADD", "one", b"A"), ("REMOVE", "one"), ("ADD", "one", b"B")],
         )
+
+    def test_update(self):
+        """Test a receiver that handles changes gets an update"""
+        self.receiver = UpdateRecorder()
+        monitor = directory_monitor.checker(self.testDirectory, self.receiver)
+        self.write("one", b"A")
+        monitor()
+        self.write("one", b"B")
+        monitor()
+        self.assertEqual(
+            self.receiver.events, [("ADD", "one", b"A"), ("UPDATE", "one", b"B")]
+        )
+
+    def test_names_add_change_remove(self):
+        """Test checking only the names known to have changed"""
+        self.write("one", b"A")
+        self.write("two", b"B")
+        self.monitor(["one"])
+        self.assertEqual(self.receiver.events, [("ADD", "one", b"A")])
+        self.write("one", b"C")
+        self.remove("two")
+        self.monitor(["one", "two", "one.new"])
+        self.assertEqual(
+            self.receiver.events,
+            [("ADD", "one", b"A"), ("REMOVE", "one"), ("ADD", "one", b"C")],
+        )
+        self.remove("one")
+        self.monitor(["one"])
+        self.assertEqual(self.receiver.events[-1], ("REMOVE", "one"))
+        self.monitor()
+        self.assertEqual(len(self.receiver.events), 4)
+
+    def test_names_then_full(self):
+        """Test a full check after checking names notices the rest"""
+        self.write("one", b"A")
+        self.write("two", b"B")
+        self.monitor(["one"])
+        self.monitor()
+        self.assertEqual(
+            self.receiver.events, [("ADD", "one", b"A"), ("ADD", "two", b"B")]
+        )
+
+    def test_racy_unchanged(self):
+        """Test a recently modified file is reread, but not reported"""
+        self.write("one", b"A")
+        self.monitor()
+        self.monitor()
+        self.assertEqual(self.receiver.events, [("ADD", "one", b"A")])
+
+    def test_vanished_during_scan(self):
+        """Test a file that goes away while scanning is ignored"""
+        self.write("one", b"A")
+        self.monitor(["two"])
+        self.assertFalse(self.receiver.events)
+
+
+class TestFingerprints(DirectoryBasedTest):
+
+    """Test configuration files are only read when they change"""
+
+    def setUp(self):
+        """Set up the test"""
+        DirectoryBasedTest.setUp(self)
+        self.receiver = EventRecorder()
+        self.old = time.time() - 3600
+        self.write("one", b"A")
+        self.age("one")
+
+    def age(self, name, delta=0):
+        """Pretend a file was modified an hour ago"""
+        name = os.path.join(self.testDirectory, name)
+        os.utime(name, (self.old + delta, self.old + delta))
+
+    def test_no_read(self):
+        """Test an old file with the same fingerprint is not read again"""
+        monitor = directory_monitor.checker(self.testDirectory, self.receiver)
+        monitor()
+        with mock.patch.object(filepath.FilePath, "getContent") as getContent:
+            monitor()
+            monitor(["one"])
+        self.assertFalse(getContent.called)
+        self.assertEqual(self.receiver.events, [("ADD", "one", b"A")])
+
+    def test_confirm(self):
+        """Test a changed fingerprint with the same contents is no change"""
+        monitor = directory_monitor.checker(self.testDirectory, self.receiver)
+        monitor()
+        self.age("one", 1)
+        monitor()
+        self.assertEqual(self.receiver.events, [("ADD", "one", b"A")])
+
+    def test_no_confirm(self):
+        """Test a changed fingerprint is a change without confirmation"""
+        monitor = directory_monitor.checker(
+            self.testDirectory, self.receiver, confirm=False
+        )
+        monitor()
+        self.age("one", 1)
+        monitor()
+        self.assertEqual(
+            self.receiver.events,
+            [("ADD", "one", b"A"), ("REMOVE", "one"), ("ADD", "one", b"A")],
+        )
+
+    def test_changed(self):
+        """Test a changed old file is reported"""
+        monitor = directory_monitor.checker(self.testDirectory, self.receiver)
+        monitor()
+        self.write("one", b"B")
+        self.age("one", 1)
+        monitor()
+        self.assertEqual(
+            self.receiver.events,
+            [("ADD", "one", b"A"), ("REMOVE", "one"), ("ADD", "one", b"B")],
+        )
+
+    def test_scan(self):
+        """Test scanning a directory stats everything but temporary files"""
+        self.write("two.new", b"B")
+        (name,) = directory_monitor.scan(self.testDirectory)
+        self.assertEqual(name, "one")
+
+    def test_scan_vanished(self):
+        """Test scanning ignores files that vanish before they are stat'ed"""
+        with mock.patch.object(os, "scandir") as scandir:
+            scandir.return_value.__enter__.return_value = [VanishedEntry()]
+            self.assertEqual(directory_monitor.scan(self.testDirectory), {})
+
+
+class DummyNotifier:
+
+    """Something that looks like an inotify.INotify"""
+
+    def __init__(self, clock):
+        self.reactor = clock
+        self.reading = False
+        self.lost = False
+        self.watches = []
+
+    def startReading(self):
+        """Pretend to start reading events"""
+        self.reading = True
+
+    def watch(self, path, mask, callbacks):
+        """Record a watch"""
+        self.watches.append((path, mask, callbacks))
+
+    def loseConnection(self):
+        """Pretend to stop reading events"""
+        self.lost = True
+
+    def notify(self, path, mask=0):
+        """Send an event to all callbacks"""
+        for _, _, callbacks in self.watches:
+            for callback in callbacks:
+                callback(None, path.asBytesMode(), mask)
+
+
+class TestWatcher(unittest.TestCase):
+
+    """Test watching a directory for changes"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.clock = task.Clock()
+        self.checks = []
+        self.notifiers = []
+        self.path = filepath.FilePath(os.path.abspath("stuff"))
+
+        def _factory(clock):
+            notifier = DummyNotifier(clock)
+            self.notifiers.append(notifier)
+            return notifier
+
+        self.watcher = directory_monitor.Watcher(
+            self.path.path, self.checks.append, self.clock, notifierFactory=_factory
+        )
+        self.watcher.startService()
+        self.addCleanup(self.watcher.stopService)
+        (self.notifier,) = self.notifiers
+
+    def test_watching(self):
+        """Test the directory is watched for configuration changes"""
+        self.assertIs(self.notifier.reactor, self.clock)
+        self.assertTrue(self.notifier.reading)
+        ((path, mask, _),) = self.notifier.watches
+        self.assertEqual(path, self.path)
+        self.assertEqual(mask, directory_monitor.CONFIG_MASK)
+
+    def test_coalesce(self):
+        """Test a burst of events results in one check"""
+        self.notifier.notify(self.path.child("one"))
+        self.notifier.notify(self.path.child("two"))
+        self.notifier.notify(self.path.child("one"))
+        self.assertFalse(self.checks)
+        self.clock.advance(0)
+        self.assertEqual(self.checks, [set(["one", "two"])])
+        self.notifier.notify(self.path.child("three"))
+        self.clock.advance(0)
+        self.assertEqual(self.checks, [set(["one", "two"]), set(["three"])])
+
+    def test_directory_event(self):
+        """Test an event on the directory itself results in a full check"""
+        self.notifier.notify(self.path.child("one"))
+        self.notifier.notify(self.path)
+        self.notifier.notify(self.path.child("two"))
+        self.clock.advance(0)
+        self.assertEqual(self.checks, [None])
+
+    def test_ignore_new(self):
+        """Test temporary files do not cause a check"""
+        self.notifier.notify(self.path.child("one.new"))
+        self.clock.advance(0)
+        self.assertFalse(self.checks)
+
+    def test_stop(self):
+        """Test stopping cancels pending checks and stops watching"""
+        self.notifier.notify(self.path.child("one"))
+        self.watcher.stopService()
+        self.assertTrue(self.notifier.lost)
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertIsNone(self.watcher.notifier)
+        self.watcher.startService()
+
+
+class TestWatcherUnavailable(unittest.TestCase):
+
+    """Test falling back to polling when inotify is not available"""
+
+    def test_no_inotify(self):
+        """Test nothing is watched when inotify cannot be imported"""
+        old = directory_monitor.inotify
+
+        def _cleanup():
+            directory_monitor.inotify = old
+
+        self.addCleanup(_cleanup)
+        directory_monitor.inotify = None
+        watcher = directory_monitor.Watcher("stuff", list, task.Clock())
+        watcher.startService()
+        self.assertIsNone(watcher.notifier)
+        watcher.stopService()
+
+    def test_inotify_error(self):
+        """Test nothing is watched when inotify fails"""
+
+        def _factory(clock):
+            raise directory_monitor.inotify.INotifyError("no more watches")
+
+        watcher = directory_monitor.Watcher(
+            "stuff", list, task.Clock(), notifierFactory=_factory
+        )
+        watcher.startService()
+        self.assertIsNone(watcher.notifier)
+        watcher.stopService()
+
+
+class TestWatcherInotify(tunittest.TestCase):
+
+    """Test watching a directory with real inotify"""
+
+    if directory_monitor.inotify is None:  # pragma: no cover
+        skip = "inotify not available"
+
+    def test_notice_message(self):
+        """Test a message is noticed without polling"""
+        location = self.mktemp()
+        os.makedirs(location)
+        receiver = EventRecorder()
+        d = defer.Deferred()
+        check = directory_monitor.messages(location, receiver)
+
+        def _check(names):
+            check(names)
+            d.callback(receiver.events)
+
+        watcher = directory_monitor.Watcher(
+            location, _check, reactor, mask=directory_monitor.MESSAGES_MASK
+        )
+        watcher.startService()
+        self.addCleanup(watcher.stopService)
+        places = ctllib.Places(config=location, messages=location)
+        ctllib.restart(places, "hello")
+        d.addCallback(
+            self.assertEqual,
+            [("MESSAGE", helper.dumps2utf8(dict(type="RESTART", name="hello")))],
+        )
+        return d
+
+    def test_notice_change(self):
+        """Test writing a file is noticed without polling"""
+        location = self.mktemp()
+        os.makedirs(location)
+        d = defer.Deferred()
+        watcher = directory_monitor.Watcher(location, d.callback, reactor)
+        watcher.startService()
+        self.addCleanup(watcher.stopService)
+        filepath.FilePath(location).child("one").setContent(b"A")
+        d.addCallback(self.assertEqual, set(["one"]))
+        return d
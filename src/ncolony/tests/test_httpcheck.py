@@ -5,20 +5,20 @@
 
 import collections
 import errno
+import functools
 import os
 import shutil
 import sys
 
 import twisted
-from twisted.python import filepath
-from twisted.internet import defer, reactor
-from twisted.web import client
-from twisted.application import internet as tainternet
+from twisted.python import failure, filepath, usage
+from twisted.internet import address, defer, error as ierror, reactor
+from twisted.web import client, http
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
 import ncolony
-from ncolony import httpcheck, ctllib
+from ncolony import httpcheck, ctllib, instrument, scanner
 from ncolony.tests import test_beatcheck, helper
 
 # pylint: disable=too-few-public-methods
@@ -40,6 +40,114 @@ class DummyHTTPAgent:
         return d
 
 
+class DummyResponse:
+
+    """Simulate a response"""
+
+    def __init__(self, code=200, done=True):
+        self.code = code
+        self.done = done
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        """Give the body to a protocol"""
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+        if self.done:
+            self.finish()
+
+    def finish(self, *chunks, reason=None):
+        """Deliver the body, and finish"""
+        for chunk in chunks:
+            self.protocol.dataReceived(chunk)
+        if reason is None:
+            reason = client.ResponseDone()
+        self.protocol.connectionLost(failure.Failure(reason))
+
+
+class DummyProcessTransport(proto_helpers.StringTransport):
+
+    """Simulate a process"""
+
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.signals = []
+        self.stdinClosed = False
+        self.exited = False
+
+    def closeStdin(self):
+        """Close the process's input"""
+        self.stdinClosed = True
+
+    def signalProcess(self, signal):
+        """Send the process a signal"""
+        if self.exited:
+            raise ierror.ProcessExitedAlready()
+        self.signals.append(signal)
+
+
+class LiteralResolver:
+
+    """Resolve host names that are addresses to themselves"""
+
+    # pylint: disable=too-many-arguments
+    def resolveHostName(
+        self,
+        receiver,
+        hostName,
+        portNumber=0,
+        addressTypes=None,
+        transportSemantics="TCP",
+    ):
+        """Resolve right away"""
+        del addressTypes
+        family = address.IPv6Address if ":" in hostName else address.IPv4Address
+        receiver.resolutionBegan(None)
+        receiver.addressResolved(family(transportSemantics, hostName, portNumber))
+        receiver.resolutionComplete()
+
+    # pylint: enable=too-many-arguments
+
+
+# pylint: disable=abstract-method
+
+
+class ProcessReactor(proto_helpers.MemoryReactorClock):
+
+    """Simulate a reactor that runs processes"""
+
+    def __init__(self):
+        proto_helpers.MemoryReactorClock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, processProtocol, executable, args, env):
+        """Pretend to run a process"""
+        transport = DummyProcessTransport()
+        self.processes.append((processProtocol, executable, args, env, transport))
+        processProtocol.makeConnection(transport)
+        return transport
+
+
+# pylint: enable=abstract-method
+
+
+class DummyScanner:
+
+    """Read configuration right away, unless busy"""
+
+    def __init__(self):
+        self.busy = False
+        self.known = []
+
+    def read(self, path, known=None):
+        """Read a directory"""
+        if self.busy:
+            return defer.fail(scanner.BusyError(path))
+        self.known.append(dict(known))
+        return defer.succeed(scanner.readDirectory(path, known))
+
+
 # pylint: enable=too-few-public-methods
 
 
@@ -89,13 +197,19 @@ class TestState(BaseTestHTTPChecker):
 
     def setUp(self):
         BaseTestHTTPChecker.setUp(self)
+        self.restarted = []
+        self.settings = self.settings._replace(restarter=self.restarted.append)
         self.location = self.filepath.child("foo")
         self.state = httpcheck.State(self.location, self.settings)
 
+    @staticmethod
+    def configure(state, params):
+        """Give a state a configuration"""
+        return state.apply(scanner.Snapshot(None, 0, helper.dumps2utf8(params)))
+
     def test_repr(self):
         """Repr includes everything"""
-        self.location.setContent(helper.dumps2utf8(self.params))
-        self.assertFalse(self.state.check())
+        self.assertTrue(self.configure(self.state, self.params))
         s = repr(self.state)
         cardS = repr(self.state.card)
         self.assertEqual(cardS[0], "<")
@@ -132,56 +246,69 @@ class TestState(BaseTestHTTPChecker):
         # pylint: enable=eval-used
 
     def test_no_check(self):
-        """Checking an empty state results in success"""
-        self.location.setContent(helper.dumps2utf8({}))
+        """A state without an HTTP check is never checked"""
+        self.assertTrue(self.configure(self.state, {}))
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
         self.reactor.advance(3)
-        self.assertFalse(self.state.check())
+        self.assertEqual(self.agent.calls, [])
+
+    def test_unchanged(self):
+        """Unchanged configurations do not reset the check"""
+        self.configure(self.state, self.params)
+        (timer,) = self.reactor.getDelayedCalls()
+        snapshot = scanner.Snapshot((1, 2, 3), 0, None)
+        self.assertFalse(self.state.apply(snapshot))
+        self.assertEqual(self.state.fingerprint, (1, 2, 3))
+        self.assertFalse(self.configure(self.state, self.params))
+        self.assertEqual(self.reactor.getDelayedCalls(), [timer])
 
     def test_bad_check(self):
-        """Checking unsuccessful HTTP results in failure"""
-        self.location.setContent(helper.dumps2utf8(self.params))
-        self.assertFalse(self.state.check())
-        self.reactor.advance(3)
-        self.assertFalse(self.state.check())
-        self.reactor.advance(3)
-        self.assertTrue(self.state.check())
+        """Unsuccessful HTTP checks restart the process, after a new grace"""
+        self.configure(self.state, self.params)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.agent.calls), 1)
+        self.reactor.advance(1)
+        self.assertEqual(self.restarted, [])
+        self.reactor.advance(1)
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertEqual(self.state.card.bad, 0)
+        self.assertEqual(self.state.nextCheck, 4)
         (error,) = self.flushLoggedErrors()
         error.trap(defer.CancelledError)
+        self.state.settings = self.settings._replace(restarter=None)
+        self.reactor.advance(1)
+        self.reactor.advance(2)
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertEqual(len(self.flushLoggedErrors(defer.CancelledError)), 1)
 
     def test_close_after_check(self):
-        """Closing state"""
-        self.location.setContent(helper.dumps2utf8(self.params))
-        self.assertFalse(self.state.check())
-        self.reactor.advance(3)
-        self.assertFalse(self.state.check())
+        """Closing state cancels checks"""
+        self.configure(self.state, self.params)
+        self.reactor.advance(1)
         self.state.close()
         self.assertTrue(self.state.closed)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
         (error,) = self.flushLoggedErrors()
         error.trap(defer.CancelledError)
 
     def test_reset_after_check(self):
-        """Closing state"""
-        self.location.setContent(helper.dumps2utf8(self.params))
-        self.assertFalse(self.state.check())
-        self.reactor.advance(3)
-        self.assertFalse(self.state.check())
-        params = {}
-        self.location.setContent(helper.dumps2utf8(params))
-        self.assertFalse(self.state.check())
+        """Removing the check cancels it"""
+        self.configure(self.state, self.params)
+        self.reactor.advance(1)
+        self.configure(self.state, {})
         (error,) = self.flushLoggedErrors()
         error.trap(defer.CancelledError)
         self.assertIsNone(self.state.call)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
 
     def test_good_check(self):
         """Checking successful HTTP results in success"""
-        self.location.setContent(helper.dumps2utf8(self.params))
-        self.assertFalse(self.state.check())
-        self.reactor.advance(3)
-        self.assertFalse(self.state.check())
+        self.configure(self.state, self.params)
+        self.reactor.advance(1)
         ((method, gotUrl, headers, body),) = self.agent.calls
         self.assertIsNone(body)
-        self.assertEqual(method, "GET")
-        url = next(iter(self.params.values()))["url"]
+        self.assertEqual(method, b"GET")
+        url = next(iter(self.params.values()))["url"].encode("utf-8")
         self.assertEqual(url, gotUrl)
         self.assertIsInstance(headers, client.Headers)
         (userAgent,) = headers.getRawHeaders("user-agent")
@@ -189,9 +316,118 @@ class TestState(BaseTestHTTPChecker):
         self.assertIn("NColony/" + str(ncolony.__version__), userAgent)
         self.assertIn("Python " + sys.version.replace("\n", ""), userAgent)
         (d,) = self.agent.pending[url]
-        d.callback(client.Response(("HTTP", 1, 1), 200, "OK", None, None))
-        self.assertFalse(self.state.check())
-        self.assertLessEqual(len(self.agent.calls), 1)
+        response = DummyResponse(done=False)
+        d.callback(response)
+        self.assertIsNotNone(self.state.call)
+        response.finish(b"ok")
+        self.assertIsNone(self.state.call)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.agent.calls), 2)
+        self.assertEqual(self.state.card.bad, 0)
+
+    def respond(self, latency):
+        """Answer the current check after a while, until the next check"""
+        self.reactor.advance(latency)
+        url = next(iter(self.params.values()))["url"].encode("utf-8")
+        self.agent.pending[url][-1].callback(DummyResponse())
+        self.reactor.advance(1 - latency)
+
+    def test_slow(self):
+        """Processes that get slow are restarted"""
+        stats = instrument.Stats()
+        self.state.settings = self.settings._replace(stats=stats)
+        self.params["ncolony.httpcheck"]["latency"] = dict(threshold=0.5, samples=2)
+        self.configure(self.state, self.params)
+        self.reactor.advance(1)
+        self.respond(0.75)
+        self.assertFalse(self.state.latency.slow)
+        self.assertEqual(self.restarted, [])
+        self.respond(0.75)
+        self.assertEqual(self.restarted, ["foo"])
+        self.assertFalse(self.state.latency.slow)
+        self.assertEqual(stats.histograms["latency.foo"].count, 2)
+        self.state.close()
+        self.assertNotIn("latency.foo", stats.histograms)
+
+    def test_slow_logged(self):
+        """Processes that get slow can be only logged about"""
+        latency = dict(threshold=0.5, samples=2, action="log")
+        self.params["ncolony.httpcheck"]["latency"] = latency
+        self.configure(self.state, self.params)
+        self.reactor.advance(1)
+        for _ in range(2):
+            self.respond(0.75)
+        self.assertTrue(self.state.latency.slow)
+        self.respond(0)
+        self.assertTrue(self.state.latency.slow)
+        self.respond(0)
+        self.assertFalse(self.state.latency.slow)
+        self.assertEqual(self.restarted, [])
+
+    def test_probe(self):
+        """Checks use the configured method, and expect the configured statuses"""
+        self.params["ncolony.httpcheck"].update(method="HEAD", status=[200, 204])
+        self.configure(self.state, self.params)
+        url = next(iter(self.params.values()))["url"].encode("utf-8")
+        self.reactor.advance(1)
+        ((method, _, _, _),) = self.agent.calls
+        self.assertEqual(method, b"HEAD")
+        self.agent.pending[url][-1].callback(DummyResponse(code=204))
+        self.assertEqual(self.state.card.bad, 0)
+        self.reactor.advance(1)
+        self.agent.pending[url][-1].callback(DummyResponse(code=500))
+        self.assertEqual(self.state.card.bad, 1)
+        (error,) = self.flushLoggedErrors(httpcheck.UnexpectedStatus)
+        self.assertEqual(
+            error.value.args, (self.params["ncolony.httpcheck"]["url"], 500)
+        )
+
+    def test_slow_body(self):
+        """Reading the body counts towards the timeout"""
+        self.params["ncolony.httpcheck"]["maxBody"] = 10
+        self.configure(self.state, self.params)
+        url = next(iter(self.params.values()))["url"].encode("utf-8")
+        self.reactor.advance(1)
+        response = DummyResponse(done=False)
+        self.agent.pending[url][-1].callback(response)
+        response.protocol.dataReceived(b"x" * 5)
+        self.reactor.advance(1)
+        self.assertEqual(response.transport.producerState, "stopped")
+        self.assertEqual(self.state.card.bad, 1)
+        self.assertEqual(len(self.flushLoggedErrors(defer.CancelledError)), 1)
+
+    def test_limited(self):
+        """Checks wait for a slot, and time out only once they started"""
+        limiter = httpcheck.Limiter(total=1)
+        self.settings = self.settings._replace(limiter=limiter)
+        other = httpcheck.State(self.filepath.child("bar"), self.settings)
+        self.state = httpcheck.State(self.location, self.settings)
+        url = next(iter(self.params.values()))["url"].encode("utf-8")
+        for state in (self.state, other):
+            self.configure(state, self.params)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.agent.pending[url]), 1)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.agent.pending[url]), 2)
+        self.reactor.advance(0.5)
+        self.assertEqual(other.card.bad, 0)
+        self.agent.pending[url][1].callback(DummyResponse())
+        self.assertEqual(other.card.bad, 0)
+        self.assertIsNone(other.call)
+        self.assertEqual(len(self.flushLoggedErrors(defer.CancelledError)), 1)
+
+    def test_jitter(self):
+        """First checks are spread over part of the period"""
+        self.params["ncolony.httpcheck"]["period"] = 10
+        self.configure(self.state, self.params)
+        plain = self.state.nextCheck
+        self.settings = self.settings._replace(jitter=0.5)
+        for name in ("foo", "bar"):
+            state = httpcheck.State(self.filepath.child(name), self.settings)
+            self.configure(state, self.params)
+            self.assertLessEqual(plain, state.nextCheck)
+            self.assertLess(state.nextCheck, plain + 5)
+        self.assertNotEqual(self.state.nextCheck, state.nextCheck)
 
     def test_close(self):
         """Checking closing causes APIs to error out"""
@@ -199,7 +435,196 @@ class TestState(BaseTestHTTPChecker):
         with self.assertRaises(ValueError):
             self.state.close()
         with self.assertRaises(ValueError):
-            self.state.check()
+            self.configure(self.state, self.params)
+
+
+class TestProbes(BaseTestHTTPChecker):
+
+    """Tests for checks that are not HTTP"""
+
+    def setUp(self):
+        BaseTestHTTPChecker.setUp(self)
+        self.reactor = ProcessReactor()
+        self.settings = self.settings._replace(reactor=self.reactor)
+        self.state = httpcheck.State(self.filepath.child("foo"), self.settings)
+
+    def configure(self, key, **kwargs):
+        """Give the state a configuration"""
+        config = dict(period=1, grace=1, maxBad=0, timeout=1, **kwargs)
+        content = helper.dumps2utf8({key: config})
+        self.state.apply(scanner.Snapshot(None, 0, content))
+        self.reactor.advance(1)
+
+    def test_tcp(self):
+        """TCP checks succeed when connected"""
+        self.configure("ncolony.tcpcheck", host="127.0.0.1", port=8080)
+        self.assertEqual(self.state.url, "tcp://127.0.0.1:8080")
+        ((host, port, factory, _, _),) = self.reactor.tcpClients
+        self.assertEqual((host, port), ("127.0.0.1", 8080))
+        transport = proto_helpers.StringTransport()
+        factory.buildProtocol(None).makeConnection(transport)
+        self.assertTrue(transport.disconnecting)
+        self.assertIsNone(self.state.call)
+        self.assertEqual(self.state.card.bad, 0)
+
+    def test_tcp_ipv6(self):
+        """TCP checks can connect to IPv6 addresses"""
+        self.reactor.installNameResolver(LiteralResolver())
+        self.configure("ncolony.tcpcheck", host="::1", port=8080)
+        self.assertEqual(self.state.url, "tcp://[::1]:8080")
+        ((host, port, _, _, _),) = self.reactor.tcpClients
+        self.assertEqual((host, port), ("::1", 8080))
+
+    def test_unix(self):
+        """Unix socket checks fail when not connected in time"""
+        self.configure("ncolony.unixcheck", path="/run/foo.sock")
+        self.assertEqual(self.state.url, "unix:/run/foo.sock")
+        ((path, _, _, _),) = self.reactor.unixClients
+        self.assertEqual(path, "/run/foo.sock")
+        self.reactor.advance(1)
+        self.assertEqual(self.state.card.bad, 1)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+
+    def test_exec(self):
+        """Commands succeed when they exit successfully"""
+        self.configure("ncolony.execcheck", args=["/bin/check", "--quick"])
+        self.assertEqual(self.state.url, "exec:/bin/check")
+        ((proto, executable, args, env, transport),) = self.reactor.processes
+        self.assertEqual(
+            (executable, args, env), ("/bin/check", ["/bin/check", "--quick"], None)
+        )
+        self.assertTrue(transport.stdinClosed)
+        proto.processEnded(failure.Failure(ierror.ProcessDone(0)))
+        self.assertEqual(self.state.card.bad, 0)
+        self.reactor.advance(1)
+        proto, _, _, _, _ = self.reactor.processes[-1]
+        proto.processEnded(failure.Failure(ierror.ProcessTerminated(1)))
+        self.assertEqual(self.state.card.bad, 1)
+        self.flushLoggedErrors(ierror.ProcessTerminated)
+
+    def test_exec_timeout(self):
+        """Commands that take too long are killed"""
+        self.configure("ncolony.execcheck", args=["/bin/check"])
+        self.reactor.advance(1)
+        ((proto, _, _, _, transport),) = self.reactor.processes[:1]
+        self.assertEqual(transport.signals, ["KILL"])
+        proto.processEnded(failure.Failure(ierror.ProcessTerminated(signal=9)))
+        self.assertEqual(self.state.card.bad, 1)
+        self.assertEqual(len(self.flushLoggedErrors(defer.CancelledError)), 1)
+
+    def test_exec_timeout_exited(self):
+        """Commands that exit just as they time out are not killed"""
+        self.configure("ncolony.execcheck", args=["/bin/check"])
+        ((_, _, _, _, transport),) = self.reactor.processes
+        transport.exited = True
+        self.reactor.advance(1)
+        self.assertEqual(transport.signals, [])
+        self.assertEqual(self.state.card.bad, 1)
+        self.assertEqual(len(self.flushLoggedErrors(defer.CancelledError)), 1)
+
+
+class TestDiscardBody(unittest.TestCase):
+
+    """Test throwing away response bodies"""
+
+    def test_whole(self):
+        """Without a limit, the whole body is read"""
+        response = DummyResponse(done=False)
+        d = httpcheck.discardBody(response)
+        self.assertNoResult(d)
+        response.finish(b"ab", b"cd")
+        self.assertEqual(self.successResultOf(d), 4)
+        response = DummyResponse(done=False)
+        d = httpcheck.discardBody(response)
+        response.finish(b"ab", reason=http.PotentialDataLoss())
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_limit(self):
+        """Reading stops once the body is too long"""
+        response = DummyResponse(done=False)
+        d = httpcheck.discardBody(response, limit=3)
+        response.protocol.dataReceived(b"ab")
+        self.assertEqual(response.transport.producerState, "producing")
+        response.finish(b"cd", b"ef", reason=client.ResponseFailed([]))
+        self.assertEqual(response.transport.producerState, "stopped")
+        self.assertEqual(self.successResultOf(d), 4)
+
+    def test_failed(self):
+        """Failing to read the body fails"""
+        response = DummyResponse(done=False)
+        d = httpcheck.discardBody(response)
+        response.finish(b"ab", reason=client.ResponseFailed([]))
+        self.failureResultOf(d, client.ResponseFailed)
+
+    def test_cancel(self):
+        """Reading can be cancelled"""
+        response = DummyResponse(done=False)
+        d = httpcheck.discardBody(response)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(response.transport.producerState, "stopped")
+        response.finish(reason=client.ResponseFailed([]))
+
+
+class TestLimiter(unittest.TestCase):
+
+    """Test limiting checks in flight"""
+
+    def setUp(self):
+        self.pending = []
+
+    def request(self, name):
+        """Pretend to make a request"""
+        d = defer.Deferred()
+        self.pending.append((name, d))
+        return d
+
+    def finish(self, index=0):
+        """Pretend a request finished"""
+        name, d = self.pending.pop(index)
+        d.callback(name)
+
+    def test_unlimited(self):
+        """Without limits, checks run right away"""
+        limiter = httpcheck.Limiter()
+        results = [limiter.run("http://a/", self.request, i) for i in range(3)]
+        self.assertEqual(len(self.pending), 3)
+        self.finish()
+        self.assertEqual(self.successResultOf(results[0]), 0)
+
+    def test_total(self):
+        """Only so many checks are in flight"""
+        limiter = httpcheck.Limiter(total=2)
+        results = [limiter.run("http://a/", self.request, i) for i in range(3)]
+        self.assertEqual([name for name, _ in self.pending], [0, 1])
+        self.finish(1)
+        self.assertEqual(self.successResultOf(results[1]), 1)
+        self.assertEqual([name for name, _ in self.pending], [0, 2])
+
+    def test_per_host(self):
+        """Only so many checks to one host are in flight"""
+        limiter = httpcheck.Limiter(total=2, perHost=1)
+        first = limiter.run("http://a/one", self.request, "a1")
+        limiter.run("http://a/two", self.request, "a2")
+        limiter.run("http://b/", self.request, "b")
+        self.assertEqual([name for name, _ in self.pending], ["a1", "b"])
+        self.finish()
+        self.assertEqual(self.successResultOf(first), "a1")
+        self.assertEqual([name for name, _ in self.pending], ["b", "a2"])
+        self.finish()
+        self.finish()
+        self.assertEqual(limiter.hosts, {})
+
+    def test_cancel(self):
+        """Checks can be cancelled while they wait"""
+        limiter = httpcheck.Limiter(perHost=1)
+        limiter.run("http://a/", self.request, 1)
+        waiting = limiter.run("http://a/", self.request, 2)
+        waiting.cancel()
+        self.failureResultOf(waiting, defer.CancelledError)
+        self.finish()
+        self.assertEqual(self.pending, [])
+        self.assertEqual(limiter.hosts, {})
 
 
 class TestCheck(BaseTestHTTPChecker):
@@ -210,6 +635,8 @@ class TestCheck(BaseTestHTTPChecker):
         BaseTestHTTPChecker.setUp(self)
         self.location = self.filepath.child("foo")
         self.location.createDirectory()
+        self.restarted = []
+        self.settings = self.settings._replace(restarter=self.restarted.append)
         self.states = {}
 
     def test_check_empty(self):
@@ -219,57 +646,91 @@ class TestCheck(BaseTestHTTPChecker):
         self.assertEqual(self.states, {})
 
     def test_check_simplestate(self):
-        """one configuration in directory is checked"""
-        self.location.child("child").setContent(helper.dumps2utf8(self.params))
+        """one configuration in directory is checked on its own timer"""
+        child = self.location.child("child")
+        child.setContent(helper.dumps2utf8(self.params))
         ret = httpcheck.check(self.settings, self.states, self.location)
-        self.assertEqual(ret, [])
+        self.assertEqual(ret, ["child"])
         ((name, state),) = self.states.items()
         self.assertEqual(name, "child")
-        httpcheck.check(self.settings, self.states, self.location)
-        self.assertEqual(ret, [])
-        self.reactor.advance(3)
-        httpcheck.check(self.settings, self.states, self.location)
-        self.reactor.advance(3)
         ret = httpcheck.check(self.settings, self.states, self.location)
-        (bad,) = ret
+        self.assertEqual(ret, [])
+        self.reactor.advance(1)
+        self.reactor.advance(1)
+        self.reactor.advance(1)
+        self.assertEqual(self.restarted, ["child"])
         (err,) = self.flushLoggedErrors()
         err.trap(defer.CancelledError)
-        self.assertEqual(bad, "child")
-        self.location.child("child").remove()
+        self.params["ncolony.httpcheck"]["url"] = "http://example.com/other"
+        child.setContent(helper.dumps2utf8(self.params))
+        ret = httpcheck.check(self.settings, self.states, self.location)
+        self.assertEqual(ret, ["child"])
+        self.assertEqual(state.url, "http://example.com/other")
+        child.remove()
         ret = httpcheck.check(self.settings, self.states, self.location)
         self.assertEqual(ret, [])
         self.assertTrue(state.closed)
         self.assertEqual(self.states, {})
 
-    def test_run(self):
-        """run restarts each bad thing"""
-        lst = []
-        restarter = lst.append
-
-        def _check():
-            return [1, 2, 3]
+    def test_check_snapshots(self):
+        """configurations that were already read are not read again"""
+        self.location.child("child").setContent(helper.dumps2utf8({}))
+        content = helper.dumps2utf8(self.params)
+        snapshots = dict(child=scanner.Snapshot(None, 0, content))
+        httpcheck.check(self.settings, self.states, self.location, snapshots)
+        self.assertEqual(self.states["child"].url, "http://example.com/status")
 
-        httpcheck.run(restarter, _check)
-        self.assertEqual(lst, [1, 2, 3])
+    def test_scan_check(self):
+        """configurations are read with a scanner, when they changed"""
+        self.location.child("child").setContent(helper.dumps2utf8(self.params))
+        myScanner = DummyScanner()
+        d = httpcheck.scanCheck(myScanner, self.settings, self.states, self.location)
+        self.assertEqual(self.successResultOf(d), ["child"])
+        self.assertEqual(list(self.states), ["child"])
+        d = httpcheck.scanCheck(myScanner, self.settings, self.states, self.location)
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertEqual(
+            myScanner.known, [{}, dict(child=self.states["child"].fingerprint)]
+        )
+        myScanner.busy = True
+        d = httpcheck.scanCheck(myScanner, self.settings, self.states, self.location)
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertEqual(list(self.states), ["child"])
+
+    def test_checker(self):
+        """Stopping the checker stops checking processes"""
+        self.location.child("child").setContent(helper.dumps2utf8(self.params))
+        httpcheck.check(self.settings, self.states, self.location)
+        state = self.states["child"]
+        checker = httpcheck.Checker(5, lambda: None, self.states)
+        checker.clock = self.reactor
+        checker.startService()
+        checker.stopService()
+        self.assertTrue(state.closed)
+        self.assertEqual(self.states, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
 
     def test_make_service(self):
         """Test makeService"""
         opt = dict(config="config", messages="messages", freq=5)
         masterService = httpcheck.makeService(opt)
         service = masterService.getServiceNamed("httpcheck")
-        self.assertIsInstance(service, tainternet.TimerService)
+        self.assertIsInstance(service, httpcheck.Checker)
         self.assertEqual(service.step, 5)
-        callableThing, args, kwargs = service.call
-        self.assertIs(callableThing, httpcheck.run)
+        checker, args, kwargs = service.call
+        self.assertFalse(args)
         self.assertFalse(kwargs)
-        restarter, checker = args
+        self.assertIs(checker.func, httpcheck.scanCheck)
+        self.assertFalse(checker.keywords)
+        myScanner, settings, states, location = checker.args
+        self.assertIs(service.states, states)
+        restarter = settings.restarter
         self.assertFalse(restarter.keywords)
         (places,) = restarter.args
         self.assertEqual(places, ctllib.Places(config="config", messages="messages"))
         self.assertIs(restarter.func, ctllib.restart)
-        self.assertIs(checker.func, httpcheck.check)
-        self.assertFalse(checker.keywords)
-        settings, states, location = checker.args
+        self.assertIs(masterService.getServiceNamed("scanner"), myScanner)
+        self.assertEqual(myScanner.timeout, 5)
         self.assertEqual(location, filepath.FilePath(opt["config"]))
         self.assertEqual(states, {})
         self.assertIs(settings.reactor, reactor)
@@ -277,7 +738,44 @@ class TestCheck(BaseTestHTTPChecker):
         self.assertIsInstance(agent, client.Agent)
         # pylint: disable=protected-access
         self.assertTrue(agent._pool.persistent)
+        self.assertEqual(agent._pool.maxPersistentPerHost, 2)
         # pylint: enable=protected-access
+        self.assertIsNone(settings.limiter.total)
+        self.assertEqual(settings.jitter, 0)
+
+    def test_make_service_limits(self):
+        """Test makeService with limits on checks and connections"""
+        opt = httpcheck.Options()
+        opt.parseOptions(
+            ["--config", "config", "--messages", "messages"]
+            + ["--max-in-flight", "10", "--per-host", "2", "--jitter", "0.5"]
+            + ["--persistent-per-host", "3", "--idle-timeout", "30"]
+        )
+        masterService = httpcheck.makeService(opt)
+        checker, _, _ = masterService.getServiceNamed("httpcheck").call
+        settings = checker.args[1]
+        self.assertEqual(settings.limiter.total.limit, 10)
+        self.assertEqual(settings.limiter.perHost, 2)
+        self.assertEqual(settings.jitter, 0.5)
+        # pylint: disable=protected-access
+        self.assertEqual(settings.agent._pool.maxPersistentPerHost, 3)
+        self.assertEqual(settings.agent._pool.cachedConnectionTimeout, 30)
+        # pylint: enable=protected-access
+        for extra in (["--jitter", "2"], ["--socket", "beats"]):
+            with self.assertRaises(usage.UsageError):
+                httpcheck.Options().parseOptions(
+                    ["--config", "config", "--messages", "messages"] + extra
+                )
+
+    def test_make_service_stats(self):
+        """Test makeService writing stats"""
+        opt = dict(config="config", messages="messages", freq=5, stats="stats.json")
+        masterService = httpcheck.makeService(opt)
+        self.assertEqual(masterService.getServiceNamed("stats").path, "stats.json")
+        service = masterService.getServiceNamed("httpcheck")
+        callableThing, _, _ = service.call
+        self.assertNotIsInstance(callableThing, functools.partial)
+        self.assertIs(masterService.getServiceNamed("lag").reactor, reactor)
 
     def test_make_service_with_health(self):
         """Test httpcheck with heart beater"""
@@ -0,0 +1,237 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.instrument"""
+
+import json
+import os
+import shutil
+
+from twisted.application import service
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ncolony import instrument
+
+# pylint: disable=too-few-public-methods
+
+
+class Ticker:
+
+    """A clock that moves a second every time it is read"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        """Return the time, and move it on"""
+        self.now += 1
+        return self.now
+
+
+# pylint: enable=too-few-public-methods
+
+
+class TestHistogram(unittest.TestCase):
+
+    """Test summarizing durations"""
+
+    def test_buckets(self):
+        """Durations are counted in every bucket they fit in"""
+        histogram = instrument.Histogram(bounds=[1, 2])
+        for value in (0.5, 1, 1.5, 3):
+            histogram.add(value)
+        self.assertEqual(
+            histogram.asDict(),
+            dict(
+                count=4,
+                sum=6,
+                max=3,
+                p50=1,
+                p95=3,
+                p99=3,
+                buckets={"1": 2, "2": 3, "+Inf": 4},
+            ),
+        )
+
+    def test_empty(self):
+        """An empty histogram has all zeros"""
+        summary = instrument.Histogram().asDict()
+        self.assertEqual(summary["count"], 0)
+        self.assertEqual(summary["p99"], 0)
+        self.assertEqual(set(summary["buckets"].values()), {0})
+
+    def test_percentile(self):
+        """Percentiles are the bucket bound, unless the maximum is lower"""
+        histogram = instrument.Histogram(bounds=[1, 2])
+        for value in (0.5, 0.5, 1.5):
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(0.5), 1)
+        self.assertEqual(histogram.percentile(0.99), 1.5)
+
+    def test_recent(self):
+        """Recent durations forget old ones, and give exact percentiles"""
+        recent = instrument.RecentDurations(3)
+        self.assertEqual((recent.count, recent.percentile(0.99)), (0, 0))
+        for value in (0.5, 0.25):
+            recent.add(value)
+        self.assertEqual((recent.count, recent.percentile(0.99)), (2, 0.5))
+        self.assertEqual(recent.percentile(0.5), 0.25)
+        self.assertEqual(recent.percentile(0), 0.25)
+        for value in (3, 3):
+            recent.add(value)
+        self.assertEqual((recent.count, recent.percentile(0.5)), (3, 3))
+
+    def test_recent_exact(self):
+        """A few slow durations do not make a percentile a bucket bound"""
+        recent = instrument.RecentDurations(200)
+        for value in [0.26] * 198 + [3.0] * 2:
+            recent.add(value)
+        self.assertEqual(recent.percentile(0.99), 0.26)
+
+
+class TestStats(unittest.TestCase):
+
+    """Test recording durations"""
+
+    def setUp(self):
+        """Make stats with a clock that always moves on"""
+        self.stats = instrument.Stats(clock=Ticker())
+
+    def counts(self):
+        """Get the count and sum of all histograms"""
+        return {
+            name: (value.count, value.sum)
+            for name, value in self.stats.histograms.items()
+        }
+
+    def test_timing(self):
+        """Blocks are timed, even when they fail"""
+        with self.stats.timing("block"):
+            pass
+        with self.assertRaises(ValueError):
+            with self.stats.timing("block"):
+                raise ValueError()
+        self.assertEqual(self.counts(), dict(block=(2, 2)))
+
+    def test_timed(self):
+        """Functions are timed, even when they fail"""
+        timed = self.stats.timed("func", int)
+        self.assertEqual(timed("5"), 5)
+        with self.assertRaises(ValueError):
+            timed("five")
+        self.assertEqual(self.counts(), dict(func=(2, 2)))
+
+    def test_timed_deferred(self):
+        """Functions returning Deferreds are timed until the Deferred fires"""
+        d = defer.Deferred()
+        timed = self.stats.timed("func", lambda: d)
+        result = timed()
+        self.assertEqual(self.counts(), {})
+        self.stats.clock()
+        d.callback(5)
+        self.assertEqual(self.successResultOf(result), 5)
+        self.assertEqual(self.counts(), dict(func=(1, 2)))
+
+    def test_scoped(self):
+        """Scoped stats prefix names"""
+        scoped = self.stats.scoped("outer")
+        scoped.record("a", 1)
+        with scoped.timing("b"):
+            pass
+        scoped.timed("c", int)("5")
+        scoped.scoped("inner").record("d", 1)
+        self.assertEqual(
+            sorted(self.stats.snapshot()),
+            ["outer.a", "outer.b", "outer.c", "outer.inner.d"],
+        )
+        scoped.forget("a")
+        scoped.forget("missing")
+        self.assertEqual(
+            sorted(self.stats.snapshot()),
+            ["outer.b", "outer.c", "outer.inner.d"],
+        )
+
+    def test_null(self):
+        """Stats that are not kept do nothing"""
+        null = instrument.ensure(None)
+        self.assertIs(null, instrument.NULL)
+        self.assertIs(null.scoped("outer"), null)
+        null.record("a", 1)
+        null.forget("a")
+        with null.timing("b"):
+            pass
+        self.assertIs(null.timed("c", int), int)
+        self.assertIs(instrument.ensure(self.stats), self.stats)
+
+
+class TestLagMonitor(unittest.TestCase):
+
+    """Test measuring reactor lag"""
+
+    def test_lag(self):
+        """Lateness of timed calls is recorded"""
+        clock = task.Clock()
+        stats = instrument.Stats()
+        monitor = instrument.LagMonitor(clock, stats, interval=2)
+        monitor.startService()
+        clock.advance(2)
+        clock.advance(3)
+        clock.advance(1)
+        lag = stats.histograms["reactor.lag"]
+        self.assertEqual((lag.count, lag.sum), (2, 1))
+        monitor.stopService()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        monitor.stopService()
+
+
+class TestStatsFile(unittest.TestCase):
+
+    """Test writing stats to a file"""
+
+    def setUp(self):
+        """Make a directory for the file"""
+        self.directory = os.path.abspath("dummy-stats")
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "stats")
+
+    def read(self):
+        """Read the stats file"""
+        with open(self.path) as fp:
+            return json.load(fp)
+
+    def test_write(self):
+        """Stats are written as JSON"""
+        stats = instrument.Stats()
+        stats.record("a", 0.5)
+        instrument.write(stats, self.path)
+        self.assertEqual(self.read()["a"]["sum"], 0.5)
+        self.assertEqual(os.listdir(self.directory), ["stats"])
+
+    def test_service(self):
+        """Stats are written periodically, and when stopping"""
+        clock = task.Clock()
+        master = service.MultiService()
+        stats = instrument.maybeStats(self.path)
+        instrument.maybeAddService(master, stats, self.path, clock, interval=5)
+        statsFile = master.getServiceNamed("stats")
+        statsFile.clock = clock
+        master.startService()
+        self.assertEqual(self.read(), {})
+        clock.advance(1)
+        self.assertEqual(self.read(), {})
+        clock.advance(4)
+        self.assertEqual(list(self.read()), ["reactor.lag"])
+        stats.record("tick", 1)
+        master.stopService()
+        self.assertEqual(sorted(self.read()), ["reactor.lag", "tick"])
+
+    def test_no_service(self):
+        """Nothing is added without a file"""
+        master = service.MultiService()
+        stats = instrument.maybeStats(None)
+        self.assertIsNone(stats)
+        instrument.maybeAddService(master, stats, None, task.Clock())
+        self.assertEqual(list(master), [])
@@ -0,0 +1,130 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.metrics"""
+
+import collections
+import os
+import shutil
+import types
+
+from twisted.application import internet as tainternet
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web.test import requesthelper
+
+from ncolony import directory_monitor, instrument, metrics
+
+# pylint: disable=too-few-public-methods
+
+
+class DummyReceiver:
+
+    """Something that looks like a Receiver"""
+
+    def __init__(self, groups):
+        self._groups = groups
+        self.stats = collections.Counter(requested=3, performed=2, suppressed=1)
+
+    def groups(self):
+        """The processes in each group"""
+        return self._groups
+
+
+# pylint: enable=too-few-public-methods
+
+
+class TestMetricsPublisher(unittest.TestCase):
+
+    """Test counting starts"""
+
+    def test_starts(self):
+        """Starts are counted, and the time to start again measured"""
+        clock = task.Clock()
+        publisher = metrics.MetricsPublisher(clock)
+        publisher.set("hello", None)
+        clock.advance(10)
+        publisher.delete("hello")
+        clock.advance(2)
+        publisher.set("hello", None)
+        self.assertEqual(publisher.starts["hello"], 2)
+        self.assertEqual(publisher.spawnLatency.asDict()["sum"], 2)
+
+
+class TestMetrics(unittest.TestCase):
+
+    """Test rendering metrics"""
+
+    def setUp(self):
+        """Make a messages directory and things to gather metrics from"""
+        self.messages = os.path.abspath("dummy-messages")
+        shutil.rmtree(self.messages, ignore_errors=True)
+        os.makedirs(self.messages)
+        self.addCleanup(shutil.rmtree, self.messages)
+        monitor = types.SimpleNamespace(
+            processes={"a": None, 'b"\\\n': None}, protocols={"a": None}
+        )
+        receiver = DummyReceiver(dict(things={"a", "gone"}))
+        self.publisher = metrics.MetricsPublisher(task.Clock())
+        self.stats = instrument.Stats()
+        self.metrics = metrics.Metrics(
+            monitor, receiver, self.publisher, self.stats, self.messages
+        )
+
+    def test_queue_depth(self):
+        """Messages waiting, and claimed but not handled, are counted"""
+        self.assertEqual(metrics.queueDepth(self.messages), 0)
+        claimed = os.path.join(self.messages, directory_monitor.CLAIMED)
+        os.makedirs(claimed)
+        for name in ("00Message", "01Message.new", ".hidden"):
+            with open(os.path.join(self.messages, name), "w") as fp:
+                fp.write("{}")
+        with open(os.path.join(claimed, "02Message"), "w") as fp:
+            fp.write("{}")
+        self.assertEqual(metrics.queueDepth(self.messages), 2)
+
+    def test_render(self):
+        """Metrics are rendered in the Prometheus text format"""
+        for _ in range(3):
+            self.publisher.set("a", None)
+        self.stats.record("config.tick", 0.5)
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(
+            lines[:10],
+            [
+                "# TYPE ncolony_processes gauge",
+                "ncolony_processes 2",
+                "# TYPE ncolony_processes_running gauge",
+                "ncolony_processes_running 1",
+                "# TYPE ncolony_process_restarts_total counter",
+                'ncolony_process_restarts_total{name="a"} 2',
+                'ncolony_process_restarts_total{name="b\\"\\\\\\n"} 0',
+                "# TYPE ncolony_group_restarts_total counter",
+                'ncolony_group_restarts_total{group="things"} 2',
+                "# TYPE ncolony_restarts_requested_total counter",
+            ],
+        )
+        self.assertIn("ncolony_restarts_suppressed_total 1", lines)
+        self.assertIn("ncolony_message_queue_depth 0", lines)
+        self.assertIn("# TYPE ncolony_config_tick_seconds histogram", lines)
+        self.assertIn('ncolony_config_tick_seconds_bucket{le="0.5"} 1', lines)
+        self.assertIn('ncolony_config_tick_seconds_bucket{le="0.25"} 0', lines)
+        self.assertIn('ncolony_config_tick_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn("ncolony_config_tick_seconds_sum 0.5", lines)
+
+    def test_resource(self):
+        """Metrics are served as text"""
+        request = requesthelper.DummyRequest([b"metrics"])
+        body = metrics.MetricsResource(self.metrics).render_GET(request)
+        self.assertIn(b"ncolony_processes 2\n", body)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"content-type"),
+            [metrics.CONTENT_TYPE],
+        )
+
+    def test_service(self):
+        """Metrics are served on an endpoint"""
+        server = metrics.makeService("tcp:0:interface=127.0.0.1", self.metrics)
+        self.assertIsInstance(server, tainternet.StreamServerEndpointService)
+        self.assertEqual(server.name, "metrics")
+        self.assertIs(server.factory.resource.metrics, self.metrics)
@@ -1,11 +1,16 @@
 # Copyright (c) Moshe Zadka
 # See LICENSE for details.
 """Test event processing"""
+import os
+import shutil
 import unittest
 
 from zope.interface import verify
 
 from twisted.python import log
+from twisted.internet import task
+from twisted.runner import procmon
+from twisted.runner.test import test_procmon
 
 from ncolony import process_events
 from ncolony import interfaces
@@ -75,6 +80,9 @@ class TestReceiver(unittest.TestCase):
         self.assertTrue(
             verify.verifyObject(interfaces.IMonitorEventReceiver, self.receiver)
         )
+        self.assertTrue(
+            verify.verifyObject(interfaces.IMonitorEventUpdater, self.receiver)
+        )
 
     def test_add_simple(self):
         """Test a simple process addition"""
@@ -168,6 +176,81 @@ class TestReceiver(unittest.TestCase):
         self.assertEqual(self.monitor.events[-1], ("REMOVE", "hello"))
         self.assertEqual(self.logMessages[-1], "Removed monitored process: hello")
 
+    def test_update_unchanged(self):
+        """Changes that do not affect how a process starts do not restart it"""
+        message = dict(args=["/bin/echo", "hello"], group=["things"])
+        message["ncolony.beatcheck"] = dict(period=10, grace=3, status="status")
+        message["ncolony.httpcheck"] = dict(url="http://localhost/", period=10)
+        self.receiver.add("hello", helper.dumps2utf8(message))
+        message["ncolony.httpcheck"]["period"] = 20
+        message["group"] = ["stuff"]
+        newContents = helper.dumps2utf8(message)
+        self.receiver.update("hello", newContents)
+        ((tp, _, _, _, _, env),) = self.monitor.events
+        self.assertEqual(tp, "ADD")
+        self.assertEqual(env["NCOLONY_CONFIG"], newContents)
+        self.assertEqual(
+            self.logMessages[-1],
+            "Updated monitored process without restarting: hello",
+        )
+        self.assertEqual(self.receiver.stats["unchanged"], 1)
+        self.receiver.message(
+            helper.dumps2utf8(dict(type="RESTART-GROUP", group="stuff"))
+        )
+        self.assertEqual(self.monitor.events[-1], ("RESTART", "hello"))
+        self.receiver.message(
+            helper.dumps2utf8(dict(type="RESTART-GROUP", group="things"))
+        )
+        self.assertEqual(len(self.monitor.events), 2)
+
+    def test_update_changed(self):
+        """Changes to how a process starts restart it"""
+        self.receiver.add("hello", helper.dumps2utf8(dict(args=["/bin/echo", "a"])))
+        newContents = helper.dumps2utf8(dict(args=["/bin/echo", "b"]))
+        self.receiver.update("hello", newContents)
+        self.assertEqual(
+            [event[:3] for event in self.monitor.events],
+            [
+                ("ADD", "hello", ["/bin/echo", "a"]),
+                ("REMOVE", "hello"),
+                ("ADD", "hello", ["/bin/echo", "b"]),
+            ],
+        )
+        self.assertEqual(self.monitor.events[-1][-1]["NCOLONY_CONFIG"], newContents)
+
+    def test_update_heart(self):
+        """Changes to how a process's heart beats restart it"""
+        message = dict(args=["/bin/echo", "hello"])
+        message["ncolony.beatcheck"] = dict(period=10, grace=3, status="status")
+        self.receiver.add("hello", helper.dumps2utf8(message))
+        message["ncolony.beatcheck"]["period"] = 20
+        self.receiver.update("hello", helper.dumps2utf8(message))
+        self.assertEqual(
+            [event[:2] for event in self.monitor.events],
+            [("ADD", "hello"), ("REMOVE", "hello"), ("ADD", "hello")],
+        )
+        self.assertEqual(self.receiver.stats["unchanged"], 0)
+
+    def test_heart_without_status(self):
+        """A heart without a status file does not stop the process starting"""
+        message = dict(args=["/bin/echo", "hello"], group=["things"])
+        message["ncolony.beatcheck"] = dict(period=10, grace=3)
+        self.receiver.add("hello", helper.dumps2utf8(message))
+        self.assertEqual(self.monitor.events[-1][:2], ("ADD", "hello"))
+        message["ncolony.beatcheck"]["period"] = 20
+        self.receiver.update("hello", helper.dumps2utf8(message))
+        self.assertEqual(self.monitor.events[-1][:2], ("ADD", "hello"))
+        self.assertEqual(self.receiver.groups(), dict(things={"hello"}))
+
+    def test_update_inherited_env(self):
+        """Changes to inherited variables restart the process"""
+        message = helper.dumps2utf8(dict(args=["/bin/echo"], env_inherit=["HOME"]))
+        self.receiver.environ = dict(HOME="/a")
+        self.receiver.add("hello", message)
+        self.receiver.environ = dict(HOME="/b")
+        self.receiver.update("hello", message)
+        self.assertEqual(self.monitor.events[-1][-1]["HOME"], "/b")
+
     def test_restart(self):
         """Test a process restart"""
         message = helper.dumps2utf8(dict(type="RESTART", name="hello"))
@@ -196,6 +279,13 @@ class TestReceiver(unittest.TestCase):
         self.receiver.message(message)
         self.assertEqual(self.monitor.events[-1], ("RESTART", "hello"))
 
+    def test_groups(self):
+        """The processes in each group are known"""
+        message = helper.dumps2utf8(dict(args=["/bin/echo"], group=["a", "b"]))
+        self.receiver.add("hello", message)
+        self.receiver.add("goodbye", helper.dumps2utf8(dict(args=["/bin/echo"])))
+        self.assertEqual(self.receiver.groups(), dict(a={"hello"}, b={"hello"}))
+
     def test_restart_empty_group(self):
         """Restarting empty group restarts no processes"""
         message = helper.dumps2utf8(dict(args=["/bin/echo", "hello"], group=["things"]))
@@ -204,3 +294,218 @@ class TestReceiver(unittest.TestCase):
         message = helper.dumps2utf8(dict(type="RESTART-GROUP", group="things"))
         self.receiver.message(message)
         self.assertNotEqual(self.monitor.events[-1][0], "RESTART")
+
+
+class TestCoalescingReceiver(unittest.TestCase):
+
+    """Test gathering restart requests before acting on them"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.monitor = DummyProcessMonitor()
+        self.clock = task.Clock()
+        self.receiver = process_events.Receiver(
+            self.monitor, window=5, reactor=self.clock
+        )
+        for name, groups in [("a", ["web"]), ("b", ["web"]), ("c", [])]:
+            message = helper.dumps2utf8(dict(args=["/bin/echo", name], group=groups))
+            self.receiver.add(name, message)
+        del self.monitor.events[:]
+
+    def send(self, **kwargs):
+        """Send a message to the receiver"""
+        self.receiver.message(helper.dumps2utf8(kwargs))
+
+    def test_coalesce_restarts(self):
+        """Many restarts of the same processes stop each once"""
+        for _ in range(50):
+            self.send(type="RESTART", name="a")
+        self.send(type="RESTART-GROUP", group="web")
+        self.assertFalse(self.monitor.events)
+        self.clock.advance(5)
+        self.assertEqual(self.monitor.events, [("RESTART", "a"), ("RESTART", "b")])
+        self.assertEqual(
+            self.receiver.stats, dict(requested=52, performed=2, suppressed=50)
+        )
+
+    def test_restart_all_wins(self):
+        """A restart of everything makes other restarts redundant"""
+        self.send(type="RESTART", name="a")
+        self.send(type="RESTART-ALL")
+        self.send(type="RESTART-GROUP", group="web")
+        self.clock.advance(5)
+        self.assertEqual(self.monitor.events, [("RESTART-ALL",)])
+        self.assertEqual(
+            self.receiver.stats, dict(requested=6, performed=3, suppressed=3)
+        )
+
+    def test_window(self):
+        """Requests after the window are acted on separately"""
+        self.send(type="RESTART", name="a")
+        self.clock.advance(3)
+        self.send(type="RESTART", name="c")
+        self.clock.advance(2)
+        self.assertEqual(self.monitor.events, [("RESTART", "a"), ("RESTART", "c")])
+        self.send(type="RESTART", name="a")
+        self.clock.advance(5)
+        self.assertEqual(self.monitor.events[-1], ("RESTART", "a"))
+        self.assertEqual(self.receiver.stats["suppressed"], 0)
+
+    def test_removed(self):
+        """Processes removed while waiting are not restarted"""
+        self.send(type="RESTART", name="a")
+        self.receiver.remove("a")
+        self.clock.advance(5)
+        self.assertEqual(self.monitor.events, [("REMOVE", "a")])
+        self.assertEqual(self.receiver.stats["suppressed"], 1)
+
+    def test_immediate_stats(self):
+        """Restarts without a window are counted"""
+        receiver = process_events.Receiver(self.monitor)
+        receiver.message(helper.dumps2utf8(dict(type="RESTART", name="a")))
+        receiver.message(helper.dumps2utf8(dict(type="RESTART-ALL")))
+        self.assertEqual(receiver.stats, dict(requested=1, performed=1, suppressed=0))
+
+
+class TestRollingRestart(unittest.TestCase):
+
+    """Test restarting processes a batch at a time"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.monitor = procmon.ProcessMonitor(reactor=self.reactor)
+        self.receiver = process_events.Receiver(self.monitor, reactor=self.reactor)
+        self.status = os.path.abspath("dummy-status")
+        if os.path.exists(self.status):
+            shutil.rmtree(self.status)
+        os.makedirs(self.status)
+        self.addCleanup(shutil.rmtree, self.status)
+        for name in "abcde":
+            heart = {"period": 10, "grace": 3, "status": self.status}
+            message = dict(args=["/bin/echo", name], group=["web"])
+            message["ncolony.beatcheck"] = heart
+            self.receiver.add(name, helper.dumps2utf8(message))
+        self.monitor.startService()
+        self.reactor.advance(0)
+        self.original = dict(self.monitor.protocols)
+
+    def send(self, **kwargs):
+        """Send a message to the receiver"""
+        self.receiver.message(helper.dumps2utf8(kwargs))
+
+    def restarted(self):
+        """Names of processes whose protocol changed"""
+        return sorted(
+            name
+            for name, protocol in self.monitor.protocols.items()
+            if protocol is not self.original[name]
+        )
+
+    def stopping(self):
+        """Names of processes that were asked to stop"""
+        return sorted(self.monitor.murder)
+
+    def test_batches(self):
+        """Only a batch of processes is restarted at a time"""
+        self.send(type="RESTART-ALL", batch=2)
+        self.assertEqual(self.stopping(), ["a", "b"])
+        self.reactor.advance(1)
+        self.assertEqual(self.restarted(), ["a", "b"])
+        self.assertEqual(self.stopping(), [])
+        self.reactor.advance(1)
+        self.assertEqual(self.stopping(), ["c", "d"])
+        for _ in range(10):
+            self.reactor.advance(1)
+        self.assertEqual(self.restarted(), list("abcde"))
+        self.assertEqual(
+            self.receiver.stats, dict(requested=5, performed=5, suppressed=0)
+        )
+
+    def test_group(self):
+        """A group can be restarted a batch at a time"""
+        self.send(type="RESTART-GROUP", group="web", batch=3)
+        self.assertEqual(self.stopping(), ["a", "b", "c"])
+
+    def test_extend(self):
+        """Requests during a rolling restart join it"""
+        self.send(type="RESTART-GROUP", group="web", batch=1)
+        self.send(type="RESTART", name="a", batch=1)
+        self.assertEqual(self.stopping(), ["a"])
+        self.assertEqual(self.receiver.stats["suppressed"], 1)
+
+    def test_health(self):
+        """With health, restarted processes have to send a heartbeat"""
+        self.send(type="RESTART-ALL", batch=1, health=True, timeout=30)
+        self.reactor.advance(1)
+        self.reactor.advance(1)
+        self.assertEqual(self.restarted(), ["a"])
+        for _ in range(5):
+            self.reactor.advance(1)
+        self.assertEqual(self.restarted(), ["a"])
+        with open(os.path.join(self.status, "a"), "w") as fp:
+            fp.write("beat")
+        self.reactor.advance(1)
+        self.assertEqual(self.stopping(), ["b"])
+
+    def test_health_configuration(self):
+        """Health only waits for processes with a heart"""
+        status = os.path.join(self.status, "g-status")
+        heart = {"period": 10, "grace": 3, "status": status}
+        message = {"args": ["/bin/echo"], "ncolony.beatcheck": heart}
+        self.receiver.add("g", helper.dumps2utf8(message))
+        self.receiver.add("f", helper.dumps2utf8(dict(args=["/bin/echo"])))
+        self.reactor.advance(0)
+        self.original = dict(self.monitor.protocols)
+        self.send(type="RESTART", name="f", batch=1, health=True)
+        self.send(type="RESTART", name="g", batch=1, health=True)
+        for _ in range(20):
+            self.reactor.advance(1)
+        self.assertEqual(self.restarted(), list("fg"))
+        self.assertEqual(self.stopping(), [])
+        self.assertIn("g", self.receiver.rolling.inFlight)
+        with open(status, "w") as fp:
+            fp.write("beat")
+        self.reactor.advance(1)
+        self.assertTrue(self.receiver.rolling.done())
+
+    def test_health_timeout(self):
+        """Processes that never become healthy are waited on only so long"""
+        self.send(type="RESTART-ALL", batch=1, health=True, timeout=30)
+        for _ in range(29):
+            self.reactor.advance(1)
+        self.assertEqual(self.stopping(), [])
+        self.reactor.advance(1)
+        self.assertEqual(self.stopping(), ["b"])
+
+    def test_removed(self):
+        """Processes removed during a rolling restart are not waited on"""
+        self.send(type="RESTART-ALL", batch=1, health=True)
+        self.reactor.advance(1)
+        self.receiver.remove("a")
+        self.receiver.remove("b")
+        self.reactor.advance(1)
+        self.assertEqual(self.stopping(), ["c"])
+
+    def test_down(self):
+        """Processes that are down count towards the batch until they are up"""
+        self.monitor.protocols["a"].transport.signalProcess("KILL")
+        self.reactor.advance(0)
+        self.assertNotIn("a", self.monitor.protocols)
+        self.send(type="RESTART-ALL", batch=1)
+        self.assertEqual(list(self.receiver.rolling.inFlight), ["a"])
+        self.assertEqual(self.stopping(), [])
+        self.reactor.advance(0.5)
+        self.assertEqual(self.stopping(), [])
+        self.reactor.advance(0.5)
+        self.assertIn("a", self.monitor.protocols)
+        self.assertEqual(self.restarted(), ["a"])
+        self.assertEqual(self.stopping(), ["b"])
+
+    def test_not_running(self):
+        """Processes that are not running are not waited on"""
+        self.monitor.stopService()
+        self.reactor.advance(10)
+        self.send(type="RESTART-ALL", batch=1)
+        self.send(type="RESTART-ALL", batch=1)
+        self.assertEqual(self.receiver.stats["suppressed"], 0)
@@ -0,0 +1,220 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.scanner"""
+
+import os
+import shutil
+import time
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from ncolony import directory_monitor, scanner
+
+
+class ThreadlessReactor(task.Clock):
+
+    """A clock that can be called from (pretend) threads"""
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.threadPool = DummyPool()
+
+    def getThreadPool(self):
+        """The reactor's own (pretend) thread pool"""
+        return self.threadPool
+
+    def callFromThread(self, func, *args, **kwargs):
+        """Call the function right away"""
+        func(*args, **kwargs)
+
+
+class DummyPool:
+
+    """A thread pool that runs functions when told to"""
+
+    def __init__(self):
+        self.pending = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kwargs):
+        """Remember the function"""
+        self.pending.append((onResult, func, args, kwargs))
+
+    def stop(self):
+        """Stop no threads"""
+
+    def runAll(self):
+        """Run all the remembered functions"""
+        pending, self.pending = self.pending, []
+        for onResult, func, args, kwargs in pending:
+            try:
+                result = func(*args, **kwargs)
+            except Exception:  # pylint: disable=broad-except
+                onResult(False, failure.Failure())
+            else:
+                onResult(True, result)
+
+
+class TestRead(unittest.TestCase):
+
+    """Test reading configuration files"""
+
+    def setUp(self):
+        """Make a configuration directory"""
+        self.path = os.path.abspath("dummy-config")
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        self.addCleanup(shutil.rmtree, self.path)
+        self.child = os.path.join(self.path, "hello")
+        with open(self.child, "wb") as fp:
+            fp.write(b"content")
+        old = time.time() - 3600
+        os.utime(self.child, (old, old))
+
+    def test_file(self):
+        """Files are only read when they changed"""
+        snapshot = scanner.readFile(self.child)
+        self.assertEqual(snapshot.content, b"content")
+        self.assertEqual(snapshot.mtime, os.path.getmtime(self.child))
+        again = scanner.readFile(self.child, snapshot.fingerprint)
+        self.assertEqual(again.fingerprint, snapshot.fingerprint)
+        self.assertIsNone(again.content)
+
+    def test_racy(self):
+        """Files modified too recently are read again"""
+        os.utime(self.child)
+        snapshot = scanner.readFile(self.child)
+        self.assertIsNone(snapshot.fingerprint)
+        again = scanner.readFile(self.child, snapshot.fingerprint)
+        self.assertEqual(again.content, b"content")
+
+    def test_directory(self):
+        """Regular files in a directory are read when they changed"""
+        os.makedirs(os.path.join(self.path, "subdirectory"))
+        os.symlink("nowhere", os.path.join(self.path, "dangling"))
+        snapshots = scanner.readDirectory(self.path)
+        self.assertEqual(list(snapshots), ["hello"])
+        self.assertEqual(snapshots["hello"].content, b"content")
+        known = dict(hello=snapshots["hello"].fingerprint)
+        snapshots = scanner.readDirectory(self.path, known)
+        self.assertIsNone(snapshots["hello"].content)
+        with open(os.path.join(self.path, "hello.new"), "wb") as fp:
+            fp.write(b"half written")
+        self.assertEqual(list(scanner.readDirectory(self.path)), ["hello"])
+
+    def test_directory_removed_while_reading(self):
+        """Files removed after they are listed are left out"""
+        scan = directory_monitor.scan
+
+        def _scan(path):
+            ret = scan(path)
+            os.remove(self.child)
+            return ret
+
+        self.patch(directory_monitor, "scan", _scan)
+        self.assertEqual(scanner.readDirectory(self.path), {})
+
+    def test_inline(self):
+        """Inline reads fire right away"""
+        d = scanner.inline("key", scanner.readFile, self.child)
+        self.assertEqual(self.successResultOf(d).content, b"content")
+
+
+class TestScanner(unittest.TestCase):
+
+    """Test reading in threads"""
+
+    def setUp(self):
+        """Make a scanner with a pretend thread pool"""
+        self.reactor = ThreadlessReactor()
+        self.scanner = scanner.Scanner(self.reactor, size=2, timeout=5)
+        self.pool = self.scanner.pool = DummyPool()
+
+    def test_run(self):
+        """Reads are run in the pool"""
+        d = self.scanner.run("key", sum, [1, 2])
+        self.assertNoResult(d)
+        self.pool.runAll()
+        self.assertEqual(self.successResultOf(d), 3)
+
+    def test_busy(self):
+        """Only one read with a key runs at a time"""
+        first = self.scanner.run("key", sum, [1, 2])
+        second = self.scanner.run("key", sum, [1, 2])
+        self.failureResultOf(second, scanner.BusyError)
+        other = self.scanner.run("other", sum, [1, 2])
+        self.pool.runAll()
+        self.assertEqual(self.successResultOf(first), 3)
+        self.assertEqual(self.successResultOf(other), 3)
+        third = self.scanner.run("key", sum, [1, 2])
+        self.assertNoResult(third)
+
+    def test_timeout(self):
+        """Slow reads time out, but keep the key until they finish"""
+        d = self.scanner.run("key", sum, [1, 2])
+        self.reactor.advance(5)
+        self.failureResultOf(d, defer.TimeoutError)
+        self.failureResultOf(self.scanner.run("key", sum, [1, 2]), scanner.BusyError)
+        self.pool.runAll()
+        d = self.scanner.run("key", sum, [None])
+        self.reactor.advance(5)
+        self.failureResultOf(d, defer.TimeoutError)
+        self.pool.runAll()
+        self.assertNoResult(self.scanner.run("key", sum, [1, 2]))
+
+    def test_no_timeout(self):
+        """Without a timeout, reads take as long as they take"""
+        self.scanner.timeout = None
+        d = self.scanner.run("key", sum, [1, 2])
+        self.reactor.advance(1000)
+        self.assertNoResult(d)
+        self.pool.runAll()
+        self.assertEqual(self.successResultOf(d), 3)
+
+    def test_read(self):
+        """Directories are read with their path as the key"""
+        d = self.scanner.read("/does/not/exist", dict(hello=None))
+        self.failureResultOf(self.scanner.read("/does/not/exist"), scanner.BusyError)
+        self.pool.runAll()
+        self.failureResultOf(d, FileNotFoundError)
+
+    def test_service(self):
+        """The threads are started and stopped with the service"""
+        real = scanner.Scanner(self.reactor, size=2)
+        real.startService()
+        self.assertTrue(real.pool.started)
+        d = real.stopService()
+        self.assertTrue(real.pool.started)
+        self.assertNoResult(d)
+        self.reactor.threadPool.runAll()
+        self.assertFalse(real.pool.started)
+        self.assertIsNone(self.successResultOf(d))
+        self.assertEqual(real.pool.max, 2)
+
+    def test_service_timeout(self):
+        """Shutdown does not wait on reads for longer than the timeout"""
+        d = self.scanner.stopService()
+        self.reactor.advance(4)
+        self.assertNoResult(d)
+        self.reactor.advance(1)
+        self.assertIsNone(self.successResultOf(d))
+        self.reactor.threadPool.runAll()
+        self.assertIsNone(self.successResultOf(d))
+
+
+class TestSkipped(unittest.TestCase):
+
+    """Test skipping checks"""
+
+    def test_skipped(self):
+        """Busy and slow reads are skipped"""
+        for error in (scanner.BusyError("key"), defer.TimeoutError()):
+            self.assertIsNone(scanner.skipped(failure.Failure(error), "key"))
+
+    def test_other(self):
+        """Other failures are passed on"""
+        reason = failure.Failure(ValueError())
+        with self.assertRaises(ValueError):
+            scanner.skipped(reason, "key")
@@ -5,6 +5,8 @@
 
 from __future__ import division
 
+import datetime
+import json
 import os
 import unittest
 import sys
@@ -14,7 +16,7 @@ from zope.interface import verify
 
 from twisted.python import failure
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet import interfaces as tiinterfaces
 from twisted.internet import reactor
 
@@ -22,7 +24,8 @@ from twisted.application import internet as tainternet
 
 from twisted.runner.test import test_procmon
 
-from ncolony import schedulelib
+from ncolony import cron, schedulelib
+from ncolony.tests import test_cron
 
 from ncolony.client.tests import test_heart
 
@@ -66,6 +69,12 @@ class TestProcessProtocol(unittest.TestCase):
         self.deferred.addErrback(result.append)
         self.assertIs(result[0], myfail)
 
+    def test_end_cancelled(self):
+        """Test process end after the deferred was cancelled"""
+        self.deferred.addErrback(lambda reason: reason.trap(defer.CancelledError))
+        self.deferred.cancel()
+        self.pp.processEnded(failure.Failure(ValueError("nonono")))
+
     def test_implements(self):
         """Test object implements the right interface"""
         self.assertTrue(verify.verifyObject(tiinterfaces.IProcessProtocol, self.pp))
@@ -202,6 +211,282 @@ class TestRunProcess(unittest.TestCase):
         deferred.errback(failure.Failure(ValueError("HAHA")))
         (dummy,) = results
 
+    def test_run_process_cancel(self):
+        """Test cancelling kills the process"""
+        args = ["/bin/echo", "hello"]
+        results = []
+        deferred = schedulelib.runProcess(args, 10, 2.5, self.reactor)
+        deferred.addErrback(results.append)
+        (process,) = self.reactor.spawnedProcesses
+        terminate, kill = self.reactor.getDelayedCalls()
+        deferred.cancel()
+        self.assertFalse(terminate.active())
+        self.assertFalse(kill.active())
+        (reason,) = results
+        reason.trap(defer.CancelledError)
+        self.reactor.advance(0)
+        self.assertIsNone(process.pid)
+        self.assertEqual(sys.stdout.getvalue(), "")
+
+    def test_run_process_cancel_exited(self):
+        """Test cancelling a process that exited, with pipes still open"""
+        args = ["/bin/echo", "hello"]
+        results = []
+        deferred = schedulelib.runProcess(args, 10, 2.5, self.reactor)
+        deferred.addErrback(results.append)
+        (process,) = self.reactor.spawnedProcesses
+        process.pid = None
+        deferred.cancel()
+        (reason,) = results
+        reason.trap(defer.CancelledError)
+
+
+# pylint: disable=abstract-method
+
+
+class BrokenProcessReactor(test_procmon.DummyProcessReactor):
+
+    """A reactor that cannot run processes"""
+
+    def spawnProcess(self, *args, **kwargs):
+        """Fail to run a process"""
+        raise OSError("no processes here")
+
+
+# pylint: enable=abstract-method
+
+
+class TestRunner(unittest.TestCase):
+
+    """Test schedulelib.Runner"""
+
+    def setUp(self):
+        self.reactor = test_procmon.DummyProcessReactor()
+        out = StringIO()
+        oldstdout = sys.stdout
+
+        def _cleanup():
+            sys.stdout = oldstdout
+
+        self.addCleanup(_cleanup)
+        sys.stdout = out
+
+    def job(self, name="echo", overlap="skip"):
+        """Make a job"""
+        return schedulelib.Job(
+            name=name,
+            args=["/bin/echo", name],
+            frequency=10,
+            timeout=5,
+            grace=1,
+            overlap=overlap,
+        )
+
+    def running(self):
+        """Get the arguments of processes that did not end"""
+        return [
+            process._args[1]  # pylint: disable=protected-access
+            for process in self.reactor.spawnedProcesses
+            if process.pid is not None
+        ]
+
+    def test_skip(self):
+        """Jobs whose last run is still going are skipped"""
+        runner = schedulelib.Runner(self.reactor)
+        runner.run(self.job())
+        runner.run(self.job())
+        self.assertEqual(self.running(), ["echo"])
+        self.assertIn("Skipping echo", sys.stdout.getvalue())
+        self.reactor.spawnedProcesses[0].processEnded(0)
+        self.assertEqual(runner.running, {})
+        runner.run(self.job())
+        self.assertEqual(len(self.reactor.spawnedProcesses), 2)
+
+    def test_queue(self):
+        """Jobs can wait for their last run to end, once"""
+        runner = schedulelib.Runner(self.reactor)
+        for _ in range(3):
+            runner.run(self.job(overlap="queue"))
+        self.assertEqual(len(self.reactor.spawnedProcesses), 1)
+        self.reactor.spawnedProcesses[0].processEnded(0)
+        self.assertEqual(self.running(), ["echo"])
+        self.assertEqual(len(self.reactor.spawnedProcesses), 2)
+        self.assertEqual(runner.queued, set())
+
+    def test_kill(self):
+        """Jobs can kill their last run"""
+        runner = schedulelib.Runner(self.reactor)
+        runner.run(self.job(overlap="kill"))
+        runner.run(self.job(overlap="kill"))
+        first, second = self.reactor.spawnedProcesses
+        self.reactor.advance(0)
+        self.assertIsNone(first.pid)
+        self.assertIsNotNone(second.pid)
+        self.assertIn("Killing last run of echo", sys.stdout.getvalue())
+        self.assertEqual(list(runner.running), ["echo"])
+
+    def test_limit(self):
+        """Only so many jobs run at a time"""
+        runner = schedulelib.Runner(self.reactor, maxRunning=2)
+        for name in ("a", "b", "c"):
+            runner.run(self.job(name))
+        self.assertEqual(self.running(), ["a", "b"])
+        runner.run(self.job("c", overlap="kill"))
+        self.assertEqual(self.running(), ["a", "b"])
+        self.reactor.spawnedProcesses[0].processEnded(0)
+        self.assertEqual(self.running(), ["b", "c"])
+        self.assertEqual(sorted(runner.running), ["b", "c"])
+
+    def test_failed(self):
+        """Jobs that cannot be run are reported"""
+        runner = schedulelib.Runner(BrokenProcessReactor())
+        runner.run(self.job())
+        self.assertIn("Running echo failed: no processes here", sys.stdout.getvalue())
+        self.assertEqual(runner.running, {})
+
+    def test_parse_jobs(self):
+        """Jobs are read from JSON"""
+        content = json.dumps(
+            dict(
+                b=dict(args=["/bin/b"], frequency=10, timeout=5, grace=1),
+                a=dict(
+                    args=["/bin/a"], frequency=1, timeout=1, grace=1, overlap="kill"
+                ),
+            )
+        )
+        first, second = schedulelib.parseJobs(content)
+        self.assertEqual(first, schedulelib.Job("a", ["/bin/a"], 1, 1, 1, "kill"))
+        self.assertEqual((second.name, second.overlap), ("b", "skip"))
+        content = json.dumps(
+            dict(a=dict(args=["/bin/a"], frequency=1, timeout=1, grace=1, overlap="no"))
+        )
+        with self.assertRaises(ValueError):
+            schedulelib.parseJobs(content)
+
+
+class TestJobTimer(unittest.TestCase):
+
+    """Test schedulelib.JobTimer"""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.runs = []
+
+    def timer(self, **kwargs):
+        """Make a timer for a job"""
+        details = dict(name="echo", args=["/bin/echo"], timeout=5, grace=1)
+        details.update(kwargs)
+        job = schedulelib.makeJob(**details)
+        ret = schedulelib.JobTimer(job, self.ran, self.clock)
+        self.addCleanup(ret.stopService)
+        return ret
+
+    def ran(self, job):
+        """Note that a job ran"""
+        self.runs.append((self.clock.seconds(), job.name))
+
+    def times(self):
+        """When jobs ran"""
+        return [when for when, _ in self.runs]
+
+    def test_frequency(self):
+        """Jobs run every frequency, without making up for missed runs"""
+        timer = self.timer(frequency=10)
+        timer.startService()
+        self.clock.advance(0)
+        self.clock.advance(10)
+        self.assertEqual(self.runs, [(0, "echo"), (10, "echo")])
+        self.clock.advance(35)
+        self.assertEqual(self.times(), [0, 10, 45])
+        self.clock.advance(5)
+        self.assertEqual(self.times(), [0, 10, 45, 50])
+
+    def test_splay(self):
+        """Runs are delayed by the splay"""
+        timer = self.timer(frequency=10, splay=5)
+        timer.splay = lambda: 4
+        timer.startService()
+        self.clock.advance(4)
+        self.clock.advance(10)
+        self.assertEqual(self.times(), [4, 14])
+
+    def test_cron(self):
+        """Jobs run when their cron schedule is due"""
+        start = datetime.datetime(2026, 10, 18, 12, 1).timestamp()
+        self.clock.advance(start)
+        timer = self.timer(cron="*/5 * * * *")
+        timer.startService()
+        self.clock.advance(240)
+        self.clock.advance(300)
+        self.assertEqual(self.times(), [start + 240, start + 540])
+
+    def test_cron_fall_back(self):
+        """Jobs run once per due time when clocks go back"""
+        test_cron.useTimezone(self, "America/New_York")
+        start = datetime.datetime(2026, 11, 1, 1, 50, fold=1).timestamp()
+        self.clock.advance(start)
+        timer = self.timer(cron="*/5 * * * *")
+        timer.startService()
+        self.clock.pump([300] * 3)
+        self.assertEqual(self.times(), [start + 300, start + 600, start + 900])
+
+    def test_long_splay(self):
+        """A splay longer than the frequency does not bunch up runs"""
+        timer = self.timer(frequency=10, splay=30)
+        timer.splay = lambda: 25
+        timer.startService()
+        self.clock.pump([25, 10, 10, 10, 10])
+        self.assertEqual(self.times(), [25, 55])
+
+    def test_run_fails(self):
+        """A run that fails does not stop the job"""
+        timer = self.timer(frequency=10)
+
+        def _fail(job):
+            self.ran(job)
+            raise ValueError("no run")
+
+        timer.run = _fail
+        timer.startService()
+        for step in (0, 10):
+            with self.assertRaises(ValueError):
+                self.clock.advance(step)
+        self.assertEqual(self.times(), [0, 10])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_stop(self):
+        """Stopping cancels the next run"""
+        timer = self.timer(frequency=10)
+        timer.startService()
+        timer.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_splay_delay(self):
+        """Delays are spread by host and job, or random"""
+        job = schedulelib.makeJob(
+            name="a", args=["/bin/a"], frequency=1, timeout=1, grace=1, splay=10
+        )
+        delays = [schedulelib.splayDelay(job, host) for host in ("a", "b", "a")]
+        self.assertEqual(delays[0], delays[2])
+        self.assertNotEqual(delays[0], delays[1])
+        self.assertTrue(all(0 <= delay < 10 for delay in delays))
+        other = schedulelib.splayDelay(job._replace(name="b"), "a")
+        self.assertNotEqual(other, delays[0])
+        job = job._replace(splayBy="random")
+        self.assertEqual(schedulelib.splayDelay(job, "a", lambda: 0.5), 5)
+
+    def test_bad_jobs(self):
+        """Jobs that do not make sense are rejected"""
+        details = dict(name="a", args=["/bin/a"], timeout=1, grace=1)
+        for extra in (
+            dict(),
+            dict(frequency=1, cron="@daily"),
+            dict(frequency=1, overlap="never"),
+            dict(frequency=1, splayBy="dice"),
+        ):
+            with self.assertRaises(ValueError):
+                schedulelib.makeJob(**details, **extra)
+
 
 class TestService(unittest.TestCase):
 
@@ -249,6 +534,12 @@ class TestService(unittest.TestCase):
         """Test that frequency is required"""
         self.helper_test_required("frequency")
 
+    def test_never_due(self):
+        """Cron expressions that are never due are rejected"""
+        self.args.pop("frequency")
+        with self.assertRaises(ValueError):
+            self.parser.parseOptions(self.getArgs() + ["--cron", "0 0 30 2 *"])
+
     def test_make_service(self):
         """Test the make service function"""
         opts = {}
@@ -265,6 +556,64 @@ class TestService(unittest.TestCase):
         self.assertEqual(args, (opts["args"], opts["timeout"], opts["grace"], reactor))
         self.assertEqual(service.step, opts["frequency"])
 
+    def test_jobs(self):
+        """Test parsing a command line with jobs"""
+        self.parser.parseOptions(["--jobs", "jobs.json", "--max-running", "3"])
+        self.assertEqual(self.parser["jobs"], "jobs.json")
+        self.assertEqual(self.parser["max-running"], 3)
+        with self.assertRaises(ValueError):
+            schedulelib.Options().parseOptions(self.getArgs() + ["--jobs", "jobs.json"])
+
+    def test_make_service_jobs(self):
+        """Test the make service function, with jobs"""
+        path = os.path.abspath("dummy-jobs.json")
+        self.addCleanup(os.remove, path)
+        jobs = dict(
+            a=dict(args=["/bin/a"], frequency=10, timeout=5, grace=1),
+            b=dict(args=["/bin/b"], frequency=30, timeout=5, grace=1),
+        )
+        with open(path, "w") as fp:
+            json.dump(jobs, fp)
+        opts = {"jobs": path, "max-running": 1}
+        masterService = schedulelib.makeService(opts)
+        scheduler = masterService.getServiceNamed("scheduler")
+        timers = sorted(scheduler, key=lambda timer: timer.name)
+        self.assertEqual([timer.name for timer in timers], ["a", "b"])
+        self.assertEqual([timer.job.frequency for timer in timers], [10, 30])
+        runner = timers[0].run.__self__
+        self.assertIsInstance(runner, schedulelib.Runner)
+        self.assertIs(runner.reactor, reactor)
+        self.assertIs(timers[0].reactor, reactor)
+        self.assertEqual(runner.limit.limit, 1)
+        self.assertEqual(timers[0].job.args, ["/bin/a"])
+
+    def test_make_service_cron(self):
+        """Test the make service function, with a cron schedule and splay"""
+        self.args.pop("frequency")
+        self.parser.parseOptions(
+            self.getArgs() + ["--cron", "@hourly", "--splay", "60"]
+        )
+        masterService = schedulelib.makeService(self.parser)
+        (timer,) = masterService.getServiceNamed("scheduler")
+        self.assertEqual(timer.name, "/bin/echo hello")
+        self.assertEqual(timer.job.cron, cron.parse("0 * * * *"))
+        self.assertEqual(timer.job.splay, 60)
+        self.assertEqual(timer.job.splayBy, "hash")
+        self.assertIsNone(timer.job.frequency)
+        opts = dict(args=["/bin/echo"], timeout=10, grace=2, frequency=30, splay=5)
+        (timer,) = schedulelib.makeService(opts).getServiceNamed("scheduler")
+        self.assertEqual(timer.job.frequency, 30)
+
+    def test_make_service_stats(self):
+        """Test the make service function, writing stats"""
+        opts = dict(timeout=10, grace=2, frequency=30, stats="stats.json")
+        opts["args"] = ["/bin/echo", "hello"]
+        masterService = schedulelib.makeService(opts)
+        self.assertEqual(masterService.getServiceNamed("stats").path, "stats.json")
+        service = masterService.getServiceNamed("scheduler")
+        func, _, _ = service.call
+        self.assertIsNot(func, schedulelib.runProcess)
+
     def test_make_service_with_health(self):
         """Test schedulelib with heart beater"""
         opts = dict(timeout=10, grace=2, frequency=30)
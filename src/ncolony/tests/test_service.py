@@ -7,17 +7,17 @@ import collections
 import json
 import os
 import shutil
-import unittest
-
+import sys
 from zope.interface import verify
 
-from twisted.python import usage
-from twisted.internet import reactor
+from twisted.python import filepath, usage
+from twisted.internet import defer, reactor, task, threads
+from twisted.trial import unittest
 from twisted.application import service as taservice, internet
 from twisted.runner import procmon
 from twisted.runner.test import test_procmon
 
-from ncolony import service
+from ncolony import directory_monitor, service, shard, statustable
 
 
 class DummyFile:
@@ -57,6 +57,13 @@ class TestTransportDirectoryDict(unittest.TestCase):
     def setUp(self):
         self.file = DummyFile("")
         self.tdd = service.TransportDirectoryDict(self.file)
+        self.warnings = self.flushWarnings([self.setUp])
+
+    def test_deprecated(self):
+        """Making one warns that it is deprecated"""
+        (warning,) = self.warnings
+        self.assertIs(warning["category"], DeprecationWarning)
+        self.assertIn("PidPublisher", warning["message"])
 
     def test_add_remove(self):
         """Test adding a file and then removing it"""
@@ -70,6 +77,158 @@ class TestTransportDirectoryDict(unittest.TestCase):
         self.assertEqual(thing.removed, True)
 
 
+class TestPidPublisher(unittest.TestCase):
+
+    """Test publishing pids"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.output = filepath.FilePath(os.path.abspath("dummy-pids"))
+        if self.output.exists():
+            self.output.remove()
+        self.output.createDirectory()
+        self.addCleanup(self.output.remove)
+        self.index = self.output.child("index.json")
+        self.clock = task.Clock()
+        self.writes = []
+        self.publisher = service.PidPublisher(
+            self.clock,
+            output=self.output,
+            index=self.index,
+            delay=1,
+            runner=self.runner,
+        )
+        self.protocols = service.PublishingDict(self.publisher)
+
+    def runner(self, func, *args):
+        """Remember a function to run in a thread"""
+        d = defer.Deferred()
+        self.writes.append((d, func, args))
+        return d
+
+    def finishWrite(self):
+        """Run the function that was to run in a thread"""
+        d, func, args = self.writes.pop(0)
+        d.callback(func(*args))
+
+    def content(self):
+        """Pid files and index contents"""
+        files = {
+            child.basename(): child.getContent()
+            for child in self.output.children()
+            if child != self.index
+        }
+        index = json.loads(self.index.getContent()) if self.index.exists() else None
+        return files, index
+
+    def test_stopped(self):
+        """Changes are written right away when the service is not running"""
+        self.protocols["foo"] = DummyTransport(100)
+        self.assertEqual(self.content(), ({"foo": b"100"}, {"foo": 100}))
+        del self.protocols["foo"]
+        self.assertEqual(self.content(), ({}, {}))
+        self.assertFalse(self.writes)
+
+    def test_batch(self):
+        """Changes are gathered, coalesced and written in a thread"""
+        self.publisher.startService()
+        self.protocols["foo"] = DummyTransport(100)
+        self.protocols["bar"] = DummyTransport(200)
+        del self.protocols["foo"]
+        self.protocols["foo"] = DummyTransport(101)
+        self.clock.advance(0.5)
+        self.assertFalse(self.writes)
+        self.clock.advance(0.5)
+        ((_, _, (pids, snapshot)),) = self.writes
+        self.assertEqual(pids, dict(foo=101, bar=200))
+        self.assertEqual(snapshot, dict(foo=101, bar=200))
+        self.assertEqual(self.content(), ({}, None))
+        self.finishWrite()
+        expected = dict(foo=101, bar=200)
+        self.assertEqual(self.content(), ({"foo": b"101", "bar": b"200"}, expected))
+
+    def test_write_in_progress(self):
+        """Changes while writing are written afterwards"""
+        self.publisher.startService()
+        self.protocols["foo"] = DummyTransport(100)
+        self.clock.advance(1)
+        del self.protocols["foo"]
+        self.clock.advance(5)
+        self.assertEqual(len(self.writes), 1)
+        self.finishWrite()
+        self.clock.advance(1)
+        self.finishWrite()
+        self.assertEqual(self.content(), ({}, {}))
+
+    def test_protocol(self):
+        """Pids are found through the protocol's transport"""
+        self.publisher.startService()
+        protocol = procmon.LoggingProtocol()
+        self.protocols["foo"] = protocol
+        protocol.transport = DummyTransport(100)
+        self.protocols["bar"] = procmon.LoggingProtocol()
+        self.clock.advance(1)
+        self.finishWrite()
+        self.assertEqual(self.content(), ({"foo": b"100"}, {"foo": 100}))
+
+    def test_error(self):
+        """Errors are logged, and do not stop publishing"""
+        self.publisher.startService()
+        self.protocols["foo"] = DummyTransport(100)
+        self.clock.advance(1)
+        d, _, _ = self.writes.pop()
+        d.errback(OSError("disk full"))
+        self.assertEqual(len(self.flushLoggedErrors(OSError)), 1)
+        self.protocols["bar"] = DummyTransport(200)
+        self.clock.advance(1)
+        self.finishWrite()
+        self.assertEqual(self.content()[1], {"foo": 100, "bar": 200})
+
+    def test_stop(self):
+        """Stopping writes the gathered changes"""
+        self.publisher.startService()
+        self.protocols["foo"] = DummyTransport(100)
+        self.publisher.stopService()
+        self.assertEqual(self.content(), ({"foo": b"100"}, {"foo": 100}))
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_stop_while_writing(self):
+        """Stopping waits for the write in progress"""
+        self.publisher.startService()
+        self.protocols["foo"] = DummyTransport(100)
+        self.clock.advance(1)
+        self.protocols["bar"] = DummyTransport(200)
+        d = self.publisher.stopService()
+        self.assertEqual(self.content(), ({}, None))
+        self.finishWrite()
+        self.assertIsNone(self.successResultOf(d))
+        self.assertEqual(self.content()[0], {"foo": b"100", "bar": b"200"})
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_directory_only(self):
+        """Pids can be published without an index"""
+        publisher = service.PidPublisher(self.clock, output=self.output)
+        publisher.set("foo", DummyTransport(100))
+        self.assertEqual(self.content(), ({"foo": b"100"}, None))
+
+    def test_index_only(self):
+        """Pids can be published without a directory"""
+        publisher = service.PidPublisher(self.clock, index=self.index)
+        publisher.set("foo", DummyTransport(100))
+        self.assertEqual(self.content(), ({}, {"foo": 100}))
+
+    def test_never_started(self):
+        """Processes that did not start have no pid file to remove"""
+        self.protocols["foo"] = procmon.LoggingProtocol()
+        del self.protocols["foo"]
+        self.assertEqual(self.content(), ({}, {}))
+
+    def test_default_runner(self):
+        """Pids are written in a thread by default"""
+        publisher = service.PidPublisher(reactor, index=self.index)
+        self.assertIs(publisher.runner, threads.deferToThread)
+
+
 # pylint: disable=protected-access
 
 
@@ -117,10 +276,149 @@ class TestService(unittest.TestCase):
             pidDir=pidDir,
             reactor=self.my_reactor,
         )
+        publisher = self.service.getServiceNamed("pids")
+        self.assertEqual(list(self.service)[0], publisher)
+        self.service.removeService(publisher)
         self._finishSetUp()
         protocols = self.pm.protocols
-        self.assertIsInstance(protocols, service.TransportDirectoryDict)
-        self.assertIs(protocols.output, pidDir)
+        self.assertIsInstance(protocols, service.PublishingDict)
+        self.assertEqual(protocols.publishers, (publisher,))
+        self.assertIs(publisher.output, pidDir)
+        self.assertIsNone(publisher.index)
+        self.assertEqual(publisher.delay, 0)
+
+    def test_with_inotify(self):
+        """Test service watching the configuration with inotify"""
+        self.service = service.get(
+            self.testDirs["config"],
+            self.testDirs["messages"],
+            5,
+            reactor=self.my_reactor,
+            inotify=True,
+        )
+        watcher = self.service.getServiceNamed("confwatch")
+        self.assertIsInstance(watcher, directory_monitor.Watcher)
+        self.assertEqual(watcher.location, self.testDirs["config"])
+        self.assertEqual(watcher.mask, directory_monitor.CONFIG_MASK)
+        self.service.removeService(watcher)
+        messageWatcher = self.service.getServiceNamed("messagewatch")
+        self.assertIsInstance(messageWatcher, directory_monitor.Watcher)
+        self.assertEqual(messageWatcher.location, self.testDirs["messages"])
+        self.assertEqual(messageWatcher.mask, directory_monitor.MESSAGES_MASK)
+        self.service.removeService(messageWatcher)
+        self._finishSetUp()
+        content = json.dumps(dict(args=["/bin/echo", "hello"]))
+        self._write("config", "one", content)
+        watcher.check(set(["one"]))
+        (process,) = self.my_reactor.spawnedProcesses
+        self.assertEqual(process._args, ["/bin/echo", "hello"])
+        restart = json.dumps(dict(type="RESTART", name="one"))
+        self._write("messages", "00Message", restart)
+        messageWatcher.check(set(["00Message"]))
+        self.my_reactor.advance(60)
+        process, _ = self.my_reactor.spawnedProcesses
+        self.assertFalse(process.pid)
+
+    def test_shards(self):
+        """Test service running processes with worker supervisors"""
+        shardRoot = os.path.join(os.getcwd(), "shards")
+        self.addCleanup(shutil.rmtree, shardRoot)
+        self.service = service.get(
+            self.testDirs["config"],
+            self.testDirs["messages"],
+            5,
+            reactor=self.my_reactor,
+            shards=2,
+            shardRoot=shardRoot,
+            shardArgs=["--inotify"],
+        )
+        self._finishSetUp()
+        first, second = sorted(
+            self.my_reactor.spawnedProcesses, key=lambda process: process._args
+        )
+        places = shard.makePlaces(shardRoot, 2)
+        self.assertEqual(
+            first._args,
+            [sys.executable, "-m", "twisted", "ncolony"]
+            + ["--config", places[0].config, "--messages", places[0].messages]
+            + ["--frequency", "5", "--inotify"],
+        )
+        self.assertEqual(second._args[5], places[1].config)
+        self.assertEqual(first._environment, os.environ)
+        content = json.dumps(dict(args=["/bin/echo", "hello"]))
+        self._write("config", "one", content)
+        stale = os.path.join(places[0].config, "stale")
+        filepath.FilePath(stale).touch()
+        self._check()
+        self.assertFalse(os.path.exists(stale))
+        place = places[shard.shardFor("one", 2)]
+        self.assertEqual(os.listdir(place.config), ["one"])
+        self.assertEqual(len(self.my_reactor.spawnedProcesses), 2)
+        restart = json.dumps(dict(type="RESTART", name="one"))
+        self._write("messages", "00Message", restart)
+        self._check()
+        self.assertEqual(len(os.listdir(place.messages)), 1)
+
+    def test_status_table(self):
+        """Test service publishing a status table"""
+        tablePath = os.path.join(os.getcwd(), "status-table")
+        self.addCleanup(os.remove, tablePath)
+        self.service = service.get(
+            self.testDirs["config"],
+            self.testDirs["messages"],
+            5,
+            reactor=self.my_reactor,
+            statusTable=tablePath,
+            statusCapacity=10,
+        )
+        self._finishSetUp()
+        self.assertEqual(
+            os.path.getsize(tablePath),
+            statustable.HEADER.size + 10 * statustable.RECORD_SIZE,
+        )
+        (publisher,) = self.pm.protocols.publishers
+        self.assertIsInstance(publisher, statustable.StatusPublisher)
+        self.addCleanup(publisher.table.close)
+        content = json.dumps(dict(args=["/bin/echo", "hello"]))
+        self._write("config", "one", content)
+        self._check()
+        self.my_reactor.advance(0)
+        (process,) = self.my_reactor.spawnedProcesses
+        state = statustable.read(tablePath)["one"]
+        self.assertEqual(state.pid, process.pid)
+        self._remove("config", "one")
+        self._check()
+        self.assertEqual(statustable.read(tablePath), {})
+        self.my_reactor.advance(10)
+        self.assertNotIn("one", self.pm.protocols)
+        self.assertEqual(statustable.read(tablePath), {})
+
+    def test_metrics(self):
+        """Test service serving metrics"""
+        self.service = service.get(
+            self.testDirs["config"],
+            self.testDirs["messages"],
+            5,
+            reactor=self.my_reactor,
+            metrics="tcp:0:interface=127.0.0.1",
+        )
+        server = self.service.getServiceNamed("metrics")
+        self.service.removeService(server)
+        self._finishSetUp()
+        content = json.dumps(dict(args=["/bin/echo", "hello"], group=["things"]))
+        self._write("config", "one", content)
+        self._check()
+        restart = json.dumps(dict(type="RESTART", name="one"))
+        self._write("messages", "00Message", restart)
+        self._check()
+        self.my_reactor.advance(60)
+        lines = server.factory.resource.metrics.render().splitlines()
+        self.assertIn("ncolony_processes 1", lines)
+        self.assertIn('ncolony_process_restarts_total{name="one"} 1', lines)
+        self.assertIn('ncolony_group_restarts_total{group="things"} 1', lines)
+        self.assertIn("ncolony_restarts_performed_total 1", lines)
+        self.assertIn("ncolony_spawn_latency_seconds_count 1", lines)
+        self.assertIn("ncolony_messages_dispatch_seconds_count 1", lines)
 
     def test_regular_reactor(self):
         """Test that the default reactor is the default reactor"""
@@ -178,6 +476,30 @@ class TestService(unittest.TestCase):
         process, _ = self.my_reactor.spawnedProcesses
         self.assertFalse(process.pid)
 
+    def test_restart_window(self):
+        """Test that the service gathers restarts during the window"""
+        self.service = service.get(
+            self.testDirs["config"],
+            self.testDirs["messages"],
+            5,
+            reactor=self.my_reactor,
+            restartWindow=30,
+        )
+        self._finishSetUp()
+        content = json.dumps(dict(args=["/bin/echo", "hello"]))
+        self._write("config", "one", content)
+        self._check()
+        restart = json.dumps(dict(type="RESTART", name="one"))
+        self._write("messages", "00Message", restart)
+        self._check()
+        self.my_reactor.advance(10)
+        (process,) = self.my_reactor.spawnedProcesses
+        self.assertTrue(process.pid)
+        self.my_reactor.advance(20)
+        self.my_reactor.advance(60)
+        process, _ = self.my_reactor.spawnedProcesses
+        self.assertFalse(process.pid)
+
 
 class TestOptions(unittest.TestCase):
 
@@ -204,6 +526,79 @@ class TestOptions(unittest.TestCase):
         self.assertEqual(self.opt["maxrestartdelay"], 3600)
         self.assertEqual(self.opt["frequency"], 10)
         self.assertEqual(self.opt["pid"], None)
+        self.assertFalse(self.opt["inotify"])
+        self.assertEqual(self.opt["restart-window"], 0)
+        self.assertEqual(self.opt["shards"], 0)
+        self.assertIsNone(self.opt["shard-root"])
+        self.assertIsNone(self.opt["pid-index"])
+        self.assertEqual(self.opt["pid-delay"], 0)
+        self.assertIsNone(self.opt["status-table"])
+        self.assertEqual(self.opt["status-capacity"], 4096)
+
+    def test_pid_index(self):
+        """Test explicit pid index and delay"""
+        self.opt.parseOptions(self.basic + ["--pid-index", "p"] + ["--pid-delay", "1"])
+        self.assertEqual(self.opt["pid-index"], "p")
+        self.assertEqual(self.opt["pid-delay"], 1)
+
+    def test_pid_index_shards(self):
+        """Test failure on a pid index, or metrics, with shards"""
+        with self.assertRaises(usage.UsageError):
+            self.opt.parseOptions(
+                self.basic + ["--pid-index", "p", "--shards", "2", "--shard-root", "s"]
+            )
+        with self.assertRaises(usage.UsageError):
+            service.Options().parseOptions(
+                self.basic
+                + ["--metrics", "tcp:0", "--shards", "2", "--shard-root", "s"]
+            )
+
+    def test_makeservice_pid_index(self):
+        """Test makeService with a pid index, writing stats"""
+        self.opt.parseOptions(
+            self.basic + ["--pid-index", "pids.json", "--stats", "stats.json"]
+        )
+        s = service.makeService(self.opt)
+        (publisher,) = s.getServiceNamed("procmon").protocols.publishers
+        self.assertIsNone(publisher.output)
+        self.assertEqual(publisher.index, filepath.FilePath("pids.json"))
+        statsFile = s.getServiceNamed("stats")
+        self.assertEqual(statsFile.path, "stats.json")
+        self.assertIs(s.getServiceNamed("lag").stats, statsFile.stats)
+
+    def test_status_table(self):
+        """Test explicit status table, which cannot be used with shards"""
+        self.opt.parseOptions(
+            self.basic + ["--status-table", "t", "--status-capacity", "10"]
+        )
+        self.assertEqual(self.opt["status-table"], "t")
+        self.assertEqual(self.opt["status-capacity"], 10)
+        with self.assertRaises(usage.UsageError):
+            service.Options().parseOptions(
+                self.basic
+                + ["--status-table", "t", "--shards", "2", "--shard-root", "s"]
+            )
+
+    def test_shards(self):
+        """Test explicit shards"""
+        self.opt.parseOptions(self.basic + ["--shards", "4", "--shard-root", "s"])
+        self.assertEqual(self.opt["shards"], 4)
+        self.assertEqual(self.opt["shard-root"], "s")
+
+    def test_shards_need_root(self):
+        """Test failure on shards without a shard root"""
+        with self.assertRaises(usage.UsageError):
+            self.opt.parseOptions(self.basic + ["--shards", "4"])
+
+    def test_restart_window(self):
+        """Test explicit restart window"""
+        self.opt.parseOptions(self.basic + ["--restart-window", "2.5"])
+        self.assertEqual(self.opt["restart-window"], 2.5)
+
+    def test_inotify(self):
+        """Test explicit inotify"""
+        self.opt.parseOptions(self.basic + ["--inotify"])
+        self.assertTrue(self.opt["inotify"])
 
     def test_pid(self):
         """Test explicit pid"""
@@ -252,16 +647,53 @@ class TestOptions(unittest.TestCase):
         self.assertIsInstance(pm, procmon.ProcessMonitor)
         subservices = list(s)
         subservices.remove(pm)
+        subservices.remove(s.getServiceNamed("pids"))
         functions = [subs.call[0] for subs in subservices]
         paths = set()
         for func in functions:
             paths.add(func.args[0].basename())
         self.assertEqual(paths, set(["message-dir", "config-dir"]))
         protocols = pm.protocols
-        self.assertIsInstance(protocols, service.TransportDirectoryDict)
-        self.assertIs(protocols.output, "pid-dir")
+        self.assertIsInstance(protocols, service.PublishingDict)
+        (publisher,) = protocols.publishers
+        self.assertEqual(publisher.output, filepath.FilePath("pid-dir"))
+        self.assertIsNone(publisher.index)
         self.assertEqual(subservices[0].step, 4.5)
         self.assertEqual(pm.threshold, 0.5)
         self.assertEqual(pm.killTime, 1.5)
         self.assertEqual(pm.minRestartDelay, 2.5)
         self.assertEqual(pm.maxRestartDelay, 3.5)
+
+    def test_makeservice_shards(self):
+        """Test makeService with worker supervisors"""
+        shardRoot = os.path.join(os.getcwd(), "shards")
+        self.addCleanup(shutil.rmtree, shardRoot)
+        self.opt.parseOptions(
+            self.basic
+            + ["--killtime", "1.5"]
+            + ["--pid", "pid-dir"]
+            + ["--inotify"]
+            + ["--shards", "1", "--shard-root", shardRoot]
+        )
+        s = service.makeService(self.opt)
+        pm = s.getServiceNamed("procmon")
+        self.assertEqual(pm.killTime, 3)
+        self.assertNotIsInstance(pm.protocols, service.PublishingDict)
+        (process,) = pm._processes.values()
+        args = process.args
+        self.assertEqual(args[args.index("--killtime") + 1], "1.5")
+        self.assertEqual(args[args.index("--restart-window") + 1], "0")
+        self.assertEqual(args[args.index("--pid") + 1], "pid-dir")
+        self.assertEqual(args[args.index("--pid-delay") + 1], "0")
+        self.assertIn("--inotify", args)
+
+    def test_makeservice_shards_no_pid(self):
+        """Test makeService with worker supervisors and no pid directory"""
+        shardRoot = os.path.join(os.getcwd(), "shards")
+        self.addCleanup(shutil.rmtree, shardRoot)
+        self.opt.parseOptions(self.basic + ["--shards", "1", "--shard-root", shardRoot])
+        s = service.makeService(self.opt)
+        pm = s.getServiceNamed("procmon")
+        (process,) = pm._processes.values()
+        self.assertNotIn("--pid", process.args)
+        self.assertNotIn("--inotify", process.args)
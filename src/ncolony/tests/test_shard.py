@@ -0,0 +1,156 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.shard"""
+
+import json
+import os
+import shutil
+import unittest
+
+from zope.interface import verify
+
+from twisted.python import filepath
+
+from ncolony import ctllib
+from ncolony import interfaces
+from ncolony import shard
+from ncolony.tests import helper
+
+
+def messagesIn(place):
+    """The messages waiting in a worker's messages directory"""
+    ret = []
+    for name in sorted(os.listdir(place.messages)):
+        with open(os.path.join(place.messages, name)) as fp:
+            ret.append(json.loads(fp.read()))
+    return ret
+
+
+class TestShardFor(unittest.TestCase):
+
+    """Test assigning processes to shards"""
+
+    def test_range(self):
+        """Shards are between 0 and the count"""
+        shards = set(shard.shardFor("proc%d" % i, 4) for i in range(100))
+        self.assertEqual(shards, set(range(4)))
+
+    def test_stable(self):
+        """The same name always goes to the same shard"""
+        self.assertEqual(shard.shardFor("hello", 7), shard.shardFor("hello", 7))
+
+
+class TestRouter(unittest.TestCase):
+
+    """Test passing events on to the workers"""
+
+    def setUp(self):
+        """Set up the workers' directories"""
+        self.root = os.path.abspath("dummy-shards")
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        self.addCleanup(shutil.rmtree, self.root)
+        self.places = shard.makePlaces(self.root, 3)
+        self.router = shard.Router(self.places)
+        self.content = helper.dumps2utf8(dict(args=["/bin/echo"]))
+
+    def configOf(self, name):
+        """The configuration the owning worker has for a process"""
+        place = self.places[shard.shardFor(name, 3)]
+        with open(os.path.join(place.config, name), "rb") as fp:
+            return fp.read()
+
+    def test_interface(self):
+        """The router is an event receiver"""
+        verify.verifyObject(interfaces.IMonitorEventReceiver, self.router)
+        verify.verifyObject(interfaces.IMonitorEventUpdater, self.router)
+
+    def test_places(self):
+        """Each worker has its own directories"""
+        self.assertEqual(
+            self.places[1],
+            ctllib.Places(
+                config=os.path.join(self.root, "1", "config"),
+                messages=os.path.join(self.root, "1", "messages"),
+            ),
+        )
+        for place in self.places:
+            for directory in place:
+                self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(shard.makePlaces(self.root, 3), self.places)
+
+    def test_add_update_remove(self):
+        """Configuration is copied to, and removed from, one worker"""
+        self.router.add("hello", self.content)
+        self.assertEqual(self.configOf("hello"), self.content)
+        self.assertEqual(sum(len(os.listdir(p.config)) for p in self.places), 1)
+        newContent = helper.dumps2utf8(dict(args=["/bin/true"]))
+        self.router.update("hello", newContent)
+        self.assertEqual(self.configOf("hello"), newContent)
+        self.router.remove("hello")
+        self.assertEqual(sum(len(os.listdir(p.config)) for p in self.places), 0)
+        self.router.remove("hello")
+
+    def test_restart(self):
+        """Restarts go to the worker running the process"""
+        message = dict(type="RESTART", name="hello")
+        self.router.message(helper.dumps2utf8(message))
+        for index, place in enumerate(self.places):
+            if index == shard.shardFor("hello", 3):
+                self.assertEqual(messagesIn(place), [message])
+            else:
+                self.assertEqual(messagesIn(place), [])
+
+    def test_broadcast(self):
+        """Restarts of everything, or of a group, go to every worker"""
+        restartAll = dict(type="RESTART-ALL", batch=2)
+        restartGroup = dict(type="RESTART-GROUP", group="web")
+        self.router.message(helper.dumps2utf8(restartAll))
+        self.router.message(helper.dumps2utf8(restartGroup))
+        for place in self.places:
+            self.assertEqual(messagesIn(place), [restartAll, restartGroup])
+
+    def test_unknown_message(self):
+        """Unknown messages are rejected"""
+        with self.assertRaises(ValueError):
+            self.router.message(helper.dumps2utf8(dict(type="LALALA")))
+
+    def test_prune(self):
+        """Configuration the workers should not have is removed"""
+        names = ["proc%d" % i for i in range(10)]
+        for name in names:
+            self.router.add(name, self.content)
+        self.router.remove("proc0")
+        for place in self.places:
+            with open(os.path.join(place.config, "stale"), "wb") as fp:
+                fp.write(self.content)
+            with open(os.path.join(place.config, "proc1"), "wb") as fp:
+                fp.write(self.content)
+            with open(os.path.join(place.config, "proc2.new"), "wb") as fp:
+                fp.write(self.content)
+        self.router.prune()
+        configs = [name for p in self.places for name in os.listdir(p.config)]
+        self.assertEqual(
+            sorted(configs), sorted(names[1:] + ["proc2.new"] * len(self.places))
+        )
+        self.assertEqual(self.configOf("proc1"), self.content)
+
+    def test_pruning(self):
+        """Workers are pruned after the first full check"""
+        calls = []
+
+        def _check(names=None):
+            calls.append(names)
+
+        check = shard.pruning(_check, self.router)
+        stale = os.path.join(self.places[0].config, "stale")
+        filepath.FilePath(stale).touch()
+        check(["hello"])
+        self.assertTrue(os.path.exists(stale))
+        check()
+        self.assertFalse(os.path.exists(stale))
+        filepath.FilePath(stale).touch()
+        check()
+        self.assertTrue(os.path.exists(stale))
+        self.assertEqual(calls, [["hello"], None, None])
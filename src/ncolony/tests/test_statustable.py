@@ -0,0 +1,207 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.statustable"""
+
+import collections
+import os
+import shutil
+import types
+import unittest
+
+from twisted.internet import task
+
+from ncolony import statustable
+
+DummyTransport = collections.namedtuple("DummyTransport", "pid")
+
+
+def DummyProtocol():
+    """Something that looks like a process protocol"""
+    return types.SimpleNamespace(transport=None)
+
+
+class TestStatusTable(unittest.TestCase):
+
+    """Test reading and writing status tables"""
+
+    def setUp(self):
+        """Create a status table"""
+        self.directory = os.path.abspath("dummy-status-table")
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "status")
+        statustable.create(self.path, capacity=3)
+        self.table = statustable.StatusTable(self.path)
+        self.addCleanup(self.table.close)
+        self.table.refresh()
+
+    def test_empty(self):
+        """A new table has no records"""
+        self.assertEqual(statustable.read(self.path), {})
+        self.assertEqual(
+            os.path.getsize(self.path),
+            statustable.HEADER.size + 3 * statustable.RECORD_SIZE,
+        )
+
+    def test_not_a_table(self):
+        """Reading something that is not a table fails"""
+        with open(self.path, "wb") as fp:
+            fp.write(b"\0" * 1000)
+        with self.assertRaises(ValueError):
+            statustable.read(self.path)
+
+    def test_write(self):
+        """Both sets of fields can be written"""
+        self.table.add("hello")
+        self.table.add("hello")
+        self.table.setProcess("hello", 100, 1000.5, 2)
+        self.table.setHealth("hello", 1010.5, statustable.HEALTHY)
+        self.assertEqual(
+            statustable.read(self.path),
+            dict(
+                hello=statustable.Status(
+                    "hello", 100, 1000.5, 2, 1010.5, statustable.HEALTHY
+                )
+            ),
+        )
+
+    def test_unknown(self):
+        """Writing fields of processes not in the table does nothing"""
+        self.table.setProcess("hello", 100, 1000.5, 2)
+        self.table.setHealth("hello", 1010.5, statustable.HEALTHY)
+        self.table.remove("hello")
+        self.assertEqual(statustable.read(self.path), {})
+
+    def test_remove(self):
+        """Removed records are freed for reuse"""
+        for name in ["a", "b", "c"]:
+            self.table.add(name)
+        self.table.add("d")
+        self.assertEqual(set(statustable.read(self.path)), set("abc"))
+        self.table.setProcess("b", 100, 1000.5, 2)
+        self.table.remove("b")
+        self.table.add("d")
+        self.assertEqual(
+            statustable.read(self.path)["d"],
+            statustable.Status("d", 0, 0, 0, 0, statustable.UNKNOWN),
+        )
+
+    def test_long_name(self):
+        """Names that do not fit are not added"""
+        self.table.add("x" * 65)
+        self.table.add("y" * 64)
+        self.assertEqual(list(statustable.read(self.path)), ["y" * 64])
+
+    def test_two_writers(self):
+        """Another writer sees records once it refreshes"""
+        other = statustable.StatusTable(self.path)
+        self.addCleanup(other.close)
+        other.refresh()
+        self.table.add("hello")
+        other.setHealth("hello", 1010.5, statustable.UNHEALTHY)
+        self.assertEqual(statustable.read(self.path)["hello"].heartbeat, 0)
+        other.refresh()
+        other.setHealth("hello", 1010.5, statustable.UNHEALTHY)
+        self.assertEqual(statustable.read(self.path)["hello"].heartbeat, 1010.5)
+        self.table.remove("hello")
+        self.table.add("goodbye")
+        other.setHealth("hello", 1020.5, statustable.UNHEALTHY)
+        self.assertEqual(statustable.read(self.path)["goodbye"].heartbeat, 0)
+
+    def test_replaced(self):
+        """A replaced table is opened on refresh"""
+        self.table.add("hello")
+        statustable.create(self.path, capacity=5)
+        self.table.refresh()
+        self.assertEqual(self.table.capacity, 5)
+        self.table.add("goodbye")
+        self.assertEqual(list(statustable.read(self.path)), ["goodbye"])
+
+    def test_missing(self):
+        """A table that does not exist is not written to"""
+        table = statustable.StatusTable(os.path.join(self.directory, "missing"))
+        table.refresh()
+        table.add("hello")
+        table.close()
+        self.assertFalse(os.path.exists(table.path))
+
+
+class TestStatusPublisher(unittest.TestCase):
+
+    """Test keeping the supervisor's fields up to date"""
+
+    def setUp(self):
+        """Create a status table and a publisher"""
+        self.directory = os.path.abspath("dummy-status-table")
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "status")
+        statustable.create(self.path)
+        table = statustable.StatusTable(self.path)
+        self.addCleanup(table.close)
+        table.refresh()
+        self.clock = task.Clock()
+        self.publisher = statustable.StatusPublisher(self.clock, table)
+
+    def status(self, name):
+        """Read the status of a process"""
+        return statustable.read(self.path)[name]
+
+    def test_lifecycle(self):
+        """Starts, ends and restarts are published"""
+        self.clock.advance(100)
+        protocol = DummyProtocol()
+        self.publisher.set("hello", protocol)
+        protocol.transport = DummyTransport(5)
+        self.assertEqual(self.status("hello").pid, 0)
+        self.clock.advance(0)
+        self.assertEqual(self.status("hello")[:4], ("hello", 5, 100, 0))
+        self.clock.advance(10)
+        self.publisher.delete("hello")
+        self.assertEqual(self.status("hello")[:4], ("hello", 0, 100, 0))
+        protocol = DummyProtocol()
+        protocol.transport = DummyTransport(6)
+        self.publisher.set("hello", protocol)
+        self.clock.advance(0)
+        self.assertEqual(self.status("hello")[:4], ("hello", 6, 110, 1))
+        self.publisher.forget("hello")
+        self.assertEqual(statustable.read(self.path), {})
+
+    def test_ended_after_forgotten(self):
+        """A process that ends after it is forgotten is not published"""
+        protocol = DummyProtocol()
+        protocol.transport = DummyTransport(5)
+        self.publisher.set("hello", protocol)
+        self.publisher.forget("hello")
+        self.clock.advance(0)
+        self.publisher.delete("hello")
+        self.assertEqual(statustable.read(self.path), {})
+
+    def test_ended_before_spawned(self):
+        """A process that ends before its pid is known stays without one"""
+        self.publisher.set("hello", DummyProtocol())
+        self.publisher.delete("hello")
+        self.clock.advance(0)
+        self.assertEqual(self.status("hello").pid, 0)
+
+    def test_no_pid(self):
+        """A process that never got a pid is published without one"""
+        self.publisher.set("hello", DummyProtocol())
+        self.clock.advance(0)
+        self.assertEqual(self.status("hello").pid, 0)
+
+    def test_batched(self):
+        """Pids of processes started together are filled in together"""
+        for pid, name in enumerate(["a", "b", "c"], 1):
+            protocol = DummyProtocol()
+            protocol.transport = DummyTransport(pid)
+            self.publisher.set(name, protocol)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        pids = {name: state.pid for name, state in statustable.read(self.path).items()}
+        self.assertEqual(pids, dict(a=1, b=2, c=3))